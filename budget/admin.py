@@ -1,8 +1,10 @@
 from django.contrib import admin
+from budget.categories.forms import SlugAdminForm
 from budget.models import Budget, BudgetEstimate
 
 
 class BudgetAdmin(admin.ModelAdmin):
+    form = SlugAdminForm
     date_hierarchy = 'start_date'
     fieldsets = (
         (None, {
@@ -0,0 +1,223 @@
+"""
+Vectorized analytics over a ``TrendReport``.
+
+Computes the variance from estimates, percent of estimate, trailing moving
+averages and projected totals for every category and month at once. All of
+the math is done on whole cents (integers), with NumPy when it's installed
+and in pure Python otherwise; both give identical results. Amounts are only
+turned back into ``Decimal`` objects at the edges.
+
+Percentages and averages are rounded half up to the nearest hundredth.
+"""
+from decimal import Decimal
+from django.core.exceptions import ImproperlyConfigured
+from budget.models import BudgetEstimate
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def round_div(numerator, denominator):
+    """
+    Integer division rounding half up, for positive denominators. Works the
+    same for ints and NumPy integer arrays.
+    """
+    return (2 * numerator + denominator) // (2 * denominator)
+
+
+class PythonBackend(object):
+    """
+    The analytics on lists of rows of integers, one row per category.
+    """
+    name = 'python'
+
+    def __init__(self, actual, estimates):
+        self.actual = actual
+        self.estimates = estimates
+
+    def variance(self):
+        return [[estimate - actual for actual, estimate in zip(actual_row, estimate_row)] for actual_row, estimate_row in zip(self.actual, self.estimates)]
+
+    def percent_of_estimate(self):
+        rows = []
+
+        for actual_row, estimate_row in zip(self.actual, self.estimates):
+            row = []
+
+            for actual, estimate in zip(actual_row, estimate_row):
+                if estimate:
+                    row.append(round_div(actual * 10000, estimate))
+                else:
+                    row.append(None)
+
+            rows.append(row)
+
+        return rows
+
+    def moving_average(self, window):
+        rows = []
+
+        for actual_row in self.actual:
+            row = []
+            total = 0
+
+            for index in range(len(actual_row)):
+                total += actual_row[index]
+
+                if index >= window:
+                    total -= actual_row[index - window]
+
+                row.append(round_div(total, min(index + 1, window)))
+
+            rows.append(row)
+
+        return rows
+
+    def projection(self, window, months):
+        projected = []
+
+        for actual_row, average_row in zip(self.actual, self.moving_average(window)):
+            if average_row:
+                projected.append(sum(actual_row) + average_row[-1] * months)
+            else:
+                projected.append(0)
+
+        return projected
+
+
+class NumpyBackend(object):
+    """
+    The analytics on 2D arrays of 64 bit integers, one row per category.
+    """
+    name = 'numpy'
+
+    def __init__(self, actual, estimates):
+        self.actual = numpy.array(actual, dtype=numpy.int64).reshape(len(actual), -1)
+        self.estimates = numpy.array(estimates, dtype=numpy.int64).reshape(len(estimates), -1)
+
+    def variance(self):
+        return (self.estimates - self.actual).tolist()
+
+    def percent_of_estimate(self):
+        missing = self.estimates == 0
+        # Divide by one where there's no estimate, then blank those cells out.
+        percents = round_div(self.actual * 10000, numpy.where(missing, 1, self.estimates)).tolist()
+
+        for row, column in zip(*numpy.nonzero(missing)):
+            percents[row][column] = None
+
+        return percents
+
+    def moving_average(self, window):
+        rows, columns = self.actual.shape
+        totals = numpy.zeros((rows, columns + 1), dtype=numpy.int64)
+        numpy.cumsum(self.actual, axis=1, out=totals[:, 1:])
+        ends = numpy.arange(1, columns + 1)
+        starts = numpy.maximum(ends - window, 0)
+        return round_div(totals[:, ends] - totals[:, starts], ends - starts).tolist()
+
+    def projection(self, window, months):
+        if not self.actual.shape[1]:
+            return [0] * self.actual.shape[0]
+
+        averages = numpy.array(self.moving_average(window), dtype=numpy.int64)
+        return (self.actual.sum(axis=1) + averages[:, -1] * months).tolist()
+
+
+def to_decimal(value):
+    """
+    Turns whole cents (or hundredths of a percent) back into a ``Decimal``.
+    """
+    if value is None:
+        return None
+
+    return Decimal(int(value)) / 100
+
+
+def estimate_cents(report):
+    """
+    Returns the monthly estimate for each of the report's categories and
+    months, in cents, according to the budget applying to each month.
+    """
+    budget_ids = set([budget.pk for budget in report.budgets if budget is not None])
+    amounts = {}
+
+    for budget_id, category_id, amount in BudgetEstimate.active.filter(budget__in=list(budget_ids)).values_list('budget', 'category', 'amount'):
+        amounts[(budget_id, category_id)] = int((amount * 100).to_integral())
+
+    rows = []
+
+    for category in report.categories:
+        row = []
+
+        for budget in report.budgets:
+            if budget is None:
+                row.append(0)
+            else:
+                row.append(amounts.get((budget.pk, category.pk), 0))
+
+        rows.append(row)
+
+    return rows
+
+
+class Analytics(object):
+    """
+    Expense analytics for every category and month of a ``TrendReport``.
+
+    Each method returns a list of rows in the same order as
+    ``report.categories``. Pass ``use_numpy=False`` to force the pure-Python
+    backend (it's used automatically when NumPy isn't installed).
+    """
+    def __init__(self, report, use_numpy=None):
+        if use_numpy is None:
+            use_numpy = numpy is not None
+
+        if use_numpy and numpy is None:
+            raise ImproperlyConfigured('NumPy is not installed.')
+
+        if use_numpy:
+            backend_class = NumpyBackend
+        else:
+            backend_class = PythonBackend
+
+        self.report = report
+        self.categories = report.categories
+        actual = []
+
+        for category in report.categories:
+            start = report.expenses.category_index[category.pk] * len(report.months)
+            actual.append([int(cents) for cents in report.expenses.cells[start:start + len(report.months)]])
+
+        self.backend = backend_class(actual, estimate_cents(report))
+
+    def convert(self, rows):
+        return [[to_decimal(value) for value in row] for row in rows]
+
+    def variance(self):
+        """
+        The estimate less the actual expenses; negative when over budget.
+        """
+        return self.convert(self.backend.variance())
+
+    def percent_of_estimate(self):
+        """
+        The actual expenses as a percentage of the estimate, or ``None`` where
+        there is no estimate.
+        """
+        return self.convert(self.backend.percent_of_estimate())
+
+    def moving_average(self, window=3):
+        """
+        The average expenses over the trailing ``window`` months (fewer at the
+        start of the report).
+        """
+        return self.convert(self.backend.moving_average(window))
+
+    def projection(self, window=3, months=12):
+        """
+        The total expenses of each category so far plus ``months`` more months
+        at the latest moving average.
+        """
+        return [to_decimal(value) for value in self.backend.projection(window, months)]
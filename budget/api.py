@@ -0,0 +1,642 @@
+"""
+A JSON API for transactions, categories, budgets, estimates and the budget
+reports.
+
+Collections answer ``GET`` with a page of objects (paginated like the list
+views) and ``POST`` by creating an object. Single objects answer ``GET``,
+``POST``/``PUT`` (only the fields given are changed) and ``DELETE`` (a soft
+delete). Bodies are either JSON or form encoded, categories and budgets are
+referred to by slug and errors come back as ``{"errors": {...}}`` with a 400.
+
+Every ``GET`` carries an ``ETag`` and ``Last-Modified`` built from the latest
+``updated`` and the number of rows (deleted ones included, since deleting
+updates them) in everything the response is built from. Those are found
+with a few aggregate queries before the view runs, which read the
+``updated`` indexes of the custom SQL rather than the tables, so clients
+polling data which hasn't changed get a 304 without the objects being
+fetched or the report being computed.
+"""
+import datetime
+from django import forms
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.urlresolvers import reverse
+from django.db.transaction import commit_on_success
+from django.db.models import Count, Max
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed, QueryDict
+from django.shortcuts import get_object_or_404
+from django.utils import simplejson
+from django.utils.encoding import force_unicode
+from django.utils.hashcompat import md5_constructor
+from django.views.decorators.http import condition
+from budget import caching
+from budget import tenancy
+from budget.instrumentation import instrument
+from budget.models import Budget, BudgetEstimate
+from budget.categories.forms import CategoryForm
+from budget.categories.models import Category
+from budget.forms import BudgetEstimateForm, BudgetForm
+from budget.pagination import paginate
+from budget.transactions.exporters import filter_transactions, transaction_row
+from budget.transactions.forms import TransactionBatchFormSet, TransactionExportForm, TransactionForm, batch_data
+from budget.transactions.models import Transaction, filter_dates
+from budget.views import month_bounds
+
+
+def json_response(data, status=200):
+    response = HttpResponse(simplejson.dumps(data, cls=DjangoJSONEncoder), mimetype='application/json')
+    response.status_code = status
+    return response
+
+
+def error_response(form):
+    errors = dict([(name, [force_unicode(error) for error in field_errors]) for name, field_errors in form.errors.items()])
+    return HttpResponseBadRequest(simplejson.dumps({'errors': errors}), mimetype='application/json')
+
+
+def is_json(request):
+    return request.META.get('CONTENT_TYPE', '').startswith('application/json')
+
+
+def bad_body():
+    return HttpResponseBadRequest(simplejson.dumps({'errors': {'__all__': [u'The body is not a JSON object.']}}), mimetype='application/json')
+
+
+def request_data(request):
+    """
+    The submitted fields, from either a JSON object or a form encoded body.
+    Returns ``None`` if the JSON can't be read.
+    """
+    if is_json(request):
+        try:
+            data = simplejson.loads(request.raw_post_data)
+        except ValueError:
+            return None
+
+        if not isinstance(data, dict):
+            return None
+
+        return data
+
+    if request.method == 'POST':
+        return request.POST
+
+    return QueryDict(request.raw_post_data)
+
+
+def merge_data(initial, data):
+    """
+    Lays the submitted fields over an object's current values, so updates
+    only need to send what changed.
+    """
+    merged = dict(initial)
+
+    for name in data.keys():
+        merged[name] = data[name]
+
+    return merged
+
+
+def page_links(page, paginator):
+    """
+    The ``page`` (or ``cursor``) values of the pages either side of this one.
+    """
+    if getattr(paginator, 'is_keyset', False):
+        return (page.next_cursor, page.previous_cursor)
+
+    next_page = previous_page = None
+
+    if page.has_next():
+        next_page = page.next_page_number()
+
+    if page.has_previous():
+        previous_page = page.previous_page_number()
+
+    return (next_page, previous_page)
+
+
+def list_response(request, queryset, keyset_ordering, row_function):
+    object_list, paginator, page = paginate(request, queryset, keyset_ordering)
+    next_page, previous_page = page_links(page, paginator)
+    return json_response({
+        'objects': [row_function(obj) for obj in object_list],
+        'next': next_page,
+        'previous': previous_page,
+    })
+
+
+def resource_state(request, querysets):
+    """
+    Returns the ``(etag, last_modified)`` of a response built from the given
+    querysets, with one aggregate query per queryset.
+    """
+    parts = [request.get_full_path(), tenancy.scope_key()]
+    last_modified = None
+
+    for queryset in querysets:
+        state = queryset.order_by().aggregate(latest=Max('updated'), count=Count('id'))
+        parts.append('%s/%s' % (state['latest'], state['count']))
+
+        if state['latest'] is not None and (last_modified is None or state['latest'] > last_modified):
+            last_modified = state['latest']
+
+    return (md5_constructor('|'.join(parts)).hexdigest(), last_modified)
+
+
+def conditional(state_function):
+    """
+    Makes a view answer conditional ``GET`` requests, where
+    ``state_function`` takes the view's arguments and returns the querysets
+    the response is built from. Their state is only worked out once per
+    request.
+    """
+    def get_state(request, *args, **kwargs):
+        if not hasattr(request, '_budget_api_state'):
+            request._budget_api_state = resource_state(request, state_function(*args, **kwargs))
+
+        return request._budget_api_state
+
+    def etag(request, *args, **kwargs):
+        return get_state(request, *args, **kwargs)[0]
+
+    def last_modified(request, *args, **kwargs):
+        return get_state(request, *args, **kwargs)[1]
+
+    return condition(etag_func=etag, last_modified_func=last_modified)
+
+
+def scoped_objects(model):
+    """
+    All of the current ledger's rows of ``model``, deleted ones included.
+    """
+    return tenancy.scope(model.objects.all())
+
+
+# Rows
+
+def category_row(category):
+    return {
+        'slug': category.slug,
+        'name': category.name,
+        'updated': category.updated,
+    }
+
+
+def budget_row(budget):
+    return {
+        'slug': budget.slug,
+        'name': budget.name,
+        'start_date': budget.start_date,
+        'updated': budget.updated,
+    }
+
+
+def estimate_row(estimate):
+    return {
+        'id': estimate.id,
+        'budget': estimate.budget.slug,
+        'category': estimate.category.slug,
+        'amount': str(estimate.amount),
+        'updated': estimate.updated,
+    }
+
+
+def api_transaction_row(transaction):
+    row = transaction_row(transaction)
+    row['updated'] = transaction.updated
+    return row
+
+
+# Forms
+
+class TransactionAPIForm(TransactionForm):
+    """
+    Refers to the category by slug.
+    """
+    def __init__(self, *args, **kwargs):
+        super(TransactionAPIForm, self).__init__(*args, **kwargs)
+        self.fields['category'].to_field_name = 'slug'
+
+
+class BudgetAPIForm(BudgetForm):
+    """
+    Takes the start date as one value, defaulting to now.
+    """
+    start_date = forms.DateTimeField(required=False)
+
+    def clean_start_date(self):
+        return self.cleaned_data['start_date'] or datetime.datetime.now()
+
+
+class BudgetEstimateAPIForm(BudgetEstimateForm):
+    """
+    Refers to the category by slug.
+    """
+    def __init__(self, *args, **kwargs):
+        super(BudgetEstimateAPIForm, self).__init__(*args, **kwargs)
+        self.fields['category'].to_field_name = 'slug'
+
+
+def save_form(request, form_class, initial=None, instance=None, **save_kwargs):
+    """
+    Validates the submitted data with ``form_class`` and saves it, returning
+    either the saved object or an error response.
+    """
+    data = request_data(request)
+
+    if data is None:
+        return (None, bad_body())
+
+    if initial is not None:
+        data = merge_data(initial, data)
+
+    form = form_class(data, instance=instance)
+
+    if not form.is_valid():
+        return (None, error_response(form))
+
+    form.save(**save_kwargs)
+    return (form.instance, None)
+
+
+# Transactions
+
+def transaction_list_state():
+    return [scoped_objects(Transaction)]
+
+
+@conditional(transaction_list_state)
+def transaction_list(request):
+    form = TransactionExportForm(request.GET)
+
+    if not form.is_valid():
+        return error_response(form)
+
+    cleaned_data = form.cleaned_data
+    transactions = filter_transactions(Transaction.active.select_related('category'), cleaned_data['start_date'], cleaned_data['end_date'], cleaned_data['transaction_type'], cleaned_data['category'])
+    return list_response(request, transactions.order_by('-date', '-created'), ('-date', '-created', '-id'), api_transaction_row)
+
+
+@instrument
+def transaction_collection(request):
+    """
+    Lists transactions (filtered by ``start_date``, ``end_date``,
+    ``transaction_type`` and ``category``) or creates one.
+    """
+    if request.method == 'GET':
+        return transaction_list(request)
+
+    if request.method == 'POST':
+        transaction, response = save_form(request, TransactionAPIForm)
+
+        if response is not None:
+            return response
+
+        response = json_response(api_transaction_row(transaction), status=201)
+        response['Location'] = reverse('budget_api_transaction', kwargs={'transaction_id': transaction.id})
+        return response
+
+    return HttpResponseNotAllowed(['GET', 'POST'])
+
+
+@instrument
+def transaction_batch(request):
+    """
+    Adds many transactions at once from a JSON object whose ``transactions``
+    are rows like those of the transaction list. Every row is validated
+    before any are saved, then they're all inserted together in one database
+    transaction.
+
+    Answers with the number added, or with the errors for each row (in
+    order, empty for rows which were fine).
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+
+    data = request_data(request)
+
+    if data is None or not is_json(request) or not isinstance(data.get('transactions'), list):
+        return bad_body()
+
+    for row in data['transactions']:
+        if not isinstance(row, dict):
+            return bad_body()
+
+    formset = TransactionBatchFormSet(batch_data(data['transactions']))
+
+    if not formset.is_valid():
+        errors = {
+            'rows': formset.row_errors(),
+            'batch': [force_unicode(error) for error in formset.non_form_errors()],
+        }
+        return HttpResponseBadRequest(simplejson.dumps({'errors': errors}), mimetype='application/json')
+
+    return json_response({'created': commit_on_success(formset.save)()}, status=201)
+
+
+def transaction_detail_state(transaction_id):
+    return [scoped_objects(Transaction).filter(pk=transaction_id)]
+
+
+@conditional(transaction_detail_state)
+def transaction_detail(request, transaction_id):
+    return json_response(api_transaction_row(get_object_or_404(Transaction.active.select_related('category'), pk=transaction_id)))
+
+
+@instrument
+def transaction_resource(request, transaction_id):
+    """
+    Shows, updates or deletes a transaction.
+    """
+    if request.method == 'GET':
+        return transaction_detail(request, transaction_id=transaction_id)
+
+    transaction = get_object_or_404(Transaction.active.select_related('category'), pk=transaction_id)
+
+    if request.method in ('POST', 'PUT'):
+        row = transaction_row(transaction)
+        del row['id']
+        transaction, response = save_form(request, TransactionAPIForm, initial=row, instance=transaction)
+
+        if response is not None:
+            return response
+
+        return json_response(api_transaction_row(transaction))
+
+    if request.method == 'DELETE':
+        transaction.delete()
+        return HttpResponse(status=204)
+
+    return HttpResponseNotAllowed(['GET', 'POST', 'PUT', 'DELETE'])
+
+
+# Categories
+
+def category_list_state():
+    return [scoped_objects(Category)]
+
+
+@conditional(category_list_state)
+def category_list(request):
+    return list_response(request, Category.active.all(), ('id',), category_row)
+
+
+@instrument
+def category_collection(request):
+    """
+    Lists categories or creates one.
+    """
+    if request.method == 'GET':
+        return category_list(request)
+
+    if request.method == 'POST':
+        category, response = save_form(request, CategoryForm)
+
+        if response is not None:
+            return response
+
+        response = json_response(category_row(category), status=201)
+        response['Location'] = reverse('budget_api_category', kwargs={'slug': category.slug})
+        return response
+
+    return HttpResponseNotAllowed(['GET', 'POST'])
+
+
+def category_detail_state(slug):
+    return [scoped_objects(Category).filter(slug=slug)]
+
+
+@conditional(category_detail_state)
+def category_detail(request, slug):
+    return json_response(category_row(get_object_or_404(Category.active.all(), slug=slug)))
+
+
+@instrument
+def category_resource(request, slug):
+    """
+    Shows, renames or deletes a category.
+    """
+    if request.method == 'GET':
+        return category_detail(request, slug=slug)
+
+    category = get_object_or_404(Category.active.all(), slug=slug)
+
+    if request.method in ('POST', 'PUT'):
+        category, response = save_form(request, CategoryForm, initial={'name': category.name}, instance=category)
+
+        if response is not None:
+            return response
+
+        return json_response(category_row(category))
+
+    if request.method == 'DELETE':
+        category.delete()
+        return HttpResponse(status=204)
+
+    return HttpResponseNotAllowed(['GET', 'POST', 'PUT', 'DELETE'])
+
+
+# Budgets
+
+def budget_list_state():
+    return [scoped_objects(Budget)]
+
+
+@conditional(budget_list_state)
+def budget_list(request):
+    return list_response(request, Budget.active.all(), ('id',), budget_row)
+
+
+@instrument
+def budget_collection(request):
+    """
+    Lists budgets or creates one.
+    """
+    if request.method == 'GET':
+        return budget_list(request)
+
+    if request.method == 'POST':
+        budget, response = save_form(request, BudgetAPIForm)
+
+        if response is not None:
+            return response
+
+        response = json_response(budget_row(budget), status=201)
+        response['Location'] = reverse('budget_api_budget', kwargs={'slug': budget.slug})
+        return response
+
+    return HttpResponseNotAllowed(['GET', 'POST'])
+
+
+def budget_detail_state(slug):
+    return [scoped_objects(Budget).filter(slug=slug)]
+
+
+@conditional(budget_detail_state)
+def budget_detail(request, slug):
+    return json_response(budget_row(get_object_or_404(Budget.active.all(), slug=slug)))
+
+
+@instrument
+def budget_resource(request, slug):
+    """
+    Shows, updates or deletes a budget.
+    """
+    if request.method == 'GET':
+        return budget_detail(request, slug=slug)
+
+    budget = get_object_or_404(Budget.active.all(), slug=slug)
+
+    if request.method in ('POST', 'PUT'):
+        initial = {'name': budget.name, 'start_date': budget.start_date.strftime('%Y-%m-%d %H:%M:%S')}
+        budget, response = save_form(request, BudgetAPIForm, initial=initial, instance=budget)
+
+        if response is not None:
+            return response
+
+        return json_response(budget_row(budget))
+
+    if request.method == 'DELETE':
+        budget.delete()
+        return HttpResponse(status=204)
+
+    return HttpResponseNotAllowed(['GET', 'POST', 'PUT', 'DELETE'])
+
+
+# BudgetEstimates
+
+def estimate_list_state(budget_slug):
+    return [scoped_objects(Budget).filter(slug=budget_slug), scoped_objects(BudgetEstimate).filter(budget__slug=budget_slug)]
+
+
+@conditional(estimate_list_state)
+def estimate_list(request, budget_slug):
+    budget = get_object_or_404(Budget.active.all(), slug=budget_slug)
+    estimates = BudgetEstimate.active.filter(budget=budget).select_related('category', 'budget')
+    return list_response(request, estimates, ('id',), estimate_row)
+
+
+@instrument
+def estimate_collection(request, budget_slug):
+    """
+    Lists the estimates of a budget or adds one.
+    """
+    if request.method == 'GET':
+        return estimate_list(request, budget_slug=budget_slug)
+
+    if request.method == 'POST':
+        budget = get_object_or_404(Budget.active.all(), slug=budget_slug)
+        estimate, response = save_form(request, BudgetEstimateAPIForm, budget=budget)
+
+        if response is not None:
+            return response
+
+        response = json_response(estimate_row(estimate), status=201)
+        response['Location'] = reverse('budget_api_estimate', kwargs={'budget_slug': budget.slug, 'estimate_id': estimate.id})
+        return response
+
+    return HttpResponseNotAllowed(['GET', 'POST'])
+
+
+def estimate_detail_state(budget_slug, estimate_id):
+    return [scoped_objects(BudgetEstimate).filter(budget__slug=budget_slug, pk=estimate_id)]
+
+
+def get_estimate(budget_slug, estimate_id):
+    budget = get_object_or_404(Budget.active.all(), slug=budget_slug)
+
+    try:
+        return budget.estimates.select_related('category', 'budget').get(pk=estimate_id, is_deleted=False)
+    except ObjectDoesNotExist:
+        raise Http404("The requested estimate could not be found.")
+
+
+@conditional(estimate_detail_state)
+def estimate_detail(request, budget_slug, estimate_id):
+    return json_response(estimate_row(get_estimate(budget_slug, estimate_id)))
+
+
+@instrument
+def estimate_resource(request, budget_slug, estimate_id):
+    """
+    Shows, updates or deletes an estimate.
+    """
+    if request.method == 'GET':
+        return estimate_detail(request, budget_slug=budget_slug, estimate_id=estimate_id)
+
+    estimate = get_estimate(budget_slug, estimate_id)
+
+    if request.method in ('POST', 'PUT'):
+        initial = {'category': estimate.category.slug, 'amount': str(estimate.amount)}
+        estimate, response = save_form(request, BudgetEstimateAPIForm, initial=initial, instance=estimate, budget=estimate.budget)
+
+        if response is not None:
+            return response
+
+        return json_response(estimate_row(estimate))
+
+    if request.method == 'DELETE':
+        estimate.delete()
+        return HttpResponse(status=204)
+
+    return HttpResponseNotAllowed(['GET', 'POST', 'PUT', 'DELETE'])
+
+
+# Reports
+
+def report_bounds(year, month=None):
+    if month is None:
+        return (datetime.date(int(year), 1, 1), datetime.date(int(year), 12, 31))
+
+    return month_bounds(year, month)
+
+
+def report_state(year, month=None):
+    """
+    A report depends on which budget covers its dates, that budget's
+    estimates, their categories and the transactions in those categories
+    over the dates.
+    """
+    start_date, end_date = report_bounds(year, month)
+    budgets = scoped_objects(Budget)
+
+    try:
+        budget = Budget.active.most_current_for_date(end_date)
+    except ObjectDoesNotExist:
+        return [budgets]
+
+    estimates = BudgetEstimate.objects.filter(budget=budget)
+    category_ids = list(estimates.values_list('category', flat=True))
+    transactions = filter_dates(Transaction.objects.filter(category__in=category_ids), start_date, end_date)
+    return [budgets, estimates, Category.objects.filter(pk__in=category_ids), transactions]
+
+
+@instrument
+@conditional(report_state)
+def report(request, year, month=None):
+    """
+    The budget report for a year or a month, as built by
+    ``Budget.estimates_and_transactions``.
+    """
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+
+    start_date, end_date = report_bounds(year, month)
+
+    try:
+        budget = Budget.active.most_current_for_date(end_date)
+    except ObjectDoesNotExist:
+        raise Http404('No budget covers the requested dates.')
+
+    estimates_and_transactions, actual_total = caching.estimates_and_transactions(budget, start_date, end_date)
+    return json_response({
+        'budget': budget_row(budget),
+        'start_date': start_date,
+        'end_date': end_date,
+        'estimates': [{
+            'estimate': estimate_row(eat_group['estimate']),
+            'actual_amount': str(eat_group['actual_amount']),
+            'transactions': [api_transaction_row(transaction) for transaction in eat_group['transactions']],
+        } for eat_group in estimates_and_transactions],
+        'actual_total': str(actual_total),
+    })
@@ -0,0 +1,151 @@
+"""
+Archiving, restoring and purging soft-deleted rows.
+
+``StandardMetadata.delete`` only flags rows as deleted, so the tables grow
+forever. Rows which have been deleted for longer than a retention window can
+be moved out into a gzipped JSON lines file (one serialized object per line)
+and restored from it later, or purged outright.
+
+Rows are handled a batch at a time, children before parents, and a category
+or budget is only removed once nothing refers to it any more (its own
+deleted transactions, estimates and rules go first). The derived rollup and
+balance rows of an archived category go with it, since they can be rebuilt.
+"""
+import datetime
+import gzip
+from django.core import serializers
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import simplejson
+from budget.models import Budget, BudgetEstimate
+from budget.categories.models import Category, CategoryRule
+from budget.transactions.models import Transaction
+
+# Children first, so parents are free of references by the time they're
+# reached. Restoring goes the other way.
+ARCHIVE_ORDER = (Transaction, BudgetEstimate, CategoryRule, Category, Budget)
+
+
+def model_label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name.lower())
+
+
+def archivable(model, cutoff):
+    """
+    The soft-deleted rows of ``model`` last updated before ``cutoff`` which
+    nothing else refers to.
+    """
+    queryset = model.objects.filter(is_deleted=True, updated__lt=cutoff)
+
+    if model is Category:
+        queryset = queryset.exclude(pk__in=Transaction.objects.values_list('category', flat=True))
+        queryset = queryset.exclude(pk__in=BudgetEstimate.objects.values_list('category', flat=True))
+        queryset = queryset.exclude(pk__in=CategoryRule.objects.values_list('category', flat=True))
+    elif model is Budget:
+        queryset = queryset.exclude(pk__in=BudgetEstimate.objects.values_list('budget', flat=True))
+
+    return queryset.order_by('pk')
+
+
+def remove(days=365, batch_size=1000, output=None, commit=None):
+    """
+    Removes the archivable rows of every model, writing them to the
+    ``output`` file object first (if given). ``commit`` is called after each
+    batch.
+
+    Returns a dictionary of model labels to the number of rows removed.
+    """
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=days)
+    counts = {}
+
+    for model in ARCHIVE_ORDER:
+        counts[model_label(model)] = 0
+
+        while True:
+            batch = list(archivable(model, cutoff)[:batch_size])
+
+            if not batch:
+                break
+
+            if output is not None:
+                for record in serializers.serialize('python', batch):
+                    output.write(simplejson.dumps(record, cls=DjangoJSONEncoder) + '\n')
+
+                output.flush()
+
+            model.objects.filter(pk__in=[obj.pk for obj in batch]).delete()
+            counts[model_label(model)] += len(batch)
+
+            if commit is not None:
+                commit()
+
+    return counts
+
+
+def archive(filename, days=365, batch_size=1000, commit=None):
+    """
+    Moves the archivable rows into a gzipped JSON lines file.
+    """
+    output = gzip.open(filename, 'wb')
+
+    try:
+        return remove(days, batch_size, output, commit)
+    finally:
+        output.close()
+
+
+def purge(days=365, batch_size=1000, commit=None):
+    """
+    Deletes the archivable rows for good.
+    """
+    return remove(days, batch_size, None, commit)
+
+
+def restore(filename, batch_size=1000, commit=None):
+    """
+    Puts the rows from an archive file back (still soft-deleted), parents
+    first. Rows whose primary key is taken are skipped.
+
+    Returns a dictionary of model labels to the number of rows restored.
+    """
+    counts = {}
+
+    for model in reversed(ARCHIVE_ORDER):
+        label = model_label(model)
+        counts[label] = 0
+        records = []
+        archive_file = gzip.open(filename, 'rb')
+
+        try:
+            for line in archive_file:
+                record = simplejson.loads(line)
+
+                if record['model'] == label:
+                    records.append(record)
+
+                if len(records) >= batch_size:
+                    counts[label] += restore_records(model, records)
+                    records = []
+
+                    if commit is not None:
+                        commit()
+
+            counts[label] += restore_records(model, records)
+
+            if commit is not None:
+                commit()
+        finally:
+            archive_file.close()
+
+    return counts
+
+
+def restore_records(model, records):
+    existing = set(model.objects.filter(pk__in=[record['pk'] for record in records]).values_list('pk', flat=True))
+    restored = 0
+
+    for deserialized in serializers.deserialize('python', records):
+        if deserialized.object.pk not in existing:
+            deserialized.save()
+            restored += 1
+
+    return restored
@@ -0,0 +1,259 @@
+"""
+Timing and query plan helpers for benchmarking the budget queries.
+"""
+import datetime
+import re
+import time
+try:
+    import resource
+except ImportError:
+    # Not available on Windows.
+    resource = None
+from django.conf import settings
+from django.core.management.color import no_style
+from django.core.management.sql import custom_sql_for_model
+from django.db import connection, reset_queries
+from budget.categories.models import Category
+from budget.models import Budget, BudgetEstimate
+from budget.transactions.models import Transaction
+
+INDEX_RE = re.compile(r'CREATE\s+INDEX\s+(\w+)\s+ON\s+(\w+)', re.I)
+
+
+def custom_indexes(models=(Transaction, Budget, BudgetEstimate, Category)):
+    """
+    Returns ``(name, table, statement)`` for every index created by the
+    custom SQL of the given models.
+    """
+    indexes = []
+
+    for model in models:
+        for statement in custom_sql_for_model(model, no_style()):
+            match = INDEX_RE.search(statement)
+
+            if match:
+                indexes.append((match.group(1), match.group(2), statement))
+
+    return indexes
+
+
+def drop_indexes(indexes):
+    cursor = connection.cursor()
+    qn = connection.ops.quote_name
+
+    for name, table, statement in indexes:
+        if settings.DATABASE_ENGINE == 'mysql':
+            cursor.execute('DROP INDEX %s ON %s' % (qn(name), qn(table)))
+        else:
+            cursor.execute('DROP INDEX %s' % qn(name))
+
+
+def create_indexes(indexes):
+    cursor = connection.cursor()
+
+    for name, table, statement in indexes:
+        cursor.execute(statement)
+
+    if settings.DATABASE_ENGINE == 'sqlite3':
+        # Give the planner statistics to work with.
+        cursor.execute('ANALYZE')
+
+
+def explain(queryset):
+    """
+    Returns the database's query plan for a queryset as a list of strings.
+    """
+    sql, params = queryset.query.as_sql()
+
+    if settings.DATABASE_ENGINE == 'sqlite3':
+        sql = 'EXPLAIN QUERY PLAN ' + sql
+    else:
+        sql = 'EXPLAIN ' + sql
+
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    return [' '.join([unicode(column) for column in row]) for row in cursor.fetchall()]
+
+
+def time_queryset(queryset, repeat=5):
+    """
+    Evaluates a (fresh copy of the) queryset ``repeat`` times and returns the
+    best and average times in milliseconds.
+    """
+    timings = []
+
+    for attempt in range(repeat):
+        start = time.time()
+        list(queryset.all())
+        timings.append((time.time() - start) * 1000)
+
+    return {
+        'best_ms': round(min(timings), 3),
+        'average_ms': round(sum(timings) / len(timings), 3),
+    }
+
+
+def hot_queries():
+    """
+    The queries behind the reports, the dashboard and the transaction list,
+    built against whatever data is in the database.
+    """
+    from django.db.models import Sum
+
+    category_ids = list(Transaction.active.values_list('category', flat=True).order_by('category').distinct()[:10])
+    today = datetime.date.today()
+    start_date = datetime.date(today.year, 1, 1)
+    end_date = datetime.date(today.year, 12, 31)
+    queries = []
+
+    if category_ids:
+        queries.append(('BudgetEstimate.actual_transactions', Transaction.expenses.filter(category=category_ids[0], date__range=(start_date, end_date)).order_by('date')))
+
+    queries.extend([
+        ('actual_amounts_by_category', Transaction.expenses.filter(category__in=category_ids, date__range=(start_date, end_date)).values('category').annotate(total=Sum('amount')).order_by()),
+        ('TransactionExpenseManager.get_latest', Transaction.expenses.order_by('-date', '-created')[:10]),
+        ('TransactionIncomeManager.get_latest', Transaction.incomes.order_by('-date', '-created')[:10]),
+        ('transaction_list', Transaction.active.order_by('-date', '-created')[:50]),
+        ('BudgetManager.most_current_for_date', Budget.active.filter(start_date__lte=today).order_by('-start_date')[:1]),
+        ('Budget.active_estimates', BudgetEstimate.objects.filter(budget__in=list(Budget.active.values_list('id', flat=True)[:1])).exclude(is_deleted=True)),
+    ])
+    return queries
+
+
+def benchmark_queries(queries, repeat=5):
+    """
+    Times and explains each ``(label, queryset)`` pair.
+    """
+    results = {}
+
+    for label, queryset in queries:
+        results[label] = time_queryset(queryset, repeat)
+        results[label]['plan'] = explain(queryset)
+
+    return results
+
+
+def peak_memory_kb():
+    """
+    The peak resident memory of the process so far in kilobytes, or ``None``
+    where that isn't available.
+    """
+    if resource is None:
+        return None
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def memory_growth_kb(start_memory):
+    """
+    How far the peak resident memory has risen since ``start_memory`` was
+    read from ``peak_memory_kb``. The peak only ever grows, so this is the
+    memory a measurement needed beyond what the process had already used.
+    """
+    if start_memory is None:
+        return None
+
+    return peak_memory_kb() - start_memory
+
+
+def measure(func, repeat=5):
+    """
+    Calls ``func`` ``repeat`` times, returning the best and average wall
+    times in milliseconds, the number of queries of the last call and how
+    far the calls raised the peak memory of the process.
+
+    Queries are only recorded while ``settings.DEBUG`` is on, so it is
+    switched on for the duration.
+    """
+    old_debug = settings.DEBUG
+    settings.DEBUG = True
+    timings = []
+    start_memory = peak_memory_kb()
+
+    try:
+        for attempt in range(repeat):
+            reset_queries()
+            start = time.time()
+            func()
+            timings.append((time.time() - start) * 1000)
+            queries = connection.queries
+            sql_ms = sum([float(query['time']) for query in queries]) * 1000
+    finally:
+        settings.DEBUG = old_debug
+
+    return {
+        'best_ms': round(min(timings), 3),
+        'average_ms': round(sum(timings) / len(timings), 3),
+        'queries': len(queries),
+        'sql_ms': round(sql_ms, 3),
+        'peak_memory_growth_kb': memory_growth_kb(start_memory),
+    }
+
+
+COLORIZE_TEMPLATES = (
+    ('template: colorize_amount tag', '{% load budget %}{% for eat_group in estimates_and_transactions %}<span class="{% colorize_amount eat_group.estimate.amount eat_group.actual_amount %}"></span>{% endfor %}'),
+    ('template: colorize_estimates filter', '{% load budget %}{% for eat_group in estimates_and_transactions|colorize_estimates %}<span class="{{ eat_group.color }}"></span>{% endfor %}'),
+)
+
+
+def uncompiled_color(estimate, actual):
+    """
+    Colors an amount the way ``colorize_amount`` did before its thresholds
+    were compiled, converting each one on every call. Only kept as the
+    baseline for ``benchmark_colorize``.
+    """
+    from budget.templatetags.budget import BUDGET_DEFAULT_COLORS, make_decimal
+
+    if hasattr(settings, 'BUDGET_DEFAULT_COLORS'):
+        colors = settings.BUDGET_DEFAULT_COLORS
+    else:
+        colors = BUDGET_DEFAULT_COLORS
+
+    estimate = make_decimal(estimate)
+
+    if estimate == 0:
+        return ''
+
+    percentage = make_decimal(actual) / estimate
+
+    for color in colors:
+        if percentage >= make_decimal(color[0]):
+            return color[1]
+
+    return ''
+
+
+def benchmark_colorize(groups=500, repeat=5):
+    """
+    Times coloring a report with ``groups`` estimates: per amount with the
+    thresholds converted on every call (as before) and compiled once, for
+    the whole report with ``colorize_estimates``, and rendering a template
+    with the tag per row against one using the filter. Templates are parsed
+    up front, as a cached template loader would.
+    """
+    from decimal import Decimal
+    from django.template import Context, Template
+    from budget.templatetags.budget import colorize_estimates, get_color_table
+    estimates_and_transactions = []
+
+    for index in range(groups):
+        estimates_and_transactions.append({
+            'estimate': BudgetEstimate(amount=Decimal('100.00')),
+            'transactions': [],
+            'actual_amount': Decimal(index % 150),
+        })
+
+    def color_each(color):
+        return lambda: [color(eat_group['estimate'].amount, eat_group['actual_amount']) for eat_group in estimates_and_transactions]
+
+    results = {
+        'per amount: uncompiled thresholds': measure(color_each(uncompiled_color), repeat),
+        'per amount: compiled thresholds': measure(color_each(get_color_table().color), repeat),
+        'whole report: colorize_estimates': measure(lambda: colorize_estimates(estimates_and_transactions), repeat),
+    }
+
+    for label, source in COLORIZE_TEMPLATES:
+        compiled = Template(source)
+        results[label] = measure(lambda: compiled.render(Context({'estimates_and_transactions': estimates_and_transactions})), repeat)
+
+    return results
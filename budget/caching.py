@@ -0,0 +1,368 @@
+"""
+A versioned cache for the budget reports.
+
+Rather than deleting cached reports when the data changes, every piece of
+cached data is keyed on version counters that are bumped whenever something
+it depends on is saved or soft-deleted:
+
+    ``month:<YYYY-MM>``
+        any transaction dated in that month
+    ``budget:<id>``
+        the budget itself or any of its estimates
+    ``budgets``
+        any budget (used by the budget-for-date index)
+    ``categories``
+        any category
+    ``category_rules``
+        any categorization rule (used by the compiled rule matcher)
+    ``transactions``
+        any transaction at all (used for the "latest" lists)
+
+With ``BUDGET_MULTI_TENANT`` enabled, the scopes which span a whole ledger
+are also kept per owner (``owner:<id>:month:<YYYY-MM>`` and so on). Changes
+bump both the owner's scope and the plain one, and reads use the scope of
+the ledger they're for, so one owner's changes never invalidate another's
+cached reports.
+
+Reports are cached a month at a time, so a year summary only recomputes the
+months that were touched since it was last cached. Only plain ``get``,
+``set``, ``get_many`` and ``incr`` are used, so any of Django's cache backends
+(including local-memory and file-based) will do.
+
+Caching is off unless ``BUDGET_CACHE_REPORTS`` is set to ``True``.
+"""
+import datetime
+import threading
+import time
+from decimal import Decimal
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.hashcompat import md5_constructor
+from budget import tenancy
+
+
+def caching_enabled():
+    return getattr(settings, 'BUDGET_CACHE_REPORTS', False)
+
+
+def cache_timeout():
+    return getattr(settings, 'BUDGET_CACHE_TIMEOUT', 60 * 60 * 24 * 30)
+
+
+def version_key(scope):
+    return 'budget:version:%s' % scope
+
+
+def month_scope(date):
+    return 'month:%04d-%02d' % (date.year, date.month)
+
+
+def new_version():
+    # Versions start from the current time so that a counter which falls out
+    # of the cache never comes back with a value that was already used.
+    return int(time.time() * 1000000)
+
+
+def get_versions(scopes):
+    """
+    Returns a dictionary of the current version for each scope, initializing
+    any that are missing.
+    """
+    keys = [version_key(scope) for scope in scopes]
+    found = cache.get_many(keys)
+    versions = {}
+
+    for scope, key in zip(scopes, keys):
+        if key not in found:
+            found[key] = new_version()
+            cache.set(key, found[key], cache_timeout())
+
+        versions[scope] = found[key]
+
+    return versions
+
+
+def bump(*scopes):
+    """
+    Invalidates everything cached against the given scopes.
+    """
+    for scope in scopes:
+        key = version_key(scope)
+
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, new_version(), cache_timeout())
+
+
+def scoped(scope, owner_id):
+    """
+    The version of ``scope`` for the ledger of ``owner_id``.
+    """
+    if owner_id is None or not tenancy.tenancy_enabled():
+        return scope
+
+    return 'owner:%s:%s' % (owner_id, scope)
+
+
+def current_scope(scope):
+    """
+    The version of ``scope`` for the ledger the current thread is scoped to.
+    """
+    return scoped(scope, tenancy.get_current_owner_id())
+
+
+def bump_for(owner_ids, *scopes):
+    """
+    Bumps the scopes, along with their versions for each of the owners.
+    """
+    owner_scopes = []
+
+    for owner_id in owner_ids:
+        for scope in scopes:
+            if scoped(scope, owner_id) != scope:
+                owner_scopes.append(scoped(scope, owner_id))
+
+    bump(*(list(scopes) + owner_scopes))
+
+
+class ProcessCache(object):
+    """
+    Keeps a value per ledger in this process (the budget index, the compiled
+    rule matcher or the category choices), built by ``load`` and checked
+    against the shared version of ``scope`` on every lookup.
+
+    Only the shared versions tell one process about another's changes, so
+    nothing is kept unless ``BUDGET_CACHE_REPORTS`` is enabled; every lookup
+    then simply loads the value again. Saves and deletes in this process
+    throw the changed ledger's values away through ``invalidate``.
+    """
+    def __init__(self, scope, load):
+        self.scope = scope
+        self.load = load
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def invalidate(self, sender=None, instance=None, **kwargs):
+        self.lock.acquire()
+
+        try:
+            if instance is None or not tenancy.tenancy_enabled():
+                self.entries = {}
+            else:
+                stale = ('all', 'owner:%s' % instance.owner_id)
+                self.entries = dict([(key, entry) for key, entry in self.entries.items() if key[0] not in stale])
+        finally:
+            self.lock.release()
+
+    def keeps_values(self):
+        """
+        Whether values are kept in this process, rather than loaded again on
+        every lookup.
+        """
+        return caching_enabled()
+
+    def get(self, *args):
+        """
+        Returns ``load(*args)`` for the current ledger, from this process
+        while it's still current.
+        """
+        if not self.keeps_values():
+            return self.load(*args)
+
+        scope = current_scope(self.scope)
+        version = get_versions([scope])[scope]
+        key = (tenancy.scope_key(),) + args
+        entry = self.entries.get(key)
+
+        if entry is None or entry[0] != version:
+            entry = (version, self.load(*args))
+            self.lock.acquire()
+
+            try:
+                self.entries[key] = entry
+            finally:
+                self.lock.release()
+
+        return entry[1]
+
+
+def make_key(name, *parts):
+    return 'budget:%s:%s' % (name, md5_constructor(':'.join([str(part) for part in parts])).hexdigest())
+
+
+def month_ranges(start_date, end_date):
+    """
+    Splits a range covering whole months into ``(start_date, end_date)``
+    tuples, one per month.
+    """
+    ranges = []
+    month_start = datetime.date(start_date.year, start_date.month, 1)
+
+    while month_start <= end_date:
+        if month_start.month == 12:
+            next_month = datetime.date(month_start.year + 1, 1, 1)
+        else:
+            next_month = datetime.date(month_start.year, month_start.month + 1, 1)
+
+        ranges.append((month_start, next_month - datetime.timedelta(days=1)))
+        month_start = next_month
+
+    return ranges
+
+
+def estimates_and_transactions(budget, start_date, end_date):
+    """
+    A caching version of ``Budget.estimates_and_transactions``.
+
+    Ranges that don't cover whole months are passed straight through.
+    """
+    from budget.models import covers_whole_months
+
+    if not caching_enabled() or not covers_whole_months(start_date, end_date):
+        return budget.estimates_and_transactions(start_date, end_date)
+
+    months = month_ranges(start_date, end_date)
+    budget_scope = 'budget:%s' % budget.pk
+    categories_scope = scoped('categories', budget.owner_id)
+    month_scopes = [scoped(month_scope(month_start), budget.owner_id) for month_start, month_end in months]
+    versions = get_versions([budget_scope, categories_scope] + month_scopes)
+    keys = []
+
+    for (month_start, month_end), month_scope_name in zip(months, month_scopes):
+        keys.append(make_key('month_report', budget.pk, month_start, versions[budget_scope], versions[categories_scope], versions[month_scope_name]))
+
+    found = cache.get_many(keys)
+    pieces = []
+
+    for key, (month_start, month_end) in zip(keys, months):
+        if key in found:
+            piece = found[key]
+        else:
+            piece = budget.estimates_and_transactions(month_start, month_end)
+            cache.set(key, piece, cache_timeout())
+
+        pieces.append(piece)
+
+    return combine_reports(pieces)
+
+
+def combine_reports(pieces):
+    """
+    Merges several ``estimates_and_transactions`` results for the same budget
+    (and so the same estimates, in the same order) into one.
+    """
+    combined = []
+    actual_total = Decimal('0.0')
+
+    for estimates_and_transactions, piece_total in pieces:
+        actual_total += piece_total
+
+        for index, eat_group in enumerate(estimates_and_transactions):
+            if index >= len(combined):
+                combined.append({
+                    'estimate': eat_group['estimate'],
+                    'transactions': [],
+                    'actual_amount': Decimal('0.0'),
+                })
+
+            combined[index]['transactions'].extend(eat_group['transactions'])
+            combined[index]['actual_amount'] += eat_group['actual_amount']
+
+    return (combined, actual_total)
+
+
+def actual_total(budget, start_date, end_date):
+    """
+    A caching version of ``Budget.actual_total``.
+    """
+    if not caching_enabled():
+        return budget.actual_total(start_date, end_date)
+
+    return estimates_and_transactions(budget, start_date, end_date)[1]
+
+
+def monthly_estimated_total(budget):
+    """
+    A caching version of ``Budget.monthly_estimated_total``.
+    """
+    if not caching_enabled():
+        return budget.monthly_estimated_total()
+
+    budget_scope = 'budget:%s' % budget.pk
+    key = make_key('monthly_estimated_total', budget.pk, get_versions([budget_scope])[budget_scope])
+    total = cache.get(key)
+
+    if total is None:
+        total = budget.monthly_estimated_total()
+        cache.set(key, total, cache_timeout())
+
+    return total
+
+
+def get_latest(manager, limit=10):
+    """
+    A caching version of ``TransactionManager.get_latest``.
+    """
+    if not caching_enabled():
+        return manager.get_latest(limit)
+
+    scope = current_scope('transactions')
+    key = make_key('latest', manager.model._meta.db_table, manager.__class__.__name__, limit, tenancy.scope_key(), get_versions([scope])[scope])
+    latest = cache.get(key)
+
+    if latest is None:
+        latest = list(manager.get_latest(limit))
+        cache.set(key, latest, cache_timeout())
+
+    return latest
+
+
+def category_owners(category_ids):
+    """
+    The owners of the given categories, when there's more than one ledger.
+    """
+    from budget.categories.models import Category
+
+    if not tenancy.tenancy_enabled() or not caching_enabled():
+        return []
+
+    return list(set(Category.objects.filter(pk__in=list(category_ids)).values_list('owner', flat=True)))
+
+
+def transaction_changed(sender, instance, previous, **kwargs):
+    scopes = ['transactions', month_scope(instance.as_row()['date'])]
+
+    if previous is not None:
+        scopes.append(month_scope(previous['date']))
+
+    bump_for([instance.owner_id], *scopes)
+
+
+def transactions_bulk_changed(sender, deltas, **kwargs):
+    scopes = set(['transactions'])
+    category_ids = set()
+
+    for category_id, month, transaction_type in deltas.keys():
+        scopes.add(month_scope(month))
+        category_ids.add(category_id)
+
+    bump_for(category_owners(category_ids), *scopes)
+
+
+def budget_changed(sender, instance, **kwargs):
+    bump('budget:%s' % instance.pk)
+    bump_for([instance.owner_id], 'budgets')
+
+
+def estimate_changed(sender, instance, **kwargs):
+    bump('budget:%s' % instance.budget_id)
+
+
+def category_changed(sender, instance, **kwargs):
+    bump_for([instance.owner_id], 'categories')
+
+
+def category_rules_changed(sender, instance, **kwargs):
+    if caching_enabled():
+        bump_for([instance.owner_id], 'category_rules')
@@ -1,8 +1,10 @@
 from django.contrib import admin
-from budget.categories.models import Category
+from budget.categories.forms import SlugAdminForm
+from budget.categories.models import Category, CategoryRule
 
 
 class CategoryAdmin(admin.ModelAdmin):
+    form = SlugAdminForm
     fieldsets = (
         (None, {
             'fields': ('name', 'slug'),
@@ -20,4 +22,20 @@ class CategoryAdmin(admin.ModelAdmin):
     search_fields = ('name',)
 
 
+class CategoryRuleAdmin(admin.ModelAdmin):
+    fieldsets = (
+        (None, {
+            'fields': ('category', 'match_type', 'pattern', 'min_amount', 'max_amount', 'transaction_type', 'priority'),
+        }),
+        ('Metadata', {
+            'classes': ('collapse',),
+            'fields': ('created', 'updated', 'is_deleted')
+        })
+    )
+    list_display = ('pattern', 'match_type', 'category', 'priority', 'is_deleted')
+    list_filter = ('match_type', 'is_deleted')
+    search_fields = ('pattern',)
+
+
 admin.site.register(Category, CategoryAdmin)
+admin.site.register(CategoryRule, CategoryRuleAdmin)
@@ -0,0 +1,136 @@
+"""
+Cached category choices for the forms.
+
+A ``ModelChoiceField`` over categories queries the whole table every time
+the field is rendered and again to look up the submitted value. With
+thousands of categories that dominates the add and edit pages, so
+``CategoryChoiceField`` reads both its choices and its lookups from a
+per-process cache of the active categories instead.
+
+The cache is only kept with ``BUDGET_CACHE_REPORTS`` enabled, per process
+and ledger (see ``caching.ProcessCache``), and is checked against the shared
+``categories`` version on every lookup. Without it the categories are read
+once per lookup, just like a plain ``ModelChoiceField``. A submitted value
+that isn't cached is looked up in the database before it's turned down, so a
+category added by another process is never rejected.
+"""
+from django import forms
+from django.db.models.signals import post_save, post_delete
+from django.utils.encoding import smart_unicode
+from budget import caching
+from budget.categories.models import Category
+
+
+class CategoryChoices(object):
+    """
+    The active categories of a ledger, ordered by name, with lookups by
+    primary key and slug.
+    """
+    def __init__(self, categories):
+        self.categories = categories
+        self.by_pk = dict([(category.pk, category) for category in categories])
+        self.by_slug = dict([(category.slug, category) for category in categories])
+        self.choice_lists = {}
+
+    def choices(self, to_field_name=None):
+        """
+        The ``(value, label)`` pairs for a select, keyed on ``to_field_name``
+        (the primary key by default).
+        """
+        if to_field_name not in self.choice_lists:
+            if to_field_name == 'slug':
+                self.choice_lists[to_field_name] = [(category.slug, smart_unicode(category)) for category in self.categories]
+            else:
+                self.choice_lists[to_field_name] = [(category.pk, smart_unicode(category)) for category in self.categories]
+
+        return self.choice_lists[to_field_name]
+
+    def get(self, value, to_field_name=None):
+        """
+        The category with the given primary key (or slug), or ``None``.
+        """
+        if to_field_name == 'slug':
+            return self.by_slug.get(value)
+
+        try:
+            return self.by_pk.get(int(value))
+        except (TypeError, ValueError):
+            return None
+
+
+def load_choices():
+    return CategoryChoices(list(Category.active.order_by('name', 'id')))
+
+
+choices_cache = caching.ProcessCache('categories', load_choices)
+
+
+def get_category_choices():
+    """
+    The cached choices of the current ledger's active categories.
+    """
+    return choices_cache.get()
+
+
+class CategoryChoiceIterator(object):
+    def __init__(self, field):
+        self.field = field
+
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield (u"", self.field.empty_label)
+
+        for choice in get_category_choices().choices(self.field.to_field_name):
+            yield choice
+
+    def __len__(self):
+        return len(get_category_choices().categories) + (self.field.empty_label is not None)
+
+
+class CategoryChoiceField(forms.ModelChoiceField):
+    """
+    A ``ModelChoiceField`` over the active categories, which renders and
+    looks up the submitted value from the cache instead of the database.
+    """
+    def __init__(self, queryset=None, *args, **kwargs):
+        # The queryset is only kept for compatibility; the choices always
+        # come from ``Category.active``.
+        if queryset is None:
+            queryset = Category.active.all()
+
+        super(CategoryChoiceField, self).__init__(queryset, *args, **kwargs)
+
+    def _get_choices(self):
+        if hasattr(self, '_choices'):
+            return self._choices
+
+        return CategoryChoiceIterator(self)
+
+    choices = property(_get_choices, forms.ChoiceField._set_choices)
+
+    def clean(self, value):
+        forms.Field.clean(self, value)
+
+        if value in forms.fields.EMPTY_VALUES:
+            return None
+
+        if caching.caching_enabled():
+            category = get_category_choices().get(value, self.to_field_name)
+        else:
+            category = None
+
+        if category is None:
+            # Nothing is cached, or the cache predates the category, so ask
+            # the database (refreshing the cache if it's there after all).
+            try:
+                category = Category.active.get(**{self.to_field_name or 'pk': value})
+            except (ValueError, Category.DoesNotExist):
+                raise forms.ValidationError(self.error_messages['invalid_choice'])
+
+            choices_cache.invalidate(instance=category)
+
+        return category
+
+
+post_save.connect(choices_cache.invalidate, sender=Category, dispatch_uid='budget.categories.choices.invalidate')
+post_delete.connect(choices_cache.invalidate, sender=Category, dispatch_uid='budget.categories.choices.invalidate_deleted')
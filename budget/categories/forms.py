@@ -1,13 +1,36 @@
 from django import forms
 from django.template.defaultfilters import slugify
+from budget import tenancy
 from budget.categories.models import Category
 
 
+class SlugAdminForm(forms.ModelForm):
+    """
+    Refuses a slug another row already uses (see ``tenancy.slug_taken``) in
+    the admin.
+    """
+    def clean_slug(self):
+        slug = self.cleaned_data['slug']
+        
+        if tenancy.slug_taken(self.instance, slug):
+            raise forms.ValidationError('This slug is already in use.')
+        
+        return slug
+
+
 class CategoryForm(forms.ModelForm):
     class Meta:
         model = Category
         fields = ('name',)
     
+    def clean_name(self):
+        name = self.cleaned_data['name']
+        
+        if not self.instance.slug and tenancy.slug_taken(self.instance, slugify(name)):
+            raise forms.ValidationError('A category with this name already exists.')
+        
+        return name
+    
     def save(self):
         if not self.instance.slug:
             self.instance.slug = slugify(self.cleaned_data['name'])
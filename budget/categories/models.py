@@ -1,13 +1,21 @@
 import datetime
 from decimal import Decimal
+from django.contrib.auth.models import User
 from django.db import models
+from django.db.models.signals import post_save, post_delete
 from django.utils.translation import ugettext_lazy as _
+from budget import caching, tenancy
 
 
 class StandardMetadata(models.Model):
     """
     A basic (abstract) model for metadata.
+    
+    ``owner`` is only used with ``BUDGET_MULTI_TENANT`` enabled (see
+    ``budget.tenancy``); new rows are given to the owner of the current
+    request.
     """
+    owner = models.ForeignKey(User, related_name='budget_%(class)s_set', verbose_name=_('Owner'), blank=True, null=True, editable=False)
     created = models.DateTimeField(_('Created'), default=datetime.datetime.now)
     updated = models.DateTimeField(_('Updated'), default=datetime.datetime.now)
     is_deleted = models.BooleanField(_('Is deleted'), default=False, db_index=True)
@@ -16,6 +24,9 @@ class StandardMetadata(models.Model):
         abstract = True
     
     def save(self, *args, **kwargs):
+        if self.owner_id is None:
+            self.owner_id = tenancy.get_current_owner_id()
+        
         self.updated = datetime.datetime.now()
         super(StandardMetadata, self).save(*args, **kwargs)
     
@@ -25,8 +36,11 @@ class StandardMetadata(models.Model):
 
 
 class ActiveManager(models.Manager):
+    """
+    The rows that aren't deleted, in the current owner's ledger.
+    """
     def get_query_set(self):
-        return super(ActiveManager, self).get_query_set().filter(is_deleted=False)
+        return tenancy.scope(super(ActiveManager, self).get_query_set().filter(is_deleted=False))
 
 
 class Category(StandardMetadata):
@@ -39,7 +53,7 @@ class Category(StandardMetadata):
     on the Transaction object explains this.
     """
     name = models.CharField(_('Name'), max_length=128)
-    slug = models.SlugField(_('Slug'), unique=True)
+    slug = models.SlugField(_('Slug'))
     
     objects = models.Manager()
     active = ActiveManager()
@@ -47,7 +61,47 @@ class Category(StandardMetadata):
     class Meta:
         verbose_name = _('Category')
         verbose_name_plural = _('Categories')
+        unique_together = (('owner', 'slug'),)
     
     def __unicode__(self):
         return self.name
+
+
+MATCH_TYPES = (
+    ('contains', _('Notes contain')),
+    ('prefix', _('Notes start with')),
+    ('regex', _('Notes match the regular expression')),
+)
+
+
+class CategoryRule(StandardMetadata):
+    """
+    Picks a category for transactions by their notes and amount.
+
+    A blank ``pattern`` matches any notes, so a rule can also categorize on
+    the amount (and transaction type) alone. When several rules match, the
+    one with the lowest ``priority`` wins. Matching ignores case.
+    """
+    category = models.ForeignKey(Category, related_name='rules', verbose_name=_('Category'))
+    match_type = models.CharField(_('Match type'), max_length=16, choices=MATCH_TYPES, default='contains')
+    pattern = models.CharField(_('Pattern'), max_length=255, blank=True)
+    min_amount = models.DecimalField(_('Minimum amount'), max_digits=11, decimal_places=2, blank=True, null=True)
+    max_amount = models.DecimalField(_('Maximum amount'), max_digits=11, decimal_places=2, blank=True, null=True)
+    transaction_type = models.CharField(_('Transaction type'), max_length=32, blank=True, help_text=_('Leave blank to match any type.'))
+    priority = models.IntegerField(_('Priority'), default=0)
     
+    objects = models.Manager()
+    active = ActiveManager()
+    
+    class Meta:
+        verbose_name = _('Category rule')
+        verbose_name_plural = _('Category rules')
+        ordering = ('priority', 'id')
+    
+    def __unicode__(self):
+        return u"%s '%s' - %s" % (self.get_match_type_display(), self.pattern, self.category)
+
+
+post_save.connect(caching.category_rules_changed, sender=Category, dispatch_uid='budget.caching.category_rules_changed.category')
+post_save.connect(caching.category_rules_changed, sender=CategoryRule, dispatch_uid='budget.caching.category_rules_changed.rule')
+post_delete.connect(caching.category_rules_changed, sender=CategoryRule, dispatch_uid='budget.caching.category_rules_changed.rule_deleted')
@@ -0,0 +1,256 @@
+"""
+The engine behind ``CategoryRule``.
+
+Rather than trying every rule against every transaction, all of the rules
+are compiled into a single ``RuleMatcher``:
+
+    * ``contains`` and ``prefix`` patterns go into one Aho-Corasick automaton,
+      which finds every one of them in a single pass over the notes,
+    * ``regex`` patterns are joined into one alternation, used to rule out
+      notes none of them match before any are tried individually (unless
+      one of them refers back to its own groups, which joining renumbers, or
+      sets inline flags, which would apply to all of them),
+    * rules without a pattern are only checked on their amount and type.
+
+Categorizing is then linear in the length of the notes rather than
+proportional to the number of rules. With ``BUDGET_CACHE_REPORTS`` enabled
+the active rules are compiled once per process and recompiled whenever a
+rule or category is saved, in this process or any other.
+"""
+import re
+from collections import deque
+from django.db.models.signals import post_save, post_delete
+from budget import caching
+from budget.categories.models import Category, CategoryRule
+
+
+# Backreferences (``\1``, ``(?P=name)`` and ``(?(1)...)``) count groups from
+# the start of their own pattern. This may also catch an escaped backslash
+# followed by a digit, which only costs the prefilter.
+BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+# Inline flags (``(?x)``, ``(?s)``...) apply to the whole expression they're
+# in, so they'd spill over into every other pattern joined with them.
+INLINE_FLAGS = re.compile(r'\(\?[iLmsux]+\)')
+
+
+class Automaton(object):
+    """
+    An Aho-Corasick automaton, matching many words in one pass over a text.
+    """
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+
+    def add(self, word, value):
+        state = 0
+
+        for char in word:
+            next_state = self.goto[state].get(char)
+
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[state][char] = next_state
+
+            state = next_state
+
+        self.output[state].append(value)
+
+    def build(self):
+        """
+        Works out the failure links. Call once every word has been added.
+        """
+        queue = deque(self.goto[0].values())
+
+        while queue:
+            state = queue.popleft()
+
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+
+                self.fail[next_state] = self.goto[fail].get(char, 0)
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+    def search(self, text):
+        """
+        Yields ``(end, value)`` for every occurrence of every word, where
+        ``end`` is the index of its last character.
+        """
+        state = 0
+
+        for index in range(len(text)):
+            char = text[index]
+
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+
+            state = self.goto[state].get(char, 0)
+
+            for value in self.output[state]:
+                yield (index, value)
+
+
+class RuleMatcher(object):
+    """
+    Compiles a list of rules (in priority order) for matching.
+
+    The rules only need ``match_type``, ``pattern``, ``min_amount``,
+    ``max_amount``, ``transaction_type`` and ``category`` attributes, so
+    unsaved ``CategoryRule`` objects work too. Invalid regular expressions
+    are skipped.
+    """
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.automaton = Automaton()
+        self.expressions = []
+        self.unconditional = []
+
+        for index in range(len(self.rules)):
+            rule = self.rules[index]
+
+            if not rule.pattern:
+                self.unconditional.append(index)
+            elif rule.match_type == 'regex':
+                try:
+                    self.expressions.append((index, re.compile(rule.pattern, re.I | re.U)))
+                except re.error:
+                    pass
+            else:
+                pattern = rule.pattern.lower()
+                self.automaton.add(pattern, (index, len(pattern), rule.match_type == 'prefix'))
+
+        self.automaton.build()
+        self.combined = None
+
+        # Joining the patterns renumbers their groups and spreads any inline
+        # flags to all of them, so the prefilter is left out when any of them
+        # has a named group, refers back to one or sets its own flags.
+        combinable = [expression for index, expression in self.expressions if self.combinable(expression)]
+
+        if self.expressions and len(combinable) == len(self.expressions):
+            try:
+                self.combined = re.compile('|'.join(['(?:%s)' % expression.pattern for expression in combinable]), re.I | re.U)
+            except re.error:
+                # Python only supports 100 groups in one expression.
+                pass
+
+    def combinable(self, expression):
+        """
+        Whether a compiled pattern means the same once joined with others.
+        """
+        if expression.groupindex or expression.flags != re.I | re.U:
+            return False
+
+        return not BACKREFERENCE.search(expression.pattern) and not INLINE_FLAGS.search(expression.pattern)
+
+    def accepts(self, index, amount, transaction_type):
+        rule = self.rules[index]
+
+        if rule.transaction_type and transaction_type and rule.transaction_type != transaction_type:
+            return False
+
+        if amount is not None:
+            if rule.min_amount is not None and amount < rule.min_amount:
+                return False
+
+            if rule.max_amount is not None and amount > rule.max_amount:
+                return False
+
+        return True
+
+    def match(self, notes, amount=None, transaction_type=None):
+        """
+        Returns the first rule (in priority order) matching the notes, amount
+        and type, or ``None``.
+        """
+        notes = notes or u''
+        best = None
+
+        for end, (index, length, prefix_only) in self.automaton.search(notes.lower()):
+            if best is not None and index >= best:
+                continue
+
+            if prefix_only and end + 1 != length:
+                continue
+
+            if self.accepts(index, amount, transaction_type):
+                best = index
+
+        if self.expressions and (best is None or self.expressions[0][0] < best):
+            if self.combined is None or self.combined.search(notes):
+                for index, expression in self.expressions:
+                    if best is not None and index >= best:
+                        break
+
+                    if expression.search(notes) and self.accepts(index, amount, transaction_type):
+                        best = index
+                        break
+
+        for index in self.unconditional:
+            if best is not None and index >= best:
+                break
+
+            if self.accepts(index, amount, transaction_type):
+                best = index
+                break
+
+        if best is None:
+            return None
+
+        return self.rules[best]
+
+    def categorize(self, notes, amount=None, transaction_type=None):
+        """
+        Returns the category of the first matching rule, or ``None``.
+        """
+        rule = self.match(notes, amount, transaction_type)
+
+        if rule is None:
+            return None
+
+        return rule.category
+
+    def categorize_many(self, rows):
+        """
+        Takes an iterable of ``(notes, amount, transaction_type)`` tuples and
+        yields a category (or ``None``) for each.
+        """
+        for notes, amount, transaction_type in rows:
+            yield self.categorize(notes, amount, transaction_type)
+
+
+def load_matcher():
+    rules = CategoryRule.active.filter(category__is_deleted=False).select_related('category').order_by('priority', 'id')
+    return RuleMatcher(rules)
+
+
+# With ``BUDGET_CACHE_REPORTS`` enabled the matcher is kept per process and
+# ledger, checked against the shared ``category_rules`` version.
+matcher_cache = caching.ProcessCache('category_rules', load_matcher)
+
+
+def get_matcher():
+    """
+    The compiled matcher for every active rule.
+    """
+    return matcher_cache.get()
+
+
+def categorize(notes, amount=None, transaction_type=None):
+    """
+    Returns the category the active rules pick for a transaction, or ``None``.
+    """
+    return get_matcher().categorize(notes, amount, transaction_type)
+
+
+post_save.connect(matcher_cache.invalidate, sender=Category, dispatch_uid='budget.categories.rules.invalidate.category')
+post_save.connect(matcher_cache.invalidate, sender=CategoryRule, dispatch_uid='budget.categories.rules.invalidate.rule')
+post_delete.connect(matcher_cache.invalidate, sender=CategoryRule, dispatch_uid='budget.categories.rules.invalidate.rule_deleted')
@@ -0,0 +1,5 @@
+-- Supports the JSON API's conditional GETs (budget.api.resource_state),
+-- which read the latest updated and the row count of every category, or of
+-- one owner's, from the index rather than the table.
+CREATE INDEX categories_category_updated ON categories_category (updated);
+CREATE INDEX categories_category_owner_updated ON categories_category (owner_id, updated);
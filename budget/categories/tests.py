@@ -63,4 +63,145 @@
 200
 >>> r.context[-1]['categories']
 []
+
+
+# Rules
+
+>>> from decimal import Decimal
+>>> from budget.categories.models import Category, CategoryRule
+>>> from budget.categories.rules import RuleMatcher, Automaton, categorize
+>>> automaton = Automaton()
+>>> for word in ('he', 'she', 'his', 'hers'):
+...     automaton.add(word, word)
+>>> automaton.build()
+>>> list(automaton.search('ushers'))
+[(3, 'she'), (3, 'he'), (5, 'hers')]
+
+>>> food = Category.objects.create(name='Food', slug='food')
+>>> fuel = Category.objects.create(name='Fuel', slug='fuel')
+>>> salary = Category.objects.create(name='Salary', slug='salary')
+>>> matcher = RuleMatcher([
+...     CategoryRule(pattern='payroll', category=salary, transaction_type='income'),
+...     CategoryRule(pattern='shell', match_type='prefix', category=fuel),
+...     CategoryRule(pattern=r'^(tesco|aldi)\\b', match_type='regex', category=food),
+...     CategoryRule(pattern='shell', category=food, max_amount=Decimal('10')),
+...     CategoryRule(pattern='(', match_type='regex', category=food),
+...     CategoryRule(pattern='', category=fuel, min_amount=Decimal('1000')),
+... ])
+>>> [getattr(matcher.categorize(notes, amount, transaction_type), 'slug', None) for notes, amount, transaction_type in (
+...     ('ACME PAYROLL', Decimal('2000'), 'income'),
+...     ('ACME PAYROLL', Decimal('20'), 'expense'),
+...     ('Shell Garage', Decimal('40'), 'expense'),
+...     ('Cafe at the shell garage', Decimal('4'), 'expense'),
+...     ('Cafe at the shell garage', Decimal('40'), 'expense'),
+...     ('ALDI Store 42', Decimal('40'), 'expense'),
+...     ('Big telly', Decimal('1500'), 'expense'),
+... )]
+['salary', None, 'fuel', 'food', None, 'food', 'fuel']
+
+Joining the regular expressions would renumber their groups, so the
+prefilter is skipped when any of them refers back to one.
+
+>>> matcher = RuleMatcher([
+...     CategoryRule(pattern='x(y)', match_type='regex', category=fuel),
+...     CategoryRule(pattern=r'(\\w)\\1\\1', match_type='regex', category=food),
+... ])
+>>> matcher.combined is None, matcher.categorize('zzz store').slug
+(True, 'food')
+>>> RuleMatcher([CategoryRule(pattern='x(y)', match_type='regex', category=fuel)]).combined is None
+False
+
+Inline flags would apply to every pattern joined with them, so the prefilter
+is skipped when any of them sets its own.
+
+>>> matcher = RuleMatcher([
+...     CategoryRule(pattern=r'(?x) gas \\s station', match_type='regex', category=fuel),
+...     CategoryRule(pattern='coffee shop', match_type='regex', category=food),
+... ])
+>>> matcher.combined is None, matcher.categorize('Coffee shop downtown').slug, matcher.categorize('Gas station').slug
+(True, 'food', 'fuel')
+
+The active rules are compiled again whenever they change. With the shared
+cache they're kept per process and checked against it, which picks up
+changes made by other processes too.
+
+>>> rule = CategoryRule.objects.create(pattern='bakery', category=food)
+>>> categorize('Corner Bakery').slug
+u'food'
+>>> rule.category = fuel
+>>> rule.save()
+>>> categorize('Corner Bakery').slug
+u'fuel'
+>>> from django.conf import settings
+>>> from django.core.cache import get_cache
+>>> from budget import caching
+>>> from budget.categories.rules import get_matcher
+>>> old_cache, old_cache_reports = caching.cache, getattr(settings, 'BUDGET_CACHE_REPORTS', False)
+>>> settings.BUDGET_CACHE_REPORTS, caching.cache = True, get_cache('locmem://')
+>>> get_matcher() is get_matcher()
+True
+>>> updated = CategoryRule.objects.filter(pk=rule.pk).update(category=food)
+>>> categorize('Corner Bakery').slug
+u'fuel'
+>>> caching.bump('category_rules')
+>>> categorize('Corner Bakery').slug
+u'food'
+>>> rule.delete()
+>>> categorize('Corner Bakery') is None
+True
+>>> caching.cache, settings.BUDGET_CACHE_REPORTS = old_cache, old_cache_reports
+>>> CategoryRule.objects.all().delete()
+>>> Category.objects.filter(pk__in=[food.pk, fuel.pk, salary.pk]).delete()
+
+
+# Category choices
+
+Category fields render and look up the active categories. With the shared
+cache they're kept per process, and refreshed when a category is saved or
+deleted here or the shared version moves.
+
+>>> from budget.categories.choices import CategoryChoiceField
+>>> from budget.instrumentation import collect
+>>> zinc = Category.objects.create(name='Zinc', slug='zinc')
+>>> acorn = Category.objects.create(name='Acorn', slug='acorn')
+>>> field = CategoryChoiceField(to_field_name='slug')
+>>> list(field.choices)
+[(u'', u'---------'), (u'acorn', u'Acorn'), (u'zinc', u'Zinc')]
+>>> category, collector = collect(field.clean, 'zinc')
+>>> category == zinc, collector.queries
+(True, 1)
+>>> settings.BUDGET_CACHE_REPORTS, caching.cache = True, get_cache('locmem://')
+>>> choices = list(field.choices)
+>>> category, collector = collect(field.clean, 'zinc')
+>>> category == zinc, collector.queries
+(True, 0)
+>>> field.clean('nope')
+Traceback (most recent call last):
+    ...
+ValidationError: [u'Select a valid choice. That choice is not one of the available choices.']
+>>> CategoryChoiceField().clean(str(acorn.pk)) == acorn
+True
+>>> zinc.delete()
+>>> [label for value, label in field.choices]
+[u'---------', u'Acorn']
+
+A category the cache doesn't know about yet (added by another process, say)
+is still accepted, and refreshes the cache.
+
+>>> updated = Category.objects.filter(pk=zinc.pk).update(is_deleted=False)
+>>> [label for value, label in field.choices]
+[u'---------', u'Acorn']
+>>> field.clean('zinc') == zinc
+True
+>>> [label for value, label in field.choices]
+[u'---------', u'Acorn', u'Zinc']
+>>> caching.cache, settings.BUDGET_CACHE_REPORTS = old_cache, old_cache_reports
+>>> Category.objects.filter(pk__in=[zinc.pk, acorn.pk]).delete()
+>>> list(field.choices)
+[(u'', u'---------')]
+
+
+# Cleanup
+
+>>> Category.objects.all().delete()
 """
@@ -1,13 +1,14 @@
-from django.conf import settings
 from django.core.urlresolvers import reverse
-from django.core.paginator import Paginator, InvalidPage
 from django.http import HttpResponseRedirect
 from django.shortcuts import render_to_response, get_object_or_404
 from django.template import RequestContext
+from budget.instrumentation import instrument
 from budget.categories.models import Category
+from budget.pagination import paginate
 from budget.categories.forms import CategoryForm
 
 
+@instrument
 def category_list(request, model_class=Category, template_name='budget/categories/list.html'):
     """
     A list of category objects.
@@ -17,17 +18,12 @@ def category_list(request, model_class=Category, template_name='budget/categorie
         categories
             paginated list of category objects
         paginator
-            A Django Paginator instance
+            A Django Paginator (or KeysetPaginator) instance
         page
             current page of category objects
     """
     categories_list = model_class.active.all()
-    try:
-        paginator = Paginator(categories_list, getattr(settings, 'BUDGET_LIST_PER_PAGE', 50))
-        page = paginator.page(request.GET.get('page', 1))
-        categories = page.object_list
-    except InvalidPage:
-        raise Http404('Invalid page requested.')
+    categories, paginator, page = paginate(request, categories_list, ('id',))
     return render_to_response(template_name, {
         'categories': categories,
         'paginator': paginator,
@@ -35,6 +31,7 @@ def category_list(request, model_class=Category, template_name='budget/categorie
     }, context_instance=RequestContext(request))
 
 
+@instrument
 def category_add(request, form_class=CategoryForm, template_name='budget/categories/add.html'):
     """
     Create a new category object.
@@ -57,6 +54,7 @@ def category_add(request, form_class=CategoryForm, template_name='budget/categor
     }, context_instance=RequestContext(request))
 
 
+@instrument
 def category_edit(request, slug, model_class=Category, form_class=CategoryForm, template_name='budget/categories/edit.html'):
     """
     Edit a category object.
@@ -83,6 +81,7 @@ def category_edit(request, slug, model_class=Category, form_class=CategoryForm,
     }, context_instance=RequestContext(request))
 
 
+@instrument
 def category_delete(request, slug, model_class=Category, template_name='budget/categories/delete.html'):
     """
     Delete a category object.
@@ -0,0 +1,53 @@
+"""
+CSV and JSON lines writers for the budget summaries.
+"""
+from decimal import Decimal
+from budget.models import actual_amounts_by_category
+from budget.transactions.exporters import csv_lines, iterate_in_chunks, json_lines, transaction_row
+
+
+SUMMARY_FIELDS = ('category', 'estimated_amount', 'actual_amount')
+
+
+def summary_rows(budget, start_date, end_date):
+    """
+    Yields a dictionary per active estimate of the budget with its estimated
+    and actual amounts for the date range.
+    """
+    estimates = list(budget.active_estimates())
+    totals = actual_amounts_by_category([estimate.category_id for estimate in estimates], start_date, end_date)
+
+    for estimate in estimates:
+        yield {
+            'category': estimate.category.slug,
+            'estimated_amount': str(estimate.amount),
+            'actual_amount': str(totals.get(estimate.category_id, Decimal('0.0'))),
+        }, estimate
+
+
+def summary_records(budget, start_date, end_date, chunk_size=1000):
+    """
+    Yields a record per estimate, each followed by a record for each of its
+    transactions (read in chunks). Every record has a ``record`` key of
+    either ``estimate`` or ``transaction``.
+    """
+    for row, estimate in summary_rows(budget, start_date, end_date):
+        row['record'] = 'estimate'
+        yield row
+
+        for transaction in iterate_in_chunks(estimate.actual_transactions(start_date, end_date), chunk_size):
+            row = transaction_row(transaction)
+            row['record'] = 'transaction'
+            yield row
+
+
+def export_summary(budget, start_date, end_date, format='csv'):
+    """
+    Returns a generator of lines exporting a summary as either ``csv`` (one
+    row per estimate) or ``json`` (lines, each estimate followed by its
+    transactions).
+    """
+    if format == 'json':
+        return json_lines(summary_records(budget, start_date, end_date))
+
+    return csv_lines((row for row, estimate in summary_rows(budget, start_date, end_date)), SUMMARY_FIELDS)
@@ -1,7 +1,9 @@
 import datetime
 from django import forms
 from django.template.defaultfilters import slugify
+from budget import tenancy
 from budget.models import Budget, BudgetEstimate
+from budget.categories.choices import CategoryChoiceField
 
 
 class BudgetForm(forms.ModelForm):
@@ -11,6 +13,14 @@ class BudgetForm(forms.ModelForm):
         model = Budget
         fields = ('name', 'start_date')
     
+    def clean_name(self):
+        name = self.cleaned_data['name']
+        
+        if not self.instance.slug and tenancy.slug_taken(self.instance, slugify(name)):
+            raise forms.ValidationError('A budget with this name already exists.')
+        
+        return name
+    
     def save(self):
         if not self.instance.slug:
             self.instance.slug = slugify(self.cleaned_data['name'])
@@ -18,6 +28,8 @@ class BudgetForm(forms.ModelForm):
 
 
 class BudgetEstimateForm(forms.ModelForm):
+    category = CategoryChoiceField()
+    
     class Meta:
         model = BudgetEstimate
         fields = ('category', 'amount')
@@ -0,0 +1,293 @@
+"""
+Opt-in per-request instrumentation for the budget views.
+
+Add ``budget.instrumentation.InstrumentationMiddleware`` to your
+``MIDDLEWARE_CLASSES`` and set ``BUDGET_INSTRUMENTATION = True``. Every
+request then records:
+
+    * the number of queries and the time spent in SQL,
+    * the time spent in Python (everything else),
+    * the number of model instances hydrated,
+    * the same figures broken down by each instrumented view/method.
+
+The totals are added to the response as ``X-Budget-*`` headers, logged as a
+single line to the ``budget.instrumentation`` logger and aggregated into
+in-process histograms which ``budget_stats`` (``/budget/_stats/``) serves as
+JSON.
+"""
+import logging
+import threading
+import time
+from django.conf import settings
+from django.db import connection
+from django.db.models.signals import post_init
+from django.utils.functional import wraps
+
+logger = logging.getLogger('budget.instrumentation')
+
+# Upper bounds (in milliseconds or queries) of the histogram buckets.
+TIME_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+_local = threading.local()
+
+
+def instrumentation_enabled():
+    return getattr(settings, 'BUDGET_INSTRUMENTATION', False)
+
+
+class Collector(object):
+    """
+    Accumulates the figures for a single request (or any other block of
+    code).
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.queries = 0
+        self.sql_time = 0.0
+        self.rows = 0
+        self.breakdown = {}
+
+    def snapshot(self):
+        return (time.time(), self.queries, self.sql_time, self.rows)
+
+    def record(self, name, before):
+        now, queries, sql_time, rows = self.snapshot()
+        entry = self.breakdown.setdefault(name, {'calls': 0, 'time': 0.0, 'queries': 0, 'sql_time': 0.0, 'rows': 0})
+        entry['calls'] += 1
+        entry['time'] += now - before[0]
+        entry['queries'] += queries - before[1]
+        entry['sql_time'] += sql_time - before[2]
+        entry['rows'] += rows - before[3]
+
+    def totals(self):
+        elapsed = time.time() - self.start
+        return {
+            'queries': self.queries,
+            'sql_ms': round(self.sql_time * 1000, 3),
+            'python_ms': round((elapsed - self.sql_time) * 1000, 3),
+            'total_ms': round(elapsed * 1000, 3),
+            'rows': self.rows,
+        }
+
+
+def current_collector():
+    return getattr(_local, 'collector', None)
+
+
+class InstrumentedCursor(object):
+    """
+    Times every query run through the wrapped cursor.
+    """
+    def __init__(self, cursor, collector):
+        self.cursor = cursor
+        self.collector = collector
+
+    def execute(self, sql, params=()):
+        start = time.time()
+
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            self.collector.queries += 1
+            self.collector.sql_time += time.time() - start
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            self.collector.queries += 1
+            self.collector.sql_time += time.time() - start
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+def start_collecting():
+    """
+    Starts collecting figures for the current thread and returns the
+    collector.
+    """
+    collector = Collector()
+    _local.collector = collector
+    # The connection object is thread-local, so this only affects the current
+    # thread.
+    cursor = connection.__class__.cursor
+    connection.cursor = lambda: InstrumentedCursor(cursor(connection), collector)
+    return collector
+
+
+def stop_collecting():
+    collector = current_collector()
+    _local.collector = None
+
+    if 'cursor' in connection.__dict__:
+        del connection.cursor
+
+    return collector
+
+
+def collect(func, *args, **kwargs):
+    """
+    Calls ``func`` with the given arguments while collecting, returning a
+    tuple of ``(result, collector)``. Handy for asserting query counts in
+    tests.
+    """
+    collector = start_collecting()
+
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        stop_collecting()
+
+    return (result, collector)
+
+
+def count_hydrated_rows(sender, **kwargs):
+    collector = current_collector()
+
+    if collector is not None:
+        collector.rows += 1
+
+
+post_init.connect(count_hydrated_rows, dispatch_uid='budget.instrumentation.count_hydrated_rows')
+
+
+def instrument(func, name=None):
+    """
+    Records the time, queries and rows of every call to ``func`` in the
+    current request's breakdown. Does nothing extra unless a request is
+    being instrumented.
+    """
+    if name is None:
+        name = '%s.%s' % (func.__module__, func.__name__)
+
+    def wrapper(*args, **kwargs):
+        collector = current_collector()
+
+        if collector is None:
+            return func(*args, **kwargs)
+
+        before = collector.snapshot()
+
+        try:
+            return func(*args, **kwargs)
+        finally:
+            collector.record(name, before)
+
+    return wraps(func)(wrapper)
+
+
+def instrument_method(name):
+    """
+    Like ``instrument``, for methods, where the qualified name has to be
+    given explicitly.
+    """
+    def decorator(func):
+        return instrument(func, name)
+    return decorator
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def add(self, value):
+        index = 0
+
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+
+        self.counts[index] += 1
+        self.total += value
+        self.count += 1
+
+    def as_dict(self):
+        buckets = {}
+
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            buckets[str(bound)] = count
+
+        return {'count': self.count, 'total': round(self.total, 3), 'buckets': buckets}
+
+
+class Stats(object):
+    """
+    Per-name histograms of wall time, SQL time and query counts, shared by
+    every thread of the process.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.histograms = {}
+
+    def add(self, name, totals):
+        self.lock.acquire()
+
+        try:
+            if name not in self.histograms:
+                self.histograms[name] = {
+                    'total_ms': Histogram(TIME_BUCKETS),
+                    'sql_ms': Histogram(TIME_BUCKETS),
+                    'queries': Histogram(QUERY_BUCKETS),
+                    'rows': Histogram(QUERY_BUCKETS),
+                }
+
+            for key, histogram in self.histograms[name].items():
+                histogram.add(totals[key])
+        finally:
+            self.lock.release()
+
+    def as_dict(self):
+        self.lock.acquire()
+
+        try:
+            result = {}
+
+            for name, histograms in self.histograms.items():
+                result[name] = dict([(key, histogram.as_dict()) for key, histogram in histograms.items()])
+
+            return result
+        finally:
+            self.lock.release()
+
+
+stats = Stats()
+
+
+class InstrumentationMiddleware(object):
+    def process_request(self, request):
+        if instrumentation_enabled():
+            start_collecting()
+            request._budget_view_name = None
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if current_collector() is not None:
+            request._budget_view_name = '%s.%s' % (view_func.__module__, getattr(view_func, '__name__', view_func.__class__.__name__))
+
+    def process_response(self, request, response):
+        collector = stop_collecting()
+
+        if collector is None:
+            return response
+
+        totals = collector.totals()
+        name = getattr(request, '_budget_view_name', None) or request.path
+        stats.add(name, totals)
+        response['X-Budget-Queries'] = str(totals['queries'])
+        response['X-Budget-SQL-Time'] = '%.3f' % totals['sql_ms']
+        response['X-Budget-Python-Time'] = '%.3f' % totals['python_ms']
+        response['X-Budget-Rows'] = str(totals['rows'])
+        breakdown = ' '.join(['%s=%dq/%.1fms' % (key, value['queries'], value['time'] * 1000) for key, value in sorted(collector.breakdown.items())])
+        logger.info('view=%s path=%s status=%s queries=%d sql_ms=%.3f python_ms=%.3f rows=%d %s' % (name, request.path, response.status_code, totals['queries'], totals['sql_ms'], totals['python_ms'], totals['rows'], breakdown))
+        return response
@@ -0,0 +1,79 @@
+"""
+The worker loop behind the ``budget_worker`` command.
+
+Jobs live in the ``ReportJob`` table, so no broker is needed: workers poll
+the table and claim jobs with a conditional ``UPDATE``, which means any
+number of worker threads (and processes) can run side by side.
+"""
+import threading
+import time
+from django.db import connection
+from budget.models import ReportJob
+
+
+def work(once=False, interval=1.0, counter=None):
+    """
+    Claims and runs jobs until there are none left (if ``once``) or forever,
+    sleeping ``interval`` seconds whenever the queue is empty.
+    """
+    while True:
+        job = ReportJob.objects.claim()
+
+        if job is None:
+            if once:
+                return
+
+            time.sleep(interval)
+            continue
+
+        ReportJob.objects.run(job)
+
+        if counter is not None:
+            counter.increment()
+
+
+def work_in_thread(once, interval, counter):
+    try:
+        work(once, interval, counter)
+    finally:
+        # Each thread has its own database connection.
+        connection.close()
+
+
+class Counter(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def increment(self):
+        self.lock.acquire()
+
+        try:
+            self.value += 1
+        finally:
+            self.lock.release()
+
+
+def run_worker(threads=1, once=False, interval=1.0):
+    """
+    Runs ``threads`` workers (in the current thread when there's only one)
+    and returns the number of jobs processed.
+    """
+    counter = Counter()
+
+    if threads <= 1:
+        work(once, interval, counter)
+        return counter.value
+
+    workers = [threading.Thread(target=work_in_thread, args=(once, interval, counter)) for index in range(threads)]
+
+    for worker in workers:
+        worker.setDaemon(True)
+        worker.start()
+
+    for worker in workers:
+        # Joining with a timeout keeps the main thread responsive to Ctrl-C.
+        while worker.isAlive():
+            worker.join(interval)
+
+    return counter.value
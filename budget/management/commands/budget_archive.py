@@ -0,0 +1,49 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = "Archives soft-deleted rows older than the retention window to a gzipped JSON lines file, restores them from one, or purges them for good."
+    args = 'archive <file> | restore <file> | purge'
+    option_list = BaseCommand.option_list + (
+        make_option('--days', dest='days', type='int', default=365,
+            help='Only rows deleted more than this many days ago are archived or purged. Defaults to 365.'),
+        make_option('--batch-size', dest='batch_size', type='int', default=1000,
+            help='How many rows to handle per database transaction. Defaults to 1000.'),
+    )
+
+    def handle(self, *args, **options):
+        from django.db import transaction
+        from budget import archive
+
+        if not args or args[0] not in ('archive', 'restore', 'purge'):
+            raise CommandError("Please choose one of 'archive', 'restore' or 'purge'.")
+
+        action = args[0]
+
+        if action != 'purge' and len(args) != 2:
+            raise CommandError("Please provide the archive file to %s." % action)
+
+        verbosity = int(options.get('verbosity', 1))
+        days = options.get('days', 365)
+        batch_size = options.get('batch_size', 1000)
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+
+        try:
+            if action == 'archive':
+                counts = archive.archive(args[1], days, batch_size, transaction.commit)
+                verb = "Archived"
+            elif action == 'restore':
+                counts = archive.restore(args[1], batch_size, transaction.commit)
+                verb = "Restored"
+            else:
+                counts = archive.purge(days, batch_size, transaction.commit)
+                verb = "Purged"
+        finally:
+            transaction.rollback()
+            transaction.leave_transaction_management()
+
+        if verbosity >= 1:
+            for label in sorted(counts):
+                print "%s %d %s row(s)." % (verb, counts[label], label)
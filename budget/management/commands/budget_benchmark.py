@@ -0,0 +1,123 @@
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+
+
+class Command(NoArgsCommand):
+    help = "Generates synthetic data in a scratch test database and times the budget views and report methods."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--categories', dest='categories', type='int', default=40,
+            help='How many categories to generate.'),
+        make_option('--budgets', dest='budgets', type='int', default=2,
+            help='How many budgets (each with an estimate per category) to generate.'),
+        make_option('--transactions', dest='transactions', type='int', default=10000,
+            help='How many transactions to generate.'),
+        make_option('--years', dest='years', type='int', default=2,
+            help='How many years to spread the transactions over.'),
+        make_option('--deleted-ratio', dest='deleted_ratio', type='float', default=0.05,
+            help='The fraction of transactions to soft delete.'),
+        make_option('--repeat', dest='repeat', type='int', default=5,
+            help='How many times to run each view or method.'),
+        make_option('--output', dest='output', default='budget-benchmark.json',
+            help='The JSON file to write the results to.'),
+    )
+
+    def handle_noargs(self, **options):
+        import datetime
+        import time
+        from django.conf import settings
+        from django.core.urlresolvers import reverse
+        from django.db import connection, transaction
+        from django.test.client import Client
+        from django.utils import simplejson
+        from budget import __version__
+        from budget.benchmarks import benchmark_colorize
+        from budget.models import Budget
+        from budget.synthetic import generate
+        verbosity = int(options.get('verbosity', 1))
+        repeat = options['repeat']
+
+        # Never touch the real data; work in a throwaway test database.
+        old_name = settings.DATABASE_NAME
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+
+        try:
+            start = time.time()
+            counts = generate(categories=options['categories'], budgets=options['budgets'], transactions=options['transactions'], years=options['years'], deleted_ratio=options['deleted_ratio'])
+            transaction.commit_unless_managed()
+            results = {
+                'version': __version__,
+                'options': dict([(key, options[key]) for key in ('categories', 'budgets', 'transactions', 'years', 'deleted_ratio', 'repeat')]),
+                'generated': counts,
+                'generate_seconds': round(time.time() - start, 3),
+                'views': {},
+                'methods': {},
+                'templates': {},
+            }
+
+            today = datetime.date.today()
+            month_start = datetime.date(today.year, today.month, 1)
+            month_end = (month_start + datetime.timedelta(days=31)).replace(day=1) - datetime.timedelta(days=1)
+            year_start, year_end = datetime.date(today.year, 1, 1), datetime.date(today.year, 12, 31)
+            client = Client()
+            views = (
+                ('dashboard', reverse('budget_dashboard')),
+                ('summary_list', reverse('budget_summary_list')),
+                ('summary_year', reverse('budget_summary_year', kwargs={'year': today.year})),
+                ('summary_month', reverse('budget_summary_month', kwargs={'year': today.year, 'month': today.month})),
+                ('transaction_list', reverse('budget_transaction_list')),
+            )
+
+            for name, url in views:
+                def get():
+                    response = client.get(url)
+
+                    if response.status_code != 200:
+                        raise Exception("%s returned a %d." % (url, response.status_code))
+
+                results['views'][name] = self.run(name, get, repeat, verbosity)
+
+            budget = Budget.active.most_current_for_date(today)
+            estimate = list(budget.active_estimates())[0]
+            methods = (
+                ('BudgetManager.most_current_for_date', lambda: Budget.active.most_current_for_date(today)),
+                ('Budget.monthly_estimated_total', budget.monthly_estimated_total),
+                ('Budget.actual_total (month)', lambda: budget.actual_total(month_start, month_end)),
+                ('Budget.estimates_and_transactions (month)', lambda: budget.estimates_and_transactions(month_start, month_end)),
+                ('Budget.estimates_and_transactions (year)', lambda: budget.estimates_and_transactions(year_start, year_end)),
+                ('BudgetEstimate.actual_amount (year)', lambda: estimate.actual_amount(year_start, year_end)),
+                ('BudgetEstimate.actual_transactions (year)', lambda: list(estimate.actual_transactions(year_start, year_end))),
+            )
+
+            for name, method in methods:
+                results['methods'][name] = self.run(name, method, repeat, verbosity)
+
+            for name, result in sorted(benchmark_colorize(budget.active_estimates().count() * 10, repeat).items()):
+                results['templates'][name] = result
+
+                if verbosity >= 1:
+                    print "%s: %.3fms best, %.3fms average" % (name, result['best_ms'], result['average_ms'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        output = open(options['output'], 'w')
+        output.write(simplejson.dumps(results, indent=2, sort_keys=True))
+        output.close()
+
+        if verbosity >= 1:
+            print "Wrote the results to %s." % options['output']
+
+    def run(self, name, func, repeat, verbosity):
+        from budget.benchmarks import measure
+
+        try:
+            result = measure(func, repeat)
+        except Exception, e:
+            result = {'error': str(e)}
+
+            if verbosity >= 1:
+                print "%s: failed (%s)" % (name, e)
+        else:
+            if verbosity >= 1:
+                print "%s: %.3fms best, %.3fms average, %d queries" % (name, result['best_ms'], result['average_ms'], result['queries'])
+
+        return result
@@ -0,0 +1,61 @@
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+
+
+class Command(NoArgsCommand):
+    help = "Seeds a scratch test database and reports timings and query plans for the hot queries with and without the custom indexes."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--categories', dest='categories', type='int', default=40,
+            help='How many categories to generate.'),
+        make_option('--transactions', dest='transactions', type='int', default=100000,
+            help='How many transactions to generate.'),
+        make_option('--years', dest='years', type='int', default=5,
+            help='How many years to spread the transactions over.'),
+        make_option('--repeat', dest='repeat', type='int', default=5,
+            help='How many times to run each query.'),
+        make_option('--output', dest='output', default=None,
+            help='Also write the results as JSON to this file.'),
+    )
+
+    def handle_noargs(self, **options):
+        from django.conf import settings
+        from django.db import connection, transaction
+        from django.utils import simplejson
+        from budget.benchmarks import benchmark_queries, create_indexes, custom_indexes, drop_indexes, hot_queries
+        from budget.synthetic import generate
+        verbosity = int(options.get('verbosity', 1))
+
+        # Never touch the real data; work in a throwaway test database.
+        old_name = settings.DATABASE_NAME
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+
+        try:
+            if verbosity >= 1:
+                print "Generating %d transactions..." % options['transactions']
+
+            generate(categories=options['categories'], transactions=options['transactions'], years=options['years'])
+            transaction.commit_unless_managed()
+            indexes = custom_indexes()
+            results = {'indexes': [name for name, table, statement in indexes]}
+
+            drop_indexes(indexes)
+            results['before'] = benchmark_queries(hot_queries(), options['repeat'])
+            create_indexes(indexes)
+            results['after'] = benchmark_queries(hot_queries(), options['repeat'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if verbosity >= 1:
+            for label in sorted(results['before'].keys()):
+                before, after = results['before'][label], results['after'][label]
+                print
+                print "%s: %.3fms -> %.3fms (best of %d)" % (label, before['best_ms'], after['best_ms'], options['repeat'])
+
+                for name, result in (('before', before), ('after', after)):
+                    for line in result['plan']:
+                        print "    %-6s %s" % (name, line)
+
+        if options.get('output'):
+            output = open(options['output'], 'w')
+            output.write(simplejson.dumps(results, indent=2))
+            output.close()
@@ -0,0 +1,96 @@
+import sys
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = "Exports transactions or a year/month summary as CSV or JSON lines."
+    args = '<transactions|summary>'
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default='csv',
+            help='Either csv or json (lines). Defaults to csv.'),
+        make_option('--output', dest='output', default=None,
+            help='The file to write to. Defaults to standard output.'),
+        make_option('--start', dest='start_date', default=None,
+            help='Only export transactions on or after this date (YYYY-MM-DD).'),
+        make_option('--end', dest='end_date', default=None,
+            help='Only export transactions on or before this date (YYYY-MM-DD).'),
+        make_option('--type', dest='transaction_type', default=None,
+            help='Only export transactions of this type (expense or income).'),
+        make_option('--category', dest='category', default=None,
+            help='Only export transactions in the category with this slug.'),
+        make_option('--year', dest='year', type='int', default=None,
+            help='The year to summarize.'),
+        make_option('--month', dest='month', type='int', default=None,
+            help='The month to summarize. Summarizes the whole year if omitted.'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=1000,
+            help='How many transactions to read per query.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or args[0] not in ('transactions', 'summary'):
+            raise CommandError("Please specify either 'transactions' or 'summary'.")
+
+        format = options.get('format')
+
+        if format not in ('csv', 'json'):
+            raise CommandError("The format must be either 'csv' or 'json'.")
+
+        if args[0] == 'transactions':
+            lines = self.export_transactions(format, options)
+        else:
+            lines = self.export_summary(format, options)
+
+        if options.get('output'):
+            output = open(options['output'], 'wb')
+        else:
+            output = sys.stdout
+
+        try:
+            for line in lines:
+                output.write(line)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+
+    def export_transactions(self, format, options):
+        from budget.transactions.exporters import export_transactions, filter_transactions
+        from budget.transactions.forms import TransactionExportForm
+        from budget.transactions.models import Transaction
+
+        form = TransactionExportForm({
+            'start_date': options.get('start_date'),
+            'end_date': options.get('end_date'),
+            'transaction_type': options.get('transaction_type'),
+            'category': options.get('category'),
+        })
+
+        if not form.is_valid():
+            raise CommandError("Invalid filters: %s" % ', '.join(form.errors.keys()))
+
+        transactions = filter_transactions(Transaction.active.all(), **form.cleaned_data)
+        return export_transactions(transactions, format, options.get('chunk_size'))
+
+    def export_summary(self, format, options):
+        import datetime
+        from django.core.exceptions import ObjectDoesNotExist
+        from budget.exporters import export_summary
+        from budget.models import Budget
+        from budget.views import month_bounds
+
+        year, month = options.get('year'), options.get('month')
+
+        if not year:
+            raise CommandError("Please specify the --year to summarize.")
+
+        if month:
+            start_date, end_date = month_bounds(year, month)
+        else:
+            start_date, end_date = datetime.date(year, 1, 1), datetime.date(year, 12, 31)
+
+        try:
+            budget = Budget.active.most_current_for_date(end_date)
+        except ObjectDoesNotExist:
+            raise CommandError("No budget covers the requested dates.")
+
+        return export_summary(budget, start_date, end_date, format)
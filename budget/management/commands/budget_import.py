@@ -0,0 +1,91 @@
+import csv
+import os
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = "Imports transactions from CSV, QIF or OFX bank statements."
+    args = '<file file ...>'
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default=None,
+            help='The format of the files (csv, qif or ofx). Defaults to the file extension.'),
+        make_option('--batch-size', dest='batch_size', type='int', default=1000,
+            help='How many transactions to insert per database transaction.'),
+        make_option('--category', dest='category', default=None,
+            help='The slug of the category to use when nothing else matches.'),
+        make_option('--rules', dest='rules', default=None,
+            help='A CSV file of "text,category-slug" rules matched against the notes.'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Validate the files without saving anything.'),
+    )
+
+    def handle(self, *filenames, **options):
+        from django.db import transaction
+        from budget.transactions.importers import READERS, CategoryResolver, BudgetImportError, batches, clean_rows
+        from budget.transactions.models import insert_transactions
+
+        if not filenames:
+            raise CommandError("Please provide at least one file to import.")
+
+        verbosity = int(options.get('verbosity', 1))
+        dry_run = options.get('dry_run')
+        rules = []
+
+        if options.get('rules'):
+            rules = [(row[0], row[1]) for row in csv.reader(open(options['rules'], 'rb')) if len(row) >= 2]
+
+        try:
+            resolver = CategoryResolver(rules, options.get('category'))
+        except BudgetImportError, e:
+            raise CommandError(str(e))
+
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+
+        try:
+            for filename in filenames:
+                format = options.get('format') or os.path.splitext(filename)[1][1:].lower()
+
+                if format not in READERS:
+                    raise CommandError("Unknown format '%s' for '%s'." % (format, filename))
+
+                start = time.time()
+                imported = 0
+                failed = 0
+                rows = clean_rows(READERS[format](open(filename, 'rb')), resolver)
+
+                for batch in batches(rows, options.get('batch_size')):
+                    valid = []
+
+                    for line_number, obj, errors in batch:
+                        if errors:
+                            failed += 1
+
+                            if verbosity >= 1:
+                                print "%s, row %d: %s" % (filename, line_number, ' '.join(errors))
+                        else:
+                            valid.append(obj)
+
+                    if not dry_run:
+                        insert_transactions(valid)
+                        transaction.commit()
+
+                    imported += len(valid)
+
+                    if verbosity >= 2:
+                        print "%s: %d row(s) so far (%.0f rows/sec)." % (filename, imported + failed, (imported + failed) / max(time.time() - start, 0.001))
+
+                if verbosity >= 1:
+                    elapsed = max(time.time() - start, 0.001)
+
+                    if dry_run:
+                        action = "Validated"
+                    else:
+                        action = "Imported"
+
+                    print "%s %d transaction(s) from %s in %.2f seconds (%.0f rows/sec), %d row(s) failed." % (action, imported, filename, elapsed, (imported + failed) / elapsed, failed)
+        finally:
+            transaction.rollback()
+            transaction.leave_transaction_management()
@@ -0,0 +1,20 @@
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+
+
+class Command(NoArgsCommand):
+    help = "Rebuilds the running-balance ledger from scratch, reading the transactions in chunks."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size', action='store', dest='chunk_size', type='int', default=1000,
+            help='The number of transactions to read per query. Defaults to 1000.'),
+    )
+
+    def handle_noargs(self, **options):
+        from django.db import transaction
+        from budget.transactions.models import rebuild_ledger
+        verbosity = int(options.get('verbosity', 1))
+        rebuild = transaction.commit_on_success(rebuild_ledger)
+        days = rebuild(chunk_size=options.get('chunk_size', 1000))
+
+        if verbosity >= 1:
+            print "Rebuilt the ledger for %d day(s)." % days
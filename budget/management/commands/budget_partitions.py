@@ -0,0 +1,99 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = "Manages the year buckets of transactions: adds the column and index to an existing install, backfills them, reports on them or benchmarks routed date range queries in a scratch database."
+    args = 'create | backfill | status | benchmark'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=1000,
+            help='How many transactions to backfill per database transaction. Defaults to 1000.'),
+        make_option('--transactions', dest='transactions', type='int', default=100000,
+            help='How many transactions to generate for the benchmark.'),
+        make_option('--years', dest='years', type='int', default=10,
+            help='How many years to spread the benchmark transactions over.'),
+        make_option('--repeat', dest='repeat', type='int', default=5,
+            help='How many times to run each benchmark query.'),
+        make_option('--output', dest='output', default=None,
+            help='Also write the benchmark results as JSON to this file.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or args[0] not in ('create', 'backfill', 'status', 'benchmark'):
+            raise CommandError("Please choose one of 'create', 'backfill', 'status' or 'benchmark'.")
+
+        getattr(self, args[0])(int(options.get('verbosity', 1)), options)
+
+    def create(self, verbosity, options):
+        from django.db import transaction
+        from budget.partitions import create_partitions
+        created = transaction.commit_on_success(create_partitions)()
+
+        if verbosity >= 1:
+            if created:
+                print "Added the year column and the partition index. Run 'budget_partitions backfill' next."
+            else:
+                print "The year column already exists."
+
+    def backfill(self, verbosity, options):
+        from django.db import transaction
+        from budget.partitions import backfill
+        updated = transaction.commit_on_success(backfill)(options.get('batch_size', 1000))
+
+        if verbosity >= 1:
+            print "Backfilled the year of %d transaction(s)." % updated
+
+    def status(self, verbosity, options):
+        from budget.partitions import status
+
+        for year, count in status():
+            if year is None:
+                print "Not bucketed: %d transaction(s)." % count
+            else:
+                print "%d: %d transaction(s)." % (year, count)
+
+    def benchmark(self, verbosity, options):
+        from django.conf import settings
+        from django.db import connection, transaction
+        from django.utils import simplejson
+        from budget.benchmarks import benchmark_queries
+        from budget.partitions import partition_queries
+        from budget.synthetic import generate
+
+        # Never touch the real data; work in a throwaway test database.
+        old_name = settings.DATABASE_NAME
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+
+        try:
+            if verbosity >= 1:
+                print "Generating %d transactions over %d years..." % (options['transactions'], options['years'])
+
+            generate(transactions=options['transactions'], years=options['years'])
+            transaction.commit_unless_managed()
+
+            if settings.DATABASE_ENGINE == 'sqlite3':
+                # Give the planner statistics to work with.
+                connection.cursor().execute('ANALYZE')
+
+            queries = partition_queries()
+            results = {
+                'unrouted': benchmark_queries([(label, unrouted) for label, unrouted, routed in queries], options['repeat']),
+                'routed': benchmark_queries([(label, routed) for label, unrouted, routed in queries], options['repeat']),
+            }
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if verbosity >= 1:
+            for label in sorted(results['unrouted'].keys()):
+                unrouted, routed = results['unrouted'][label], results['routed'][label]
+                print
+                print "%s: %.3fms -> %.3fms (best of %d)" % (label, unrouted['best_ms'], routed['best_ms'], options['repeat'])
+
+                for name, result in (('all', unrouted), ('routed', routed)):
+                    for line in result['plan']:
+                        print "    %-6s %s" % (name, line)
+
+        if options.get('output'):
+            output = open(options['output'], 'w')
+            output.write(simplejson.dumps(results, indent=2))
+            output.close()
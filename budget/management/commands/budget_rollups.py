@@ -0,0 +1,34 @@
+from optparse import make_option
+from django.core.management.base import NoArgsCommand, CommandError
+
+
+class Command(NoArgsCommand):
+    help = "Rebuilds the monthly transaction rollups from scratch and verifies them against the transactions."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--verify', action='store_true', dest='verify_only', default=False,
+            help='Only compare the rollups against the transactions, without rebuilding them.'),
+    )
+
+    def handle_noargs(self, **options):
+        from django.db import transaction
+        from budget.transactions.models import TransactionRollup
+        verbosity = int(options.get('verbosity', 1))
+
+        if not options.get('verify_only'):
+            rebuild = transaction.commit_on_success(TransactionRollup.objects.rebuild)
+            cells = rebuild()
+
+            if verbosity >= 1:
+                print "Rebuilt %d rollup(s)." % cells
+
+        mismatches = TransactionRollup.objects.verify()
+
+        for (category_id, month, transaction_type), expected, actual in mismatches:
+            if verbosity >= 1:
+                print "Mismatch for category %s, %s (%s): expected %s in %d transaction(s), found %s in %d." % (category_id, month.strftime('%Y-%m'), transaction_type, expected[0], expected[1], actual[0], actual[1])
+
+        if mismatches:
+            raise CommandError("%d rollup(s) do not match the transactions." % len(mismatches))
+
+        if verbosity >= 1:
+            print "Rollups match the transactions."
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = "Prepares an existing install for separate ledgers: 'create' adds the owner columns and indexes and makes slugs unique per owner, 'assign <username>' gives every row without an owner to that user."
+    args = 'create | assign <username>'
+
+    def handle(self, *args, **options):
+        from django.contrib.auth.models import User
+        from django.db import transaction
+        from budget.tenancy import add_owner_columns, assign_unowned, swap_slug_constraints
+        verbosity = int(options.get('verbosity', 1))
+
+        if args and args[0] == 'create' and len(args) == 1:
+            changed = transaction.commit_on_success(add_owner_columns)()
+
+            if verbosity >= 1:
+                if changed:
+                    print "Added owner columns to %s." % ', '.join(changed)
+                else:
+                    print "The owner columns already exist."
+
+            swapped = transaction.commit_on_success(swap_slug_constraints)()
+
+            if verbosity >= 1 and swapped:
+                print "Made slugs unique per owner in %s." % ', '.join(swapped)
+        elif args and args[0] == 'assign' and len(args) == 2:
+            try:
+                owner = User.objects.get(username=args[1])
+            except User.DoesNotExist:
+                raise CommandError("There's no user called '%s'." % args[1])
+
+            moved = transaction.commit_on_success(assign_unowned)(owner)
+
+            if verbosity >= 1:
+                print "Gave %d row(s) to %s." % (moved, owner.username)
+        else:
+            raise CommandError("Please choose 'create' or 'assign <username>'.")
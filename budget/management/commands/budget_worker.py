@@ -0,0 +1,22 @@
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+
+
+class Command(NoArgsCommand):
+    help = "Processes queued report jobs. Run several at once for a pool of processes."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--threads', action='store', dest='threads', type='int', default=1,
+            help='The number of worker threads to run. Defaults to 1.'),
+        make_option('--interval', action='store', dest='interval', type='float', default=1.0,
+            help='How many seconds to wait between checks of an empty queue. Defaults to 1.'),
+        make_option('--once', action='store_true', dest='once', default=False,
+            help='Exit once the queue is empty instead of waiting for more jobs.'),
+    )
+
+    def handle_noargs(self, **options):
+        from budget.jobs import run_worker
+        verbosity = int(options.get('verbosity', 1))
+        processed = run_worker(options.get('threads', 1), options.get('once', False), options.get('interval', 1.0))
+
+        if verbosity >= 1:
+            print "Processed %d job(s)." % processed
@@ -1,14 +1,147 @@
+import base64
+import bisect
 import datetime
+import traceback
 from decimal import Decimal
-from django.db import models
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.urlresolvers import get_callable
+from django.db import models, IntegrityError
+from django.utils import simplejson
+from django.utils.hashcompat import md5_constructor
+from django.db.models import Q, Sum
+from django.db.models.signals import post_save, post_delete
+from budget import caching, tenancy
+from budget.instrumentation import instrument_method
 from budget.categories.models import Category, StandardMetadata, ActiveManager
-from budget.transactions.models import Transaction
+from budget.transactions.models import Transaction, TransactionRollup, rollups_enabled
+from budget.transactions.signals import transaction_changed, transactions_bulk_changed
 from django.utils.translation import ugettext_lazy as _
 
 
+def covers_whole_months(start_date, end_date):
+    """
+    Checks whether a date range starts on the first of a month and ends on
+    the last day of a month.
+    """
+    return start_date.day == 1 and (end_date + datetime.timedelta(days=1)).day == 1
+
+
+def actual_amounts_by_category(category_ids, start_date, end_date):
+    """
+    Returns a dictionary mapping category ids to the sum of their expenses
+    within the date range, using one grouped query.
+    
+    When ``BUDGET_USE_ROLLUPS`` is enabled and the range covers whole months,
+    the totals are read from the rollup table instead.
+    
+    Categories without any expenses are left out.
+    """
+    if not category_ids:
+        return {}
+    
+    if rollups_enabled() and covers_whole_months(start_date, end_date):
+        return TransactionRollup.objects.totals_by_category(category_ids, start_date, end_date)
+    
+    totals = {}
+    expenses = Transaction.expenses.between(start_date, end_date).filter(category__in=category_ids)
+    
+    for row in expenses.values('category').annotate(total=Sum('amount')).order_by():
+        totals[row['category']] = row['total']
+    
+    return totals
+
+
+def actual_transactions_by_category(category_ids, start_date, end_date):
+    """
+    Returns a dictionary mapping category ids to a list of their expenses
+    (ordered by date) within the date range, using one query.
+    """
+    if not category_ids:
+        return {}
+    
+    buckets = {}
+    expenses = Transaction.expenses.between(start_date, end_date).filter(category__in=category_ids)
+    
+    for transaction in expenses.select_related('category').order_by('date'):
+        buckets.setdefault(transaction.category_id, []).append(transaction)
+    
+    return buckets
+
+
+class BudgetIndex(object):
+    """
+    An index of the active budgets sorted by start date, so the budget in
+    effect on any number of dates can be found with a binary search instead
+    of a query per date.
+
+    With ``BUDGET_CACHE_REPORTS`` enabled the index is also kept per process
+    and ledger (see ``caching.ProcessCache``), checked against the shared
+    ``budgets`` version on every lookup, so a loaded index answers without
+    touching the database. Otherwise it's only loaded (with one query) to
+    resolve several dates at once.
+    """
+    def __init__(self):
+        self.cache = caching.ProcessCache('budgets', self.load)
+        self.invalidate = self.cache.invalidate
+
+    def load(self, manager):
+        budgets = list(manager.get_query_set().order_by('start_date', 'id'))
+        return ([budget.start_date for budget in budgets], budgets)
+
+    def lookup(self, manager):
+        """
+        Returns a tuple of ``(start_dates, budgets)`` for the manager's model.
+        """
+        return self.cache.get(manager)
+
+    def resolve(self, manager, dates):
+        start_dates, budgets = self.lookup(manager)
+        resolved = []
+
+        for date in dates:
+            if not isinstance(date, datetime.datetime):
+                date = datetime.datetime.combine(date, datetime.time())
+
+            index = bisect.bisect_right(start_dates, date)
+
+            if index:
+                resolved.append(budgets[index - 1])
+            else:
+                resolved.append(None)
+
+        return resolved
+
+
+budget_index = BudgetIndex()
+
+
 class BudgetManager(ActiveManager):
+    @instrument_method('budget.models.BudgetManager.most_current_for_date')
     def most_current_for_date(self, date):
-        return super(BudgetManager, self).get_query_set().filter(start_date__lte=date).latest('start_date')
+        budget = self.most_current_for_dates([date])[0]
+
+        if budget is None:
+            raise self.model.DoesNotExist('No budget had started by %s.' % date)
+
+        return budget
+
+    def most_current_for_dates(self, dates):
+        """
+        Returns the most current budget (or ``None``) for each of the dates,
+        using at most one query however many dates there are.
+        """
+        if len(dates) == 1 and not budget_index.cache.keeps_values():
+            # Without a kept index, a single date is cheaper to look up with
+            # the start date index than by loading every budget.
+            budgets = list(self.get_query_set().filter(start_date__lte=dates[0]).order_by('-start_date', '-id')[:1])
+            return budgets or [None]
+
+        return budget_index.resolve(self, dates)
 
 
 class Budget(StandardMetadata):
@@ -19,7 +152,7 @@ class Budget(StandardMetadata):
     to be applied to the same set of transactions for comparision.
     """
     name = models.CharField(_('Name'), max_length=255)
-    slug = models.SlugField(_('Slug'), unique=True)
+    slug = models.SlugField(_('Slug'))
     start_date = models.DateTimeField(_('Start Date'),
             default=datetime.datetime.now, db_index=True)
 
@@ -29,6 +162,7 @@ class Budget(StandardMetadata):
     def __unicode__(self):
         return self.name
 
+    @instrument_method('budget.models.Budget.monthly_estimated_total')
     def monthly_estimated_total(self):
         total = Decimal('0.0')
         for estimate in self.estimates.exclude(is_deleted=True):
@@ -38,33 +172,54 @@ class Budget(StandardMetadata):
     def yearly_estimated_total(self):
         return self.monthly_estimated_total() * 12
 
+    def active_estimates(self):
+        return self.estimates.exclude(is_deleted=True).select_related('category', 'budget')
+
+    @instrument_method('budget.models.Budget.estimates_and_transactions')
     def estimates_and_transactions(self, start_date, end_date):
+        """
+        Pairs each active estimate with the expenses in its category for the
+        date range.
+
+        Rather than querying once per estimate, the totals for every category
+        come from a single grouped query and the transactions themselves from
+        a single query, bucketed by category.
+        """
+        estimates = list(self.active_estimates())
+        category_ids = [estimate.category_id for estimate in estimates]
+        totals = actual_amounts_by_category(category_ids, start_date, end_date)
+        transactions = actual_transactions_by_category(category_ids, start_date, end_date)
         estimates_and_transactions = []
         actual_total = Decimal('0.0')
 
-        for estimate in self.estimates.exclude(is_deleted=True):
-            actual_amount = estimate.actual_amount(start_date, end_date)
+        for estimate in estimates:
+            actual_amount = totals.get(estimate.category_id, Decimal('0.0'))
             actual_total += actual_amount
             estimates_and_transactions.append({
                 'estimate': estimate,
-                'transactions': estimate.actual_transactions(start_date, end_date),
+                'transactions': transactions.get(estimate.category_id, []),
                 'actual_amount': actual_amount,
             })
         
         return (estimates_and_transactions, actual_total)
 
+    @instrument_method('budget.models.Budget.actual_total')
     def actual_total(self, start_date, end_date):
         actual_total = Decimal('0.0')
+        category_ids = [estimate.category_id for estimate in self.active_estimates()]
+        totals = actual_amounts_by_category(category_ids, start_date, end_date)
 
-        for estimate in self.estimates.exclude(is_deleted=True):
-            actual_amount = estimate.actual_amount(start_date, end_date)
-            actual_total += actual_amount
+        # Categories are counted once per estimate, matching
+        # ``estimates_and_transactions``.
+        for category_id in category_ids:
+            actual_total += totals.get(category_id, Decimal('0.0'))
         
         return actual_total
 
     class Meta:
         verbose_name = _('Budget')
         verbose_name_plural = _('Budgets')
+        unique_together = (('owner', 'slug'),)
 
 class BudgetEstimate(StandardMetadata):
     """
@@ -86,17 +241,219 @@ class BudgetEstimate(StandardMetadata):
     def yearly_estimated_amount(self):
         return self.amount * 12
 
+    @instrument_method('budget.models.BudgetEstimate.actual_transactions')
     def actual_transactions(self, start_date, end_date):
         # Estimates should only report on expenses to prevent incomes from 
         # (incorrectly) artificially inflating totals.
-        return Transaction.expenses.filter(category=self.category, date__range=(start_date, end_date)).order_by('date')
+        return Transaction.expenses.between(start_date, end_date).filter(category=self.category).order_by('date')
 
+    @instrument_method('budget.models.BudgetEstimate.actual_amount')
     def actual_amount(self, start_date, end_date):
-        total = Decimal('0.0')
-        for transaction in self.actual_transactions(start_date, end_date):
-            total += transaction.amount
-        return total
+        total = self.actual_transactions(start_date, end_date).aggregate(total=Sum('amount'))['total']
+        return total or Decimal('0.0')
         
     class Meta:
         verbose_name = _('Budget estimate')
         verbose_name_plural = _('Budget estimates')
+
+
+def async_reports_enabled():
+    return getattr(settings, 'BUDGET_ASYNC_REPORTS', False)
+
+
+def job_timeout():
+    """
+    How long a job may run before another worker takes it over, in seconds.
+    """
+    return getattr(settings, 'BUDGET_JOB_TIMEOUT', 60 * 10)
+
+
+def job_retry_delay():
+    """
+    How long a failed job is left before it's queued again, in seconds.
+    """
+    return getattr(settings, 'BUDGET_JOB_RETRY_DELAY', 60 * 5)
+
+
+JOB_STATUSES = (
+    ('pending', _('Pending')),
+    ('running', _('Running')),
+    ('done', _('Done')),
+    ('stale', _('Stale')),
+    ('failed', _('Failed')),
+)
+
+
+class ReportJobManager(models.Manager):
+    def request(self, function, **params):
+        """
+        Returns the job for calling ``function`` (a dotted path) with the
+        given keyword arguments, queueing it if it's new or stale. A failed
+        job is only queued again once it has been failed for
+        ``BUDGET_JOB_RETRY_DELAY`` seconds.
+
+        The parameters must be JSON serializable. Any result from a previous
+        run is kept until the new one is ready. Jobs requested from a ledger
+        (see ``budget.tenancy``) are kept apart and run in that ledger.
+        """
+        params = simplejson.dumps(params, sort_keys=True)
+        owner_id = tenancy.get_current_owner_id()
+
+        if owner_id is None:
+            key = md5_constructor('%s:%s' % (function, params)).hexdigest()
+        else:
+            key = md5_constructor('%s:%s:%s' % (owner_id, function, params)).hexdigest()
+
+        try:
+            job = self.get(key=key)
+        except self.model.DoesNotExist:
+            try:
+                return self.create(key=key, function=function, params=params, owner_id=owner_id)
+            except IntegrityError:
+                # Someone else queued it in the meantime.
+                job = self.get(key=key)
+
+        now = datetime.datetime.now()
+
+        if job.status == 'failed' and job.finished and job.finished > now - datetime.timedelta(seconds=job_retry_delay()):
+            return job
+
+        if job.status in ('stale', 'failed'):
+            self.filter(pk=job.pk, status=job.status).update(status='pending', requested=now)
+            job.status = 'pending'
+
+        return job
+
+    def claim(self):
+        """
+        Marks the oldest pending job as running and returns it, or ``None`` if
+        there's nothing to do. Safe to call from many workers at once.
+
+        Jobs which have been running for longer than ``BUDGET_JOB_TIMEOUT``
+        seconds (left behind by a worker that died, say) are claimed again.
+        """
+        now = datetime.datetime.now()
+        abandoned = Q(status='running', started__lt=now - datetime.timedelta(seconds=job_timeout()))
+
+        for job in self.filter(Q(status='pending') | abandoned).order_by('requested')[:10]:
+            if job.status == 'pending':
+                claimable = self.filter(pk=job.pk, status='pending')
+            else:
+                claimable = self.filter(abandoned, pk=job.pk)
+
+            if claimable.update(status='running', started=now):
+                job.status = 'running'
+                job.started = now
+                return job
+
+        return None
+
+    def run(self, job):
+        """
+        Runs a claimed job and stores its result (or the error it raised).
+        """
+        try:
+            params = dict([(str(name), value) for name, value in simplejson.loads(job.params).items()])
+
+            if tenancy.tenancy_enabled():
+                result = tenancy.as_owner(job.owner_id, get_callable(job.function), **params)
+            else:
+                result = get_callable(job.function)(**params)
+        except Exception:
+            self.filter(pk=job.pk).update(status='failed', error=traceback.format_exc(), finished=datetime.datetime.now())
+            return False
+
+        encoded = base64.b64encode(pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+        finished = datetime.datetime.now()
+
+        # If the data changed while the job was running, the result is stored
+        # but the job stays stale.
+        if not self.filter(pk=job.pk, status='running').update(status='done', result=encoded, error='', finished=finished):
+            self.filter(pk=job.pk).update(result=encoded, error='', finished=finished)
+
+        return True
+
+    def mark_stale(self, owner_ids=None):
+        """
+        Flags every finished (or running) job as out of date, or only those
+        of the given owners' ledgers.
+        """
+        if not async_reports_enabled():
+            return
+
+        jobs = self.filter(status__in=('done', 'running'))
+
+        if owner_ids is not None and tenancy.tenancy_enabled():
+            owner_ids = list(owner_ids)
+            owned = Q(owner__in=[owner_id for owner_id in owner_ids if owner_id is not None])
+
+            if None in owner_ids:
+                owned = owned | Q(owner__isnull=True)
+
+            jobs = jobs.filter(owned)
+
+        jobs.update(status='stale')
+
+
+class ReportJob(models.Model):
+    """
+    A report computed in the background by the ``budget_worker`` command.
+
+    ``function`` is the dotted path of a function returning the report, which
+    is called with the JSON encoded ``params`` as keyword arguments. The
+    pickled result is kept until the job is run again, so views can keep
+    serving it while a fresh one is prepared.
+    """
+    key = models.CharField(_('Key'), max_length=32, unique=True)
+    owner = models.ForeignKey(User, related_name='budget_reportjob_set', verbose_name=_('Owner'), blank=True, null=True)
+    function = models.CharField(_('Function'), max_length=255)
+    params = models.TextField(_('Parameters'), blank=True)
+    status = models.CharField(_('Status'), max_length=16, choices=JOB_STATUSES, default='pending', db_index=True)
+    result = models.TextField(_('Result'), blank=True)
+    error = models.TextField(_('Error'), blank=True)
+    requested = models.DateTimeField(_('Requested'), default=datetime.datetime.now)
+    started = models.DateTimeField(_('Started'), blank=True, null=True)
+    finished = models.DateTimeField(_('Finished'), blank=True, null=True)
+
+    objects = ReportJobManager()
+
+    def __unicode__(self):
+        return u"%s(%s) - %s" % (self.function, self.params, self.status)
+
+    def get_result(self):
+        """
+        The result of the last successful run, or ``None``.
+        """
+        if not self.result:
+            return None
+
+        return pickle.loads(base64.b64decode(self.result))
+
+    class Meta:
+        verbose_name = _('Report job')
+        verbose_name_plural = _('Report jobs')
+
+
+def report_data_changed(sender, instance=None, deltas=None, **kwargs):
+    if instance is not None:
+        ReportJob.objects.mark_stale([instance.owner_id])
+    elif deltas is not None and tenancy.tenancy_enabled():
+        ReportJob.objects.mark_stale(Category.objects.filter(pk__in=list(set([key[0] for key in deltas.keys()]))).values_list('owner', flat=True).distinct())
+    else:
+        ReportJob.objects.mark_stale()
+
+
+post_save.connect(caching.budget_changed, sender=Budget, dispatch_uid='budget.caching.budget_changed')
+post_delete.connect(caching.budget_changed, sender=Budget, dispatch_uid='budget.caching.budget_deleted')
+post_save.connect(budget_index.invalidate, sender=Budget, dispatch_uid='budget.models.budget_index.invalidate')
+post_delete.connect(budget_index.invalidate, sender=Budget, dispatch_uid='budget.models.budget_index.invalidate_deleted')
+post_save.connect(caching.estimate_changed, sender=BudgetEstimate, dispatch_uid='budget.caching.estimate_changed')
+post_save.connect(caching.category_changed, sender=Category, dispatch_uid='budget.caching.category_changed')
+post_delete.connect(caching.category_changed, sender=Category, dispatch_uid='budget.caching.category_deleted')
+transaction_changed.connect(caching.transaction_changed, dispatch_uid='budget.caching.transaction_changed')
+transactions_bulk_changed.connect(caching.transactions_bulk_changed, dispatch_uid='budget.caching.transactions_bulk_changed')
+post_save.connect(report_data_changed, sender=Budget, dispatch_uid='budget.models.report_data_changed.budget')
+post_save.connect(report_data_changed, sender=BudgetEstimate, dispatch_uid='budget.models.report_data_changed.estimate')
+post_save.connect(report_data_changed, sender=Category, dispatch_uid='budget.models.report_data_changed.category')
+transaction_changed.connect(report_data_changed, dispatch_uid='budget.models.report_data_changed.transaction')
+transactions_bulk_changed.connect(report_data_changed, dispatch_uid='budget.models.report_data_changed.transactions')
@@ -0,0 +1,203 @@
+"""
+Keyset (a.k.a. seek) pagination for the list views.
+
+Rather than counting every row and skipping to an ``OFFSET``, each page
+remembers the sort key of its first and last objects in an opaque cursor and
+the next page simply asks for the rows after it. Deep pages cost the same as
+the first one, at the price of not knowing how many pages there are.
+
+Enable it for the list views with ``BUDGET_KEYSET_PAGINATION = True``.
+"""
+import base64
+import binascii
+import datetime
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator, InvalidPage
+from django.db.models import Q
+from django.http import Http404
+from django.utils import simplejson
+
+
+def keyset_pagination_enabled():
+    return getattr(settings, 'BUDGET_KEYSET_PAGINATION', False)
+
+
+def datetime_slack():
+    """
+    How much earlier than stored a datetime may be read back. Django's SQLite
+    backend parses fractions of a second as floats, which sometimes loses a
+    microsecond, and cursors are made from the values read.
+    """
+    if settings.DATABASE_ENGINE == 'sqlite3':
+        return datetime.timedelta(microseconds=1)
+
+    return datetime.timedelta(0)
+
+
+class InvalidCursor(InvalidPage):
+    pass
+
+
+class KeysetPage(object):
+    def __init__(self, object_list, paginator, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __repr__(self):
+        return '<Keyset page of %d object(s)>' % len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_previous() or self.has_next()
+
+
+class KeysetPaginator(object):
+    """
+    Paginates a queryset on a unique ordering, such as
+    ``('-date', '-created', '-id')``.
+
+    The ordering must end with a unique field so that every object has a
+    distinct position.
+    """
+    is_keyset = True
+
+    def __init__(self, object_list, per_page, ordering):
+        self.object_list = object_list
+        self.per_page = int(per_page)
+        self.ordering = ordering
+        self.fields = [name.lstrip('-') for name in ordering]
+
+    def encode_cursor(self, obj, direction):
+        values = []
+
+        for name in self.fields:
+            value = getattr(obj, self.object_list.model._meta.get_field(name).attname)
+
+            if isinstance(value, datetime.date):
+                value = str(value)
+
+            values.append(value)
+
+        return base64.urlsafe_b64encode(simplejson.dumps([direction, values]))
+
+    def decode_cursor(self, cursor):
+        try:
+            direction, raw_values = simplejson.loads(base64.urlsafe_b64decode(str(cursor)))
+            values = []
+
+            for name, value in zip(self.fields, raw_values):
+                values.append(self.object_list.model._meta.get_field(name).to_python(value))
+        except (TypeError, ValueError, binascii.Error, ValidationError):
+            raise InvalidCursor('That cursor is not valid.')
+
+        if direction not in ('next', 'previous') or len(values) != len(self.fields):
+            raise InvalidCursor('That cursor is not valid.')
+
+        return (direction, values)
+
+    def seek(self, values, reverse=False):
+        """
+        Builds the filter for all objects after (or before, if ``reverse``)
+        the given sort key.
+        """
+        condition = None
+        slack = datetime_slack()
+
+        for index in range(len(self.fields)):
+            descending = self.ordering[index].startswith('-') != reverse
+            value = values[index]
+
+            if descending:
+                lookup = '%s__lt' % self.fields[index]
+            else:
+                lookup = '%s__gt' % self.fields[index]
+
+                if isinstance(value, datetime.datetime):
+                    value = value + slack
+
+            filters = {}
+
+            for position in range(index):
+                if isinstance(values[position], datetime.datetime):
+                    filters[str('%s__range' % self.fields[position])] = (values[position], values[position] + slack)
+                else:
+                    filters[str(self.fields[position])] = values[position]
+
+            filters[str(lookup)] = value
+
+            if condition is None:
+                condition = Q(**filters)
+            else:
+                condition = condition | Q(**filters)
+
+        return condition
+
+    def page(self, cursor=None):
+        queryset = self.object_list
+        direction = 'next'
+
+        if cursor:
+            direction, values = self.decode_cursor(cursor)
+            queryset = queryset.filter(self.seek(values, reverse=(direction == 'previous')))
+
+        if direction == 'previous':
+            ordering = [self.reverse_ordering(name) for name in self.ordering]
+        else:
+            ordering = self.ordering
+
+        # Fetching one extra object tells us whether there's another page.
+        object_list = list(queryset.order_by(*ordering)[:self.per_page + 1])
+        has_more = len(object_list) > self.per_page
+        object_list = object_list[:self.per_page]
+
+        if direction == 'previous':
+            object_list.reverse()
+
+        next_cursor = previous_cursor = None
+
+        if object_list:
+            if has_more or direction == 'previous':
+                next_cursor = self.encode_cursor(object_list[-1], 'next')
+
+            if cursor and (has_more or direction == 'next'):
+                previous_cursor = self.encode_cursor(object_list[0], 'previous')
+
+        return KeysetPage(object_list, self, next_cursor, previous_cursor)
+
+    def reverse_ordering(self, name):
+        if name.startswith('-'):
+            return name[1:]
+
+        return '-%s' % name
+
+
+def paginate(request, queryset, keyset_ordering):
+    """
+    Paginates a queryset for a list view, returning a tuple of
+    ``(object_list, paginator, page)``.
+
+    Uses the ``page`` GET parameter and a Django ``Paginator`` normally, or
+    the ``cursor`` GET parameter and a ``KeysetPaginator`` (ordered by
+    ``keyset_ordering``) when ``BUDGET_KEYSET_PAGINATION`` is enabled.
+    """
+    per_page = getattr(settings, 'BUDGET_LIST_PER_PAGE', 50)
+
+    try:
+        if keyset_pagination_enabled():
+            paginator = KeysetPaginator(queryset, per_page, keyset_ordering)
+            page = paginator.page(request.GET.get('cursor'))
+        else:
+            paginator = Paginator(queryset, per_page)
+            page = paginator.page(request.GET.get('page', 1))
+    except InvalidPage:
+        raise Http404('Invalid page requested.')
+
+    return (page.object_list, paginator, page)
@@ -0,0 +1,98 @@
+"""
+Tooling for the year-bucketed transaction storage.
+
+Every transaction carries the year of its date in ``year``, which leads the
+``transactions_transaction_partitions`` index. With ``BUDGET_PARTITION_BY_YEAR``
+enabled, date range queries are routed to their years (see
+``budget.transactions.models.filter_dates``), so each only reads the slices of
+the index for those years, however long the history gets.
+
+Installs which predate the column add it with ``create_partitions`` and fill
+it in with ``backfill`` (transactions can't be read or saved until they've
+done so); partitioning should only be enabled once ``status``
+shows no unbucketed rows.
+"""
+import datetime
+from django.db import connection
+from django.db.models import Count
+from budget.benchmarks import custom_indexes
+from budget.transactions.models import Transaction, filter_dates, has_year_column, year_of
+
+
+def create_partitions():
+    """
+    Adds the ``year`` column and the partition index to an existing table.
+    Returns ``False`` if the column was already there.
+    """
+    if has_year_column():
+        return False
+
+    field = Transaction._meta.get_field('year')
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    cursor.execute('ALTER TABLE %s ADD COLUMN %s %s NULL' % (qn(Transaction._meta.db_table), qn(field.column), field.db_type()))
+
+    for name, table, statement in custom_indexes([Transaction]):
+        if name.endswith('_partitions'):
+            cursor.execute(statement)
+
+    return True
+
+
+def backfill(batch_size=1000):
+    """
+    Fills in the year of every transaction without one, ``batch_size`` rows
+    at a time with one ``UPDATE`` per year in each batch. Returns the number
+    of rows updated.
+    """
+    updated = 0
+
+    while True:
+        batch = list(Transaction.objects.filter(year__isnull=True).order_by('id').values_list('id', 'date')[:batch_size])
+
+        if not batch:
+            return updated
+
+        years = {}
+
+        for pk, date in batch:
+            years.setdefault(year_of(date), []).append(pk)
+
+        for year, pks in years.items():
+            updated += Transaction.objects.filter(pk__in=pks).update(year=year)
+
+
+def status():
+    """
+    Returns a list of ``(year, count)`` for every year bucket, with ``None``
+    for the transactions which haven't been bucketed yet.
+    """
+    counts = Transaction.objects.values('year').annotate(count=Count('id')).order_by('year')
+    return [(row['year'], row['count']) for row in counts]
+
+
+def partition_queries(year=None):
+    """
+    The date range queries behind the reports for ``year`` (the latest year
+    with transactions by default), as ``(label, unrouted, routed)``.
+    """
+    from django.db.models import Sum
+
+    if year is None:
+        year = Transaction.objects.order_by('-date').values_list('date', flat=True)[0].year
+
+    start_date = datetime.date(year, 1, 1)
+    end_date = datetime.date(year, 12, 31)
+    category_ids = list(Transaction.active.values_list('category', flat=True).order_by('category').distinct()[:10])
+    queries = []
+
+    for partitioned in (False, True):
+        expenses = filter_dates(Transaction.expenses.all(), start_date, end_date, partitioned)
+        active = filter_dates(Transaction.active.all(), start_date, end_date, partitioned)
+        queries.append([
+            ('BudgetEstimate.actual_transactions', expenses.filter(category=category_ids[0]).order_by('date')),
+            ('actual_amounts_by_category', expenses.filter(category__in=category_ids).values('category').annotate(total=Sum('amount')).order_by()),
+            ('yearly_totals', active.values('category', 'transaction_type').annotate(total=Sum('amount')).order_by()),
+        ])
+
+    return [(unrouted[0], unrouted[1], routed[1]) for unrouted, routed in zip(queries[0], queries[1])]
@@ -0,0 +1,8 @@
+-- Supports BudgetManager.most_current_for_date, which looks for the latest
+-- active budget starting on or before a date.
+CREATE INDEX budget_budget_active_start_date ON budget_budget (is_deleted, start_date);
+-- The same lookup within one owner's ledger (see budget.tenancy).
+CREATE INDEX budget_budget_owner_start_date ON budget_budget (owner_id, is_deleted, start_date);
+-- Supports the JSON API's conditional GETs (budget.api.resource_state).
+CREATE INDEX budget_budget_updated ON budget_budget (updated);
+CREATE INDEX budget_budget_owner_updated ON budget_budget (owner_id, updated);
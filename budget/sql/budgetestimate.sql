@@ -0,0 +1,3 @@
+-- Supports Budget.active_estimates (the estimates of a budget that aren't
+-- deleted).
+CREATE INDEX budget_budgetestimate_active_budget ON budget_budgetestimate (budget_id, is_deleted);
@@ -0,0 +1,70 @@
+"""
+Generates synthetic budgets, categories and transactions for benchmarking.
+
+Everything is derived from a seeded ``random.Random``, so the same options
+always produce the same data.
+"""
+import datetime
+import random
+from decimal import Decimal
+from budget.categories.models import Category
+from budget.models import Budget, BudgetEstimate
+from budget.transactions.models import Transaction, insert_transactions
+
+
+def generate(categories=40, budgets=2, transactions=10000, years=2, deleted_ratio=0.05, start_year=None, seed=0, batch_size=1000):
+    """
+    Creates the given number of categories, budgets (each with an estimate per
+    category) and transactions spread evenly over ``years`` years, soft
+    deleting roughly ``deleted_ratio`` of the transactions.
+
+    Returns a dictionary of the created counts.
+    """
+    rng = random.Random(seed)
+
+    if start_year is None:
+        start_year = datetime.date.today().year - years + 1
+
+    first_day = datetime.date(start_year, 1, 1)
+    days = (datetime.date(start_year + years, 1, 1) - first_day).days
+    category_objects = []
+
+    for index in range(categories):
+        category_objects.append(Category.objects.create(name='Category %d' % index, slug='synthetic-category-%d' % index))
+
+    for index in range(budgets):
+        start_date = datetime.datetime.combine(first_day + datetime.timedelta(days=days * index / budgets), datetime.time())
+        budget = Budget.objects.create(name='Budget %d' % index, slug='synthetic-budget-%d' % index, start_date=start_date)
+
+        for category in category_objects:
+            BudgetEstimate.objects.create(budget=budget, category=category, amount=Decimal(rng.randint(5000, 100000)) / 100)
+
+    batch = []
+    created = 0
+
+    for index in range(transactions):
+        if rng.random() < 0.1:
+            transaction_type = 'income'
+        else:
+            transaction_type = 'expense'
+
+        batch.append(Transaction(
+            transaction_type=transaction_type,
+            notes='Synthetic transaction %d' % index,
+            category=rng.choice(category_objects),
+            amount=Decimal(rng.randint(100, 50000)) / 100,
+            date=first_day + datetime.timedelta(days=rng.randint(0, days - 1)),
+            is_deleted=rng.random() < deleted_ratio,
+        ))
+
+        if len(batch) >= batch_size:
+            created += insert_transactions(batch)
+            batch = []
+
+    created += insert_transactions(batch)
+    return {
+        'categories': categories,
+        'budgets': budgets,
+        'estimates': categories * budgets,
+        'transactions': created,
+    }
@@ -1,6 +1,8 @@
+from bisect import bisect_right
 from decimal import Decimal
 from django import template
 from django.conf import settings
+from django.utils.safestring import mark_safe
 
 
 register = template.Library()
@@ -15,35 +17,71 @@ BUDGET_DEFAULT_COLORS = (
 )
 
 
+class ColorTable(object):
+    """
+    The color thresholds, converted to ``Decimal`` once and sorted so the
+    color for a percentage is found with a binary search.
+    """
+    def __init__(self, colors):
+        thresholds = {}
+        
+        # The first color listed for a percentage wins, as it always has.
+        for percentage, css_class in colors:
+            thresholds.setdefault(make_decimal(percentage), css_class)
+        
+        self.thresholds = sorted(thresholds.keys())
+        # Safe, like the tag's output, so templates don't escape them again.
+        self.classes = [mark_safe(thresholds[percentage]) for percentage in self.thresholds]
+    
+    def color(self, estimate, actual):
+        """
+        The CSS class for an actual amount against its estimate, or an empty
+        string if there's no estimate or the amount is below every threshold.
+        """
+        estimate = make_decimal(estimate)
+        
+        if not estimate:
+            return ''
+        
+        index = bisect_right(self.thresholds, make_decimal(actual) / estimate) - 1
+        
+        if index < 0:
+            return ''
+        
+        return self.classes[index]
+
+
+_color_table = (None, None)
+
+
+def get_color_table():
+    """
+    The ``ColorTable`` for the current ``BUDGET_DEFAULT_COLORS``, only
+    rebuilt when the setting is replaced.
+    """
+    global _color_table
+    colors = getattr(settings, 'BUDGET_DEFAULT_COLORS', BUDGET_DEFAULT_COLORS)
+    
+    if _color_table[0] is not colors:
+        _color_table = (colors, ColorTable(colors))
+    
+    return _color_table[1]
+
+
 class ColorizeAmountNode(template.Node):
     def __init__(self, estimated_amount, actual_amount):
         self.estimated_amount = template.Variable(estimated_amount)
         self.actual_amount = template.Variable(actual_amount)
+        self.colors = get_color_table()
     
     def render(self, context):
-        if hasattr(settings, 'BUDGET_DEFAULT_COLORS'):
-            colors = settings.BUDGET_DEFAULT_COLORS
-        else:
-            colors = BUDGET_DEFAULT_COLORS
-        
         try:
             estimate = self.estimated_amount.resolve(context)
             actual = self.actual_amount.resolve(context)
-            estimate = make_decimal(estimate)
-
-            if estimate == 0:
-                return ''
-
-            actual = make_decimal(actual)            
-            percentage = actual / estimate
-            
-            for color in colors:
-                color_percentage = make_decimal(color[0])
-                
-                if percentage >= color_percentage:
-                    return color[1]
         except template.VariableDoesNotExist:
             return ''
+        
+        return self.colors.color(estimate, actual)
 
 
 def make_decimal(amount):
@@ -72,4 +110,34 @@ def colorize_amount(parser, token):
     return ColorizeAmountNode(estimated_amount, actual_amount)
 
 
+def colorize_estimates(estimates_and_transactions, estimated_amount='amount'):
+    """
+    Colors a whole report at once, returning a copy of each group from
+    ``Budget.estimates_and_transactions`` with a ``color`` added. The
+    argument names the estimate's attribute (or method) holding the amount
+    to compare against.
+    
+    Example:
+    
+        {% for eat_group in estimates_and_transactions|colorize_estimates:"yearly_estimated_amount" %}
+            <span class="{{ eat_group.color }}">...</span>
+        {% endfor %}
+    """
+    colors = get_color_table()
+    colored = []
+    
+    for eat_group in estimates_and_transactions:
+        estimate = getattr(eat_group['estimate'], estimated_amount)
+        
+        if callable(estimate):
+            estimate = estimate()
+        
+        eat_group = dict(eat_group)
+        eat_group['color'] = colors.color(estimate, eat_group['actual_amount'])
+        colored.append(eat_group)
+    
+    return colored
+
+
 register.tag('colorize_amount', colorize_amount)
+register.filter('colorize_estimates', colorize_estimates)
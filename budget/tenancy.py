@@ -0,0 +1,303 @@
+"""
+Separate ledgers for many owners in a single deployment.
+
+With ``BUDGET_MULTI_TENANT`` enabled, every category, rule, budget, estimate
+and transaction belongs to an owner (a ``django.contrib.auth`` user, or
+``None`` for the shared ledger) and ``TenantMiddleware`` scopes each request
+to the ledger of the user making it:
+
+    * the ``ActiveManager`` family only returns the current owner's rows,
+    * new rows are given to the current owner when they're first saved,
+    * cache versions, the budget index, the rule matcher and report jobs
+      are all kept per owner, so one owner's changes never invalidate
+      another's reports.
+
+Anonymous requests get the shared ledger. Outside of a request (management
+commands, the shell) nothing is scoped unless ``activate`` or ``as_owner`` is
+used; the worker runs each report job in the ledger it was requested from.
+
+Existing installs add the owner columns (and make slugs unique per owner
+rather than across every row) with ``./manage.py budget_tenants create``, and
+can hand their data to a user with ``./manage.py budget_tenants assign
+<username>``.
+"""
+import threading
+from django.conf import settings
+
+_state = threading.local()
+
+
+def tenancy_enabled():
+    return getattr(settings, 'BUDGET_MULTI_TENANT', False)
+
+
+def owner_id_of(owner):
+    if owner is None or isinstance(owner, (int, long)):
+        return owner
+
+    return owner.pk
+
+
+def activate(owner):
+    """
+    Scopes this thread to the ledger of ``owner`` (a user, a user id or
+    ``None`` for the shared ledger).
+    """
+    _state.active = True
+    _state.owner_id = owner_id_of(owner)
+
+
+def deactivate():
+    _state.active = False
+    _state.owner_id = None
+
+
+def is_active():
+    return tenancy_enabled() and getattr(_state, 'active', False)
+
+
+def get_current_owner_id():
+    """
+    The id of the owner this thread is scoped to, or ``None`` for the shared
+    ledger or when nothing is scoped.
+    """
+    if not is_active():
+        return None
+
+    return _state.owner_id
+
+
+def as_owner(owner, func, *args, **kwargs):
+    """
+    Calls ``func`` scoped to the ledger of ``owner``, restoring the previous
+    scope afterwards.
+    """
+    previous = (getattr(_state, 'active', False), getattr(_state, 'owner_id', None))
+    activate(owner)
+
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _state.active, _state.owner_id = previous
+
+
+def scope(queryset, field='owner'):
+    """
+    Narrows a queryset to the current owner's rows, where ``field`` is the
+    path to the owner (``category__owner`` for rollups, say).
+    """
+    if not is_active():
+        return queryset
+
+    owner_id = get_current_owner_id()
+
+    if owner_id is None:
+        return queryset.filter(**{'%s__isnull' % field: True})
+
+    return queryset.filter(**{field: owner_id})
+
+
+def slug_taken(instance, slug):
+    """
+    Whether another row of ``instance``'s model already uses ``slug``,
+    counting soft-deleted rows.
+
+    Slugs are unique per ledger with ``BUDGET_MULTI_TENANT`` enabled and
+    across every row otherwise. The database only enforces the
+    ``(owner, slug)`` pair, which never matches a ``NULL`` owner, so forms
+    check here before saving.
+    """
+    queryset = instance.__class__.objects.filter(slug=slug)
+
+    if tenancy_enabled():
+        if instance.pk:
+            owner_id = instance.owner_id
+        else:
+            owner_id = get_current_owner_id()
+
+        if owner_id is None:
+            queryset = queryset.filter(owner__isnull=True)
+        else:
+            queryset = queryset.filter(owner=owner_id)
+
+    if instance.pk:
+        queryset = queryset.exclude(pk=instance.pk)
+
+    return queryset.count() > 0
+
+
+def scope_key():
+    """
+    Identifies the current scope in per-process caches and cache keys.
+    """
+    if not is_active():
+        return 'all'
+
+    return 'owner:%s' % get_current_owner_id()
+
+
+def owned_models():
+    from budget.categories.models import Category, CategoryRule
+    from budget.models import Budget, BudgetEstimate
+    from budget.transactions.models import Transaction
+    return (Category, CategoryRule, Budget, BudgetEstimate, Transaction)
+
+
+def add_owner_columns():
+    """
+    Adds the ``owner_id`` columns and the owner-led indexes to the tables of
+    an existing install. Returns the names of the tables changed.
+    """
+    from django.db import connection
+    from budget.benchmarks import custom_indexes
+    from budget.models import ReportJob
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    changed = []
+
+    for model in owned_models() + (ReportJob,):
+        table = model._meta.db_table
+        columns = [row[0] for row in connection.introspection.get_table_description(cursor, table)]
+
+        if 'owner_id' not in columns:
+            cursor.execute('ALTER TABLE %s ADD COLUMN %s %s NULL' % (qn(table), qn('owner_id'), model._meta.get_field('owner').db_type()))
+            changed.append(table)
+
+    for name, table, statement in custom_indexes():
+        if table in changed and '_owner_' in name:
+            cursor.execute(statement)
+
+    return changed
+
+
+def has_unique_slug(cursor, table):
+    """
+    Whether ``slug`` alone is still unique in ``table``, as it was before
+    ledgers.
+    """
+    from django.db import connection
+
+    if settings.DATABASE_ENGINE == 'mysql':
+        # MySQL names the index after the column.
+        cursor.execute('SHOW INDEX FROM %s' % connection.ops.quote_name(table))
+        return 'slug' in [row[2] for row in cursor.fetchall() if not row[1]]
+
+    return connection.introspection.get_indexes(cursor, table).get('slug', {}).get('unique', False)
+
+
+def rebuild_table(model):
+    """
+    Recreates the table of ``model`` from its current definition, keeping its
+    rows and recreating its indexes. SQLite can't drop a constraint any other
+    way.
+    """
+    from django.core.management.color import no_style
+    from django.db import connection
+    from budget.benchmarks import custom_indexes
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    table = model._meta.db_table
+    old_table = '%s_old' % table
+    columns = ', '.join([qn(field.column) for field in model._meta.local_fields])
+    create, pending = connection.creation.sql_create_model(model, no_style())
+    indexes = connection.creation.sql_indexes_for_model(model, no_style())
+    indexes.extend([statement for name, index_table, statement in custom_indexes() if index_table == table])
+
+    cursor.execute('ALTER TABLE %s RENAME TO %s' % (qn(table), qn(old_table)))
+
+    for statement in create:
+        cursor.execute(statement)
+
+    cursor.execute('INSERT INTO %s (%s) SELECT %s FROM %s' % (qn(table), columns, columns, qn(old_table)))
+    # The old indexes go with the old table, which frees their names.
+    cursor.execute('DROP TABLE %s' % qn(old_table))
+
+    for statement in indexes:
+        cursor.execute(statement)
+
+
+def swap_slug_constraints():
+    """
+    Replaces the unique index on ``slug`` of the category and budget tables
+    of an existing install with one on ``(owner_id, slug)``, so each ledger
+    can use the same slugs. Run after ``add_owner_columns``. Returns the
+    names of the tables changed.
+    """
+    from django.db import connection
+    from budget.categories.models import Category
+    from budget.models import Budget
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    changed = []
+
+    for model in (Category, Budget):
+        table = model._meta.db_table
+
+        if not has_unique_slug(cursor, table):
+            continue
+
+        if settings.DATABASE_ENGINE == 'sqlite3':
+            rebuild_table(model)
+        else:
+            if settings.DATABASE_ENGINE == 'mysql':
+                cursor.execute('ALTER TABLE %s DROP INDEX %s' % (qn(table), qn('slug')))
+            else:
+                cursor.execute('ALTER TABLE %s DROP CONSTRAINT %s' % (qn(table), qn('%s_slug_key' % table)))
+
+            cursor.execute('CREATE UNIQUE INDEX %s ON %s (%s, %s)' % (qn('%s_owner_slug' % table), qn(table), qn('owner_id'), qn('slug')))
+
+        changed.append(table)
+
+    return changed
+
+
+def assign_unowned(owner):
+    """
+    Gives every row of the shared ledger to ``owner``, turning a single
+    ledger install into the first owner's ledger. Returns the number of rows
+    moved.
+
+    Report jobs are keyed per ledger, so the shared ledger's are dropped and
+    simply requested again.
+    """
+    from budget import caching
+    from budget.models import ReportJob
+    from budget.transactions.models import Transaction
+    moved = 0
+
+    for model in owned_models():
+        moved += model.objects.filter(owner__isnull=True).update(owner=owner_id_of(owner))
+
+    ReportJob.objects.filter(owner__isnull=True).delete()
+
+    if caching.caching_enabled():
+        scopes = ['budgets', 'categories', 'category_rules', 'transactions']
+        scopes.extend([caching.month_scope(month) for month in Transaction.objects.dates('date', 'month')])
+        caching.bump_for([owner_id_of(owner)], *scopes)
+
+    return moved
+
+
+class TenantMiddleware(object):
+    """
+    Scopes every request to the ledger of the user making it. Goes after
+    ``AuthenticationMiddleware``.
+    """
+    def process_request(self, request):
+        if not tenancy_enabled():
+            return None
+
+        if request.user.is_authenticated():
+            activate(request.user)
+        else:
+            activate(None)
+
+        return None
+
+    def process_response(self, request, response):
+        deactivate()
+        return response
+
+    def process_exception(self, request, exception):
+        deactivate()
+        return None
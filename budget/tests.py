@@ -1,4 +1,5 @@
 """
+>>> import datetime
 >>> from django.test import Client
 >>> c = Client()
 
@@ -177,4 +178,718 @@ Decimal("250.0")
 Decimal("0.0")
 >>> r.context[-1]['progress_bar_percent']
 0
+
+
+# Report engine
+
+>>> from decimal import Decimal
+>>> from budget.models import BudgetEstimate
+>>> from budget.transactions.models import Transaction
+>>> estimate = BudgetEstimate.objects.create(budget=budget, category=cat, amount=Decimal('100.25'))
+>>> t1 = Transaction.objects.create(transaction_type='expense', category=cat, notes='Lunch', amount=Decimal('12.25'), date='2008-10-02')
+>>> t2 = Transaction.objects.create(transaction_type='expense', category=cat, notes='Dinner', amount=Decimal('30.75'), date='2008-10-20')
+>>> t3 = Transaction.objects.create(transaction_type='income', category=cat, notes='Refund', amount=Decimal('5.25'), date='2008-10-21')
+>>> t4 = Transaction.objects.create(transaction_type='expense', category=cat, notes='Snack', amount=Decimal('2.25'), date='2008-11-01')
+>>> t5 = Transaction.objects.create(transaction_type='expense', category=cat, notes='Deleted', amount=Decimal('99.25'), date='2008-10-05')
+>>> t5.delete()
+
+>>> eat, actual_total = budget.estimates_and_transactions(datetime.date(2008, 10, 1), datetime.date(2008, 10, 31))
+>>> len(eat)
+1
+>>> eat[0]['estimate']
+<BudgetEstimate: Misc - 100.25>
+>>> eat[0]['transactions']
+[<Transaction: Lunch (Expense) - 12.25>, <Transaction: Dinner (Expense) - 30.75>]
+>>> print eat[0]['actual_amount'], actual_total
+43.00 43.00
+>>> print budget.actual_total(datetime.date(2008, 10, 1), datetime.date(2008, 10, 31))
+43.00
+>>> print estimate.actual_amount(datetime.date(2008, 10, 1), datetime.date(2008, 11, 30))
+45.25
+>>> print budget.actual_total(datetime.date(2009, 1, 1), datetime.date(2009, 1, 31))
+0.0
+
+>>> from django.conf import settings
+>>> from budget.transactions.models import TransactionRollup
+>>> old_use_rollups = getattr(settings, 'BUDGET_USE_ROLLUPS', False)
+>>> settings.BUDGET_USE_ROLLUPS = True
+>>> cells = TransactionRollup.objects.rebuild()
+>>> print '%.2f' % budget.actual_total(datetime.date(2008, 10, 1), datetime.date(2008, 10, 31))
+43.00
+>>> eat, actual_total = budget.estimates_and_transactions(datetime.date(2008, 10, 1), datetime.date(2008, 11, 30))
+>>> print '%.2f' % actual_total, len(eat[0]['transactions'])
+45.25 3
+
+The summary list reads the months, with their counts and totals, from the
+rollups too.
+
+>>> r = c.get('/budget/summary/')
+>>> months = [(summary['month'], summary['count'], '%.2f' % summary['expenses'], '%.2f' % summary['incomes']) for summary in r.context[-1]['months']]
+>>> months
+[(datetime.datetime(2008, 10, 1, 0, 0), 3, '43.00', '5.25'), (datetime.datetime(2008, 11, 1, 0, 0), 1, '2.25', '0.00')]
+>>> r.context[-1]['dates']
+[datetime.datetime(2008, 10, 1, 0, 0), datetime.datetime(2008, 11, 1, 0, 0)]
+>>> settings.BUDGET_USE_ROLLUPS = old_use_rollups
+>>> r = c.get('/budget/summary/')
+>>> [(summary['month'], summary['count'], '%.2f' % summary['expenses'], '%.2f' % summary['incomes']) for summary in r.context[-1]['months']] == months
+True
+>>> '3 transactions, $43.00 spent, $5.25 earned' in r.content
+True
+>>> TransactionRollup.objects.all().delete()
+
+
+# Report caching
+
+>>> import shutil, tempfile
+>>> from django.core.cache import get_cache
+>>> from budget import caching
+>>> from budget.categories.models import Category
+>>> old_cache, old_cache_reports = caching.cache, getattr(settings, 'BUDGET_CACHE_REPORTS', False)
+>>> settings.BUDGET_CACHE_REPORTS = True
+>>> cache_dir = tempfile.mkdtemp()
+>>> def summary_for(start_date, end_date):
+...     eat, actual_total = caching.estimates_and_transactions(budget, start_date, end_date)
+...     print '%.2f' % actual_total, [t.notes for t in eat[0]['transactions']], eat[0]['estimate'].category.name
+>>> for backend in ('locmem://', 'file://%s' % cache_dir):
+...     caching.cache = get_cache(backend)
+...     summary_for(datetime.date(2008, 10, 1), datetime.date(2008, 11, 30))
+...     updated = Transaction.objects.filter(pk=t1.pk).update(amount=Decimal('500.00'))
+...     summary_for(datetime.date(2008, 10, 1), datetime.date(2008, 11, 30))
+...     t4.amount = Decimal('3.25')
+...     t4.save()
+...     summary_for(datetime.date(2008, 10, 1), datetime.date(2008, 11, 30))
+...     t1.save()
+...     summary_for(datetime.date(2008, 10, 1), datetime.date(2008, 11, 30))
+...     cat.name = 'Miscellaneous'
+...     cat.save()
+...     summary_for(datetime.date(2008, 10, 1), datetime.date(2008, 11, 30))
+...     cat.name = 'Misc'
+...     cat.save()
+...     t4.amount = Decimal('2.25')
+...     t4.save()
+45.25 [u'Lunch', u'Dinner', u'Snack'] Misc
+45.25 [u'Lunch', u'Dinner', u'Snack'] Misc
+46.25 [u'Lunch', u'Dinner', u'Snack'] Misc
+46.25 [u'Lunch', u'Dinner', u'Snack'] Misc
+46.25 [u'Lunch', u'Dinner', u'Snack'] Miscellaneous
+45.25 [u'Lunch', u'Dinner', u'Snack'] Misc
+45.25 [u'Lunch', u'Dinner', u'Snack'] Misc
+46.25 [u'Lunch', u'Dinner', u'Snack'] Misc
+46.25 [u'Lunch', u'Dinner', u'Snack'] Misc
+46.25 [u'Lunch', u'Dinner', u'Snack'] Miscellaneous
+
+>>> print '%.2f' % caching.monthly_estimated_total(budget)
+100.25
+>>> estimate.amount = Decimal('150.25')
+>>> estimate.save()
+>>> print '%.2f' % caching.monthly_estimated_total(budget)
+150.25
+
+>>> shutil.rmtree(cache_dir)
+>>> caching.cache, settings.BUDGET_CACHE_REPORTS = old_cache, old_cache_reports
+
+
+# Exporting summaries
+
+>>> r = c.get('/budget/summary/2008/10/export/csv/')
+>>> r.status_code
+200
+>>> r['Content-Disposition']
+'attachment; filename=summary-2008-10.csv'
+>>> print r.content,
+category,estimated_amount,actual_amount
+misc,150.25,43.00
+>>> from django.utils import simplejson
+>>> [(row['record'], row.get('notes'), row.get('actual_amount')) for row in [simplejson.loads(line) for line in c.get('/budget/summary/2008/export/json/').content.splitlines()]]
+[(u'estimate', None, u'45.25'), (u'transaction', u'Lunch', None), (u'transaction', u'Dinner', None), (u'transaction', u'Snack', None)]
+
+
+# Instrumentation
+
+>>> from budget import instrumentation
+>>> collector = instrumentation.start_collecting()
+>>> total = budget.monthly_estimated_total()
+>>> estimates = list(budget.active_estimates())
+>>> collector = instrumentation.stop_collecting()
+>>> collector.queries >= 2, collector.rows >= 1
+(True, True)
+>>> sorted(collector.breakdown.keys())
+['budget.models.Budget.monthly_estimated_total']
+>>> collector.breakdown['budget.models.Budget.monthly_estimated_total']['calls']
+1
+>>> instrumentation.current_collector() is None
+True
+
+>>> class FakeRequest(object):
+...     path = '/budget/'
+>>> request = FakeRequest()
+>>> from budget.views import dashboard
+>>> middleware = instrumentation.InstrumentationMiddleware()
+>>> old_instrumentation = getattr(settings, 'BUDGET_INSTRUMENTATION', False)
+>>> settings.BUDGET_INSTRUMENTATION = True
+>>> instrumentation.stats.reset()
+>>> middleware.process_request(request)
+>>> middleware.process_view(request, dashboard, (), {})
+>>> response = middleware.process_response(request, c.get('/budget/'))
+>>> int(response['X-Budget-Queries']) > 0, float(response['X-Budget-SQL-Time']) >= 0
+(True, True)
+>>> stats = simplejson.loads(c.get('/budget/_stats/').content)
+>>> stats.keys()
+[u'budget.views.dashboard']
+>>> stats['budget.views.dashboard']['queries']['count']
+1
+>>> settings.BUDGET_INSTRUMENTATION = old_instrumentation
+
+
+# Query counts
+
+Every page should run a fixed number of queries, however many estimates and
+transactions there are.
+
+>>> from budget.instrumentation import collect
+>>> urls = ['/budget/', '/budget/summary/2008/', '/budget/summary/2008/10/', '/budget/budget/test-budget/estimate/', '/budget/transaction/', '/budget/category/']
+>>> def query_counts():
+...     counts = []
+...     for url in urls:
+...         response, collector = collect(c.get, url)
+...         counts.append(collector.queries)
+...     return counts
+>>> before = query_counts()
+
+>>> from budget.categories.models import Category
+>>> from budget.transactions.models import Transaction
+>>> extra_categories = []
+>>> for index in range(5):
+...     category = Category.objects.create(name='Extra %d' % index, slug='extra-%d' % index)
+...     extra_categories.append(category)
+...     estimate = BudgetEstimate.objects.create(budget=budget, category=category, amount=Decimal('10'))
+...     for day in (1, 2, 3):
+...         transaction = Transaction.objects.create(category=category, notes='Extra', amount=Decimal('1'), date=datetime.date(2008, 10, day))
+>>> after = query_counts()
+>>> after == before
+True
+>>> [count <= 8 for count in after]
+[True, True, True, True, True, True]
+
+>>> Transaction.objects.filter(category__in=extra_categories).delete()
+>>> BudgetEstimate.objects.filter(category__in=extra_categories).delete()
+>>> Category.objects.filter(pk__in=[category.pk for category in extra_categories]).delete()
+
+
+# Trend reports
+
+>>> from budget.trends import TrendReport, TrendMatrix
+>>> report = TrendReport(datetime.date(2008, 1, 1), datetime.date(2009, 12, 31))
+>>> len(report.months), report.months[0], report.months[-1]
+(24, datetime.date(2008, 1, 1), datetime.date(2009, 12, 1))
+>>> [category.name for category in report.categories]
+[u'Misc']
+>>> ['%.2f' % amount for amount in report.expenses.row(cat.pk)[8:12]]
+['0.00', '43.00', '2.25', '0.00']
+>>> print '%.2f %.2f' % (report.expenses.total(), report.incomes.total())
+45.25 5.25
+>>> [getattr(month_budget, 'slug', None) for month_budget in report.budgets[8:11]]
+[None, u'test-budget', u'test-budget']
+
+>>> matrix = TrendMatrix([1, 2], report.months[:2])
+>>> matrix.add(1, report.months[0], Decimal('0.10'))
+>>> matrix.add(1, report.months[0], Decimal('0.20'))
+>>> matrix.add(2, report.months[1], Decimal('-1.05'))
+>>> matrix.get(1, report.months[0]) == Decimal('0.30'), matrix.column_totals() == [Decimal('0.30'), Decimal('-1.05')]
+(True, True)
+
+>>> old_use_rollups = getattr(settings, 'BUDGET_USE_ROLLUPS', False)
+>>> settings.BUDGET_USE_ROLLUPS = True
+>>> cells = TransactionRollup.objects.rebuild()
+>>> TrendReport(datetime.date(2008, 1, 1), datetime.date(2009, 12, 31)).expenses.cells == report.expenses.cells
+True
+>>> settings.BUDGET_USE_ROLLUPS = old_use_rollups
+>>> TransactionRollup.objects.all().delete()
+
+>>> r = c.get('/budget/summary/trends/2008-2009/')
+>>> r.status_code
+200
+>>> [(row['category'].name, '%.2f' % row['expense_total'], '%.2f' % row['income_total']) for row in r.context[-1]['rows']]
+[(u'Misc', '45.25', '5.25')]
+
+
+# Analytics
+
+>>> from budget.analytics import Analytics
+>>> report = TrendReport(datetime.date(2008, 9, 1), datetime.date(2008, 12, 31))
+>>> python = Analytics(report, use_numpy=False)
+>>> [['%s' % value for value in row] for row in python.variance()]
+[['0', '107.25', '148', '150.25']]
+>>> [['%s' % value for value in row] for row in python.percent_of_estimate()]
+[['None', '28.62', '1.5', '0']]
+>>> [['%s' % value for value in row] for row in python.moving_average(2)]
+[['0', '21.5', '22.63', '1.13']]
+>>> ['%s' % value for value in python.projection(2, 12)]
+['58.81']
+
+The NumPy backend is used whenever NumPy is installed and has to agree with
+the pure-Python one. Without NumPy this only checks that the pure-Python
+backend is picked.
+
+>>> from budget import analytics
+>>> default = Analytics(report)
+>>> default.backend.name == (analytics.numpy is None and 'python' or 'numpy')
+True
+>>> [default.variance() == python.variance(), default.percent_of_estimate() == python.percent_of_estimate(), default.moving_average(2) == python.moving_average(2), default.projection(2, 12) == python.projection(2, 12)]
+[True, True, True, True]
+
+The trend report shows them for every category.
+
+>>> r = c.get('/budget/summary/trends/2008-2008/')
+>>> row = r.context[-1]['rows'][0]
+>>> [['%s' % value for value in row[name][8:]] for name in ('variance', 'percent_of_estimate', 'moving_average')]
+[['0', '107.25', '148', '150.25'], ['None', '28.62', '1.5', '0'], ['0', '14.33', '15.08', '15.08']]
+>>> '%s' % row['projection']
+'226.21'
+>>> '<td class="numeric">28.62</td>' in r.content
+True
+
+
+# Budget index
+
+Without the shared cache, a single date is looked up with one single-row
+query rather than by loading every budget.
+
+>>> from budget.models import budget_index
+>>> older = Budget.objects.create(name='Older Budget', slug='older-budget', start_date=datetime.datetime(2008, 6, 1))
+>>> result, collector = collect(Budget.active.most_current_for_date, datetime.date(2008, 12, 1))
+>>> result.slug, collector.queries, collector.rows
+(u'test-budget', 1, 1)
+>>> Budget.objects.filter(pk=older.pk).delete()
+>>> Budget.active.most_current_for_dates([datetime.date(2008, 10, 13)])
+[None]
+>>> dates = [datetime.date(2008, 10, 13), datetime.date(2008, 10, 14), datetime.datetime(2008, 10, 13, 23, 59)]
+>>> result, collector = collect(Budget.active.most_current_for_dates, dates)
+>>> [getattr(found, 'slug', None) for found in result], collector.queries
+([None, u'test-budget', None], 1)
+
+With the shared cache the index is kept per process, and checked against
+the ``budgets`` version on every lookup, so another process's changes are
+picked up too.
+
+>>> settings.BUDGET_CACHE_REPORTS, caching.cache = True, get_cache('locmem://')
+>>> budget_index.invalidate()
+>>> result, collector = collect(Budget.active.most_current_for_date, datetime.date(2008, 12, 1))
+>>> result.slug, collector.queries
+(u'test-budget', 1)
+>>> result, collector = collect(Budget.active.most_current_for_dates, dates)
+>>> [getattr(found, 'slug', None) for found in result], collector.queries
+([None, u'test-budget', None], 0)
+>>> updated = Budget.objects.filter(pk=budget.pk).update(start_date=datetime.datetime(2008, 10, 13))
+>>> Budget.active.most_current_for_date(datetime.date(2008, 10, 13)) is None
+Traceback (most recent call last):
+    ...
+DoesNotExist: No budget had started by 2008-10-13.
+>>> caching.bump('budgets')
+>>> Budget.active.most_current_for_date(datetime.date(2008, 10, 13)).slug
+u'test-budget'
+>>> updated = Budget.objects.filter(pk=budget.pk).update(start_date=budget.start_date)
+>>> caching.bump('budgets')
+>>> Budget.active.most_current_for_date(datetime.date(2008, 1, 1))
+Traceback (most recent call last):
+    ...
+DoesNotExist: No budget had started by 2008-01-01.
+
+>>> newer = Budget.objects.create(name='Newer Budget', slug='newer-budget', start_date=datetime.datetime(2009, 1, 1))
+>>> [found.slug for found in Budget.active.most_current_for_dates([datetime.date(2008, 12, 31), datetime.date(2009, 1, 1)])]
+[u'test-budget', u'newer-budget']
+>>> newer.is_deleted = True
+>>> newer.save()
+>>> Budget.active.most_current_for_date(datetime.date(2009, 6, 1)).slug
+u'test-budget'
+>>> newer.delete()
+>>> caching.cache, settings.BUDGET_CACHE_REPORTS = old_cache, old_cache_reports
+
+
+# Background reports
+
+>>> from budget.models import ReportJob
+>>> old_async = getattr(settings, 'BUDGET_ASYNC_REPORTS', False)
+>>> settings.BUDGET_ASYNC_REPORTS = True
+>>> r = c.get('/budget/summary/2008/')
+>>> r.status_code, r.template[0].name
+(202, 'budget/summaries/preparing.html')
+>>> [(job.function, job.params, job.status) for job in ReportJob.objects.all()]
+[(u'budget.views.summary_year_context', u'{"year": 2008}', u'pending')]
+>>> call_command('budget_worker', once=True)
+Processed 1 job(s).
+>>> r = c.get('/budget/summary/2008/')
+>>> r.status_code, '%.2f' % r.context[-1]['actual_total']
+(200, '45.25')
+
+Changing the data marks the result as stale; it's still served while the job
+runs again.
+
+>>> t1.amount = Decimal('13.25')
+>>> t1.save()
+>>> ReportJob.objects.get().status
+u'stale'
+>>> r = c.get('/budget/summary/2008/')
+>>> r.status_code, '%.2f' % r.context[-1]['actual_total'], ReportJob.objects.get().status
+(200, '45.25', u'pending')
+>>> call_command('budget_worker', once=True, verbosity=0)
+>>> '%.2f' % c.get('/budget/summary/2008/').context[-1]['actual_total']
+'46.25'
+
+>>> c.get('/budget/summary/2001/').status_code
+202
+>>> call_command('budget_worker', once=True, verbosity=0)
+>>> job = ReportJob.objects.get(params='{"year": 2001}')
+>>> job.status, job.error.splitlines()[-1]
+(u'failed', u'DoesNotExist: No budget had started by 2001-12-31.')
+
+A failed job shows an error page, and is only queued again once
+``BUDGET_JOB_RETRY_DELAY`` has passed.
+
+>>> r = c.get('/budget/summary/2001/')
+>>> r.status_code, r.template[0].name, ReportJob.objects.get(pk=job.pk).status
+(500, 'budget/summaries/failed.html', u'failed')
+>>> updated = ReportJob.objects.filter(pk=job.pk).update(finished=datetime.datetime.now() - datetime.timedelta(hours=1))
+>>> c.get('/budget/summary/2001/').status_code, ReportJob.objects.get(pk=job.pk).status
+(202, u'pending')
+
+Jobs left running by a worker that died are taken over once they've been
+running for ``BUDGET_JOB_TIMEOUT``.
+
+>>> claimed = ReportJob.objects.claim()
+>>> claimed.pk == job.pk, ReportJob.objects.claim()
+(True, None)
+>>> updated = ReportJob.objects.filter(pk=job.pk).update(started=datetime.datetime.now() - datetime.timedelta(hours=1))
+>>> ReportJob.objects.claim().pk == job.pk, ReportJob.objects.get(pk=job.pk).started > claimed.started
+(True, True)
+
+>>> settings.BUDGET_ASYNC_REPORTS = old_async
+>>> t1.amount = Decimal('12.25')
+>>> t1.save()
+>>> ReportJob.objects.all().delete()
+
+
+# Archiving
+
+Soft-deleted rows older than the retention window are moved out to a file.
+A category still referred to by a transaction (even an active one) stays.
+
+>>> import gzip, os
+>>> from budget import archive
+>>> gone = Category.objects.create(name='Gone', slug='gone')
+>>> kept = Category.objects.create(name='Kept', slug='kept')
+>>> old = Transaction.objects.create(transaction_type='expense', category=gone, notes='Old', amount=Decimal('1.50'), date='2001-01-01')
+>>> live = Transaction.objects.create(transaction_type='expense', category=kept, notes='Live', amount=Decimal('2.50'), date='2001-01-01')
+>>> old.delete()
+>>> gone.delete()
+>>> kept.delete()
+>>> Category.objects.filter(pk__in=[gone.pk, kept.pk]).update(updated=datetime.datetime(2001, 1, 1))
+2
+>>> Transaction.objects.filter(pk=old.pk).update(updated=datetime.datetime(2001, 1, 1))
+1
+>>> [category.name for category in archive.archivable(Category, datetime.datetime.now())]
+[]
+
+>>> fd, filename = tempfile.mkstemp('.jsonl.gz')
+>>> os.close(fd)
+>>> call_command('budget_archive', 'archive', filename)
+Archived 0 budget.budget row(s).
+Archived 0 budget.budgetestimate row(s).
+Archived 1 categories.category row(s).
+Archived 0 categories.categoryrule row(s).
+Archived 1 transactions.transaction row(s).
+>>> Transaction.objects.filter(pk=old.pk).count(), Category.objects.filter(pk=gone.pk).count(), Category.objects.filter(pk=kept.pk).count()
+(0, 0, 1)
+>>> [simplejson.loads(line)['model'] for line in gzip.open(filename)]
+[u'transactions.transaction', u'categories.category']
+
+Restoring puts them back as they were, still deleted.
+
+>>> call_command('budget_archive', 'restore', filename, verbosity=0)
+>>> restored = Transaction.objects.get(pk=old.pk)
+>>> restored.category.name, restored.notes, '%.2f' % restored.amount, restored.is_deleted, restored.category.is_deleted
+(u'Gone', u'Old', '1.50', True, True)
+>>> archive.restore(filename)['transactions.transaction']
+0
+
+Purging deletes them without keeping a copy.
+
+>>> call_command('budget_archive', 'purge', days=30, verbosity=0)
+>>> Transaction.objects.filter(pk=old.pk).count(), Category.objects.filter(pk=gone.pk).count(), Category.objects.filter(pk=kept.pk).count()
+(0, 0, 1)
+>>> call_command('budget_archive', 'purge', days=30, batch_size=1)
+Purged 0 budget.budget row(s).
+Purged 0 budget.budgetestimate row(s).
+Purged 0 categories.category row(s).
+Purged 0 categories.categoryrule row(s).
+Purged 0 transactions.transaction row(s).
+
+>>> os.remove(filename)
+>>> Transaction.objects.filter(pk=live.pk).delete()
+>>> Category.objects.filter(pk=kept.pk).delete()
+
+
+# Tenancy
+
+With ``BUDGET_MULTI_TENANT`` enabled, every user gets a ledger of their own.
+
+>>> from django.contrib.auth.models import User
+>>> from django.http import HttpRequest
+>>> from budget import tenancy
+>>> from budget.tenancy import TenantMiddleware
+>>> old_tenancy = getattr(settings, 'BUDGET_MULTI_TENANT', False)
+>>> settings.BUDGET_MULTI_TENANT = True
+>>> alice = User.objects.create_user('alice', 'alice@example.com', 'secret')
+>>> bob = User.objects.create_user('bob', 'bob@example.com', 'secret')
+
+>>> tenancy.activate(alice)
+>>> alice_food = Category.objects.create(name='Food', slug='food')
+>>> alice_budget = Budget.objects.create(name='Home', slug='home', start_date=datetime.datetime(2008, 1, 1))
+>>> alice_lunch = Transaction.objects.create(transaction_type='expense', category=alice_food, notes='Lunch', amount=Decimal('8.00'), date='2008-10-02')
+>>> alice_food.owner == alice, alice_lunch.owner == alice
+(True, True)
+
+Slugs only need to be unique within a ledger, and every manager in the
+``ActiveManager`` family only sees the current one.
+
+>>> tenancy.activate(bob)
+>>> bob_food = Category.objects.create(name='Food', slug='food')
+>>> Category.active.get(slug='food') == bob_food
+True
+>>> Transaction.active.count(), Transaction.expenses.count()
+(0, 0)
+>>> Budget.active.most_current_for_date(datetime.date(2008, 10, 31))
+Traceback (most recent call last):
+    ...
+DoesNotExist: No budget had started by 2008-10-31.
+>>> from budget.categories.forms import CategoryForm
+>>> CategoryForm({'name': 'Food'}).errors['name']
+[u'A category with this name already exists.']
+
+The middleware scopes each request to the user making it, and anonymous
+requests to the shared ledger.
+
+>>> request = HttpRequest()
+>>> request.user = alice
+>>> TenantMiddleware().process_request(request)
+>>> Budget.active.most_current_for_date(datetime.date(2008, 10, 31)) == alice_budget
+True
+>>> [transaction.notes for transaction in Transaction.expenses.get_latest()]
+[u'Lunch']
+>>> TenantMiddleware().process_response(request, None)
+>>> tenancy.is_active()
+False
+>>> from django.contrib.auth.models import AnonymousUser
+>>> request.user = AnonymousUser()
+>>> TenantMiddleware().process_request(request)
+>>> Category.active.filter(slug='food').count()
+0
+>>> Category.active.filter(pk=cat.pk).count()
+1
+>>> TenantMiddleware().process_response(request, None)
+
+Cache versions and report jobs are kept per ledger.
+
+>>> caching.scoped('month:2008-10', alice.pk) == 'owner:%s:month:2008-10' % alice.pk
+True
+>>> caching.scoped('month:2008-10', None)
+'month:2008-10'
+>>> job = tenancy.as_owner(alice, ReportJob.objects.request, 'budget.views.summary_year_context', year=2008)
+>>> other_job = tenancy.as_owner(bob, ReportJob.objects.request, 'budget.views.summary_year_context', year=2008)
+>>> job.owner == alice, other_job.owner == bob, job.key != other_job.key
+(True, True, True)
+>>> ReportJob.objects.all().delete()
+
+Outside of a request nothing is scoped.
+
+>>> Category.active.filter(slug='food').count()
+2
+>>> call_command('budget_tenants', 'create')
+The owner columns already exist.
+
+>>> Transaction.objects.filter(pk=alice_lunch.pk).delete()
+>>> Budget.objects.filter(pk=alice_budget.pk).delete()
+>>> Category.objects.filter(slug='food').delete()
+
+Installs which predate ledgers have no owner columns and a unique index on
+the slug alone, which ``budget_tenants create`` swaps for one per owner.
+
+>>> from django.db import connection
+>>> cursor = connection.cursor()
+>>> def execute(*statements):
+...     for statement in statements:
+...         cursor.execute(statement)
+>>> category_count = Category.objects.count()
+>>> execute('CREATE TABLE categories_category_copy AS SELECT id, created, updated, is_deleted, name, slug FROM categories_category',
+...     'DROP TABLE categories_category',
+...     'CREATE TABLE categories_category (id integer NOT NULL PRIMARY KEY, created datetime NOT NULL, updated datetime NOT NULL, is_deleted bool NOT NULL, name varchar(128) NOT NULL, slug varchar(50) NOT NULL UNIQUE)',
+...     'INSERT INTO categories_category SELECT * FROM categories_category_copy',
+...     'DROP TABLE categories_category_copy')
+>>> call_command('budget_tenants', 'create')
+Added owner columns to categories_category.
+Made slugs unique per owner in categories_category.
+>>> connection.introspection.get_indexes(cursor, 'categories_category')['slug']['unique']
+False
+>>> Category.objects.count() == category_count
+True
+>>> alice_food = tenancy.as_owner(alice, Category.objects.create, name='Food', slug='food')
+>>> bob_food = tenancy.as_owner(bob, Category.objects.create, name='Food', slug='food')
+>>> call_command('budget_tenants', 'create')
+The owner columns already exist.
+>>> Category.objects.filter(slug='food').delete()
+
+>>> User.objects.filter(pk__in=[alice.pk, bob.pk]).delete()
+>>> settings.BUDGET_MULTI_TENANT = old_tenancy
+
+Without ledgers every row is in the shared ledger, so slugs stay unique
+across all of them, soft-deleted ones included, in the forms and the admin.
+
+>>> from django.forms.models import modelform_factory
+>>> from budget.categories.forms import SlugAdminForm
+>>> old_food = Category.objects.create(name='Food', slug='food', is_deleted=True)
+>>> CategoryForm({'name': 'Food'}).errors['name']
+[u'A category with this name already exists.']
+>>> CategoryAdminForm = modelform_factory(Category, form=SlugAdminForm, fields=('name', 'slug'))
+>>> CategoryAdminForm({'name': 'Food', 'slug': 'food'}).errors['slug']
+[u'This slug is already in use.']
+>>> CategoryAdminForm({'name': 'Food', 'slug': 'food'}, instance=old_food).is_valid()
+True
+>>> from budget.forms import BudgetForm
+>>> BudgetForm({'name': 'Test Budget'}).errors['name']
+[u'A budget with this name already exists.']
+>>> Category.objects.filter(pk=old_food.pk).delete()
+
+
+# API
+
+Objects are created, read, changed and deleted as JSON.
+
+>>> r = c.post('/budget/api/categories/', simplejson.dumps({'name': 'Books'}), content_type='application/json')
+>>> r.status_code, r['Location']
+(201, 'http://testserver/budget/api/categories/books/')
+>>> r = c.post('/budget/api/budgets/', {'name': 'Reading', 'start_date': '2007-01-01 00:00:00'})
+>>> r.status_code, simplejson.loads(r.content)['start_date']
+(201, u'2007-01-01 00:00:00')
+>>> r = c.post('/budget/api/budgets/reading/estimates/', simplejson.dumps({'category': 'books', 'amount': '20.00'}), content_type='application/json')
+>>> r.status_code
+201
+>>> estimate_url = r['Location']
+>>> r = c.post('/budget/api/transactions/', simplejson.dumps({'category': 'books', 'notes': 'Novel', 'amount': '12.50', 'date': '2007-03-04', 'transaction_type': 'expense'}), content_type='application/json')
+>>> r.status_code
+201
+>>> transaction_url = r['Location']
+>>> r = c.post('/budget/api/transactions/', simplejson.dumps({'category': 'nope', 'amount': 'x'}), content_type='application/json')
+>>> r.status_code, sorted(simplejson.loads(r.content)['errors'].keys())
+(400, [u'amount', u'category', u'date', u'transaction_type'])
+
+Updates only need the fields which change.
+
+>>> r = c.post(transaction_url, simplejson.dumps({'amount': '14.00'}), content_type='application/json')
+>>> row = simplejson.loads(r.content)
+>>> row['notes'], row['amount'], row['category'], row['date']
+(u'Novel', u'14.00', u'books', u'2007-03-04')
+>>> r = c.post(estimate_url, {'amount': '25.00'})
+>>> simplejson.loads(r.content)['amount']
+u'25.00'
+>>> [row['notes'] for row in simplejson.loads(c.get('/budget/api/transactions/', {'category': 'books'}).content)['objects']]
+[u'Novel']
+
+Reports mirror ``Budget.estimates_and_transactions``.
+
+>>> r = c.get('/budget/api/reports/2007/3/')
+>>> report = simplejson.loads(r.content)
+>>> report['budget']['slug'], report['actual_total'], report['start_date'], report['end_date']
+(u'reading', u'14.00', u'2007-03-01', u'2007-03-31')
+>>> [(group['estimate']['category'], group['actual_amount'], [row['notes'] for row in group['transactions']]) for group in report['estimates']]
+[(u'books', u'14.00', [u'Novel'])]
+
+Every response has an ``ETag`` and ``Last-Modified``, so polling unchanged
+data gets a 304 without building the response.
+
+>>> etag = r['ETag']
+>>> r = c.get('/budget/api/reports/2007/3/', HTTP_IF_NONE_MATCH=etag)
+>>> r.status_code, r.content
+(304, '')
+>>> r = c.get('/budget/api/reports/2007/3/', HTTP_IF_MODIFIED_SINCE=r['Last-Modified'])
+>>> r.status_code
+304
+>>> c.get('/budget/api/reports/2007/4/', HTTP_IF_NONE_MATCH=etag).status_code
+200
+>>> r = c.delete(transaction_url)
+>>> r.status_code
+204
+>>> r = c.get('/budget/api/reports/2007/3/', HTTP_IF_NONE_MATCH=etag)
+>>> r.status_code, simplejson.loads(r.content)['actual_total']
+(200, u'0.0')
+>>> etag = c.get('/budget/api/categories/books/')['ETag']
+>>> c.get('/budget/api/categories/books/', HTTP_IF_NONE_MATCH=etag).status_code
+304
+>>> r = c.put('/budget/api/categories/books/', simplejson.dumps({'name': 'Reading'}), content_type='application/json')
+>>> r.status_code, simplejson.loads(r.content)['name']
+(200, u'Reading')
+>>> c.get('/budget/api/categories/books/', HTTP_IF_NONE_MATCH=etag).status_code
+200
+
+>>> rows = [{'category': 'books', 'notes': 'Atlas', 'amount': '30.00', 'date': '2007-05-01', 'transaction_type': 'expense'}, {'notes': 'Mystery', 'amount': '1.00'}]
+>>> r = c.post('/budget/api/transactions/batch/', simplejson.dumps({'transactions': rows}), content_type='application/json')
+>>> errors = simplejson.loads(r.content)['errors']['rows']
+>>> r.status_code, errors[0], sorted(errors[1].keys())
+(400, {}, [u'category', u'date', u'transaction_type'])
+>>> r = c.post('/budget/api/transactions/batch/', simplejson.dumps({'transactions': rows[:1] * 3}), content_type='application/json')
+>>> r.status_code, r.content
+(201, '{"created": 3}')
+>>> Transaction.active.filter(notes='Atlas').count()
+3
+
+>>> Transaction.objects.filter(category__slug='books').delete()
+>>> BudgetEstimate.objects.filter(budget__slug='reading').delete()
+>>> Budget.objects.filter(slug='reading').delete()
+>>> Category.objects.filter(slug='books').delete()
+
+
+# Colors
+
+The color thresholds are compiled once into sorted decimals and searched
+with a binary search.
+
+>>> from django.template import Context, Template
+>>> from budget.templatetags.budget import colorize_estimates, get_color_table
+>>> colors = get_color_table()
+>>> [colors.color(Decimal('100'), actual) for actual in ('0', '74.99', '75', '100', '100.1', '100.11')]
+['green', 'green', 'yellow', 'yellow', 'red', 'red']
+>>> colors.color(Decimal('0'), Decimal('10')), colors.color(Decimal('100'), Decimal('-5'))
+('', '')
+>>> Template('{% load budget %}{% colorize_amount estimate actual %}|{% colorize_amount estimate missing %}').render(Context({'estimate': Decimal('10'), 'actual': 9}))
+u'yellow|'
+
+Whole reports can be colored in one go.
+
+>>> report = [{'estimate': BudgetEstimate(amount=Decimal('10')), 'actual_amount': Decimal('2')}, {'estimate': BudgetEstimate(amount=Decimal('10')), 'actual_amount': Decimal('20')}]
+>>> [eat_group['color'] for eat_group in colorize_estimates(report)], 'color' in report[0]
+(['green', 'red'], False)
+>>> Template('{% load budget %}{% for eat_group in report|colorize_estimates:"yearly_estimated_amount" %}{{ eat_group.color }} {% endfor %}').render(Context({'report': report}))
+u'green green '
+
+Replacing the setting compiles a new table.
+
+>>> old_colors = getattr(settings, 'BUDGET_DEFAULT_COLORS', None)
+>>> settings.BUDGET_DEFAULT_COLORS = ((0.5, 'over'), (0, 'under'))
+>>> get_color_table().color(Decimal('10'), Decimal('6'))
+'over'
+>>> settings.BUDGET_DEFAULT_COLORS = old_colors
+>>> if old_colors is None:
+...     del settings._wrapped.BUDGET_DEFAULT_COLORS
+>>> get_color_table() is colors
+False
+
+
+# Cleanup
+
+The rows above are committed along the way, so remove them for the other
+apps' tests.
+
+>>> Transaction.objects.all().delete()
+>>> BudgetEstimate.objects.all().delete()
+>>> Budget.objects.all().delete()
+>>> Category.objects.all().delete()
 """
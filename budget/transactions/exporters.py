@@ -0,0 +1,113 @@
+"""
+Streaming CSV and JSON lines writers for transactions.
+
+Transactions are read in chunks, keyed on ``(date, id)`` rather than using
+``OFFSET``, and every writer is a generator producing one line at a time, so
+exports of any size run in constant memory.
+"""
+import csv
+from StringIO import StringIO
+from django.db.models import Q
+from django.utils import simplejson
+from django.utils.encoding import smart_str
+from budget.transactions.models import partitioning_enabled
+
+
+TRANSACTION_FIELDS = ('id', 'date', 'transaction_type', 'category', 'amount', 'notes')
+
+
+def filter_transactions(queryset, start_date=None, end_date=None, transaction_type=None, category=None):
+    if start_date:
+        queryset = queryset.filter(date__gte=start_date)
+
+        if partitioning_enabled():
+            queryset = queryset.filter(year__gte=start_date.year)
+
+    if end_date:
+        queryset = queryset.filter(date__lte=end_date)
+
+        if partitioning_enabled():
+            queryset = queryset.filter(year__lte=end_date.year)
+
+    if transaction_type:
+        queryset = queryset.filter(transaction_type=transaction_type)
+
+    if category:
+        queryset = queryset.filter(category=category)
+
+    return queryset
+
+
+def iterate_in_chunks(queryset, chunk_size=1000):
+    """
+    Yields every object in the queryset ordered by ``(date, id)``, fetching
+    ``chunk_size`` rows per query.
+    """
+    queryset = queryset.select_related('category').order_by('date', 'id')
+    last = None
+
+    while True:
+        chunk = queryset
+
+        if last is not None:
+            chunk = chunk.filter(Q(date__gt=last.date) | Q(date=last.date, id__gt=last.id))
+
+        count = 0
+
+        for obj in chunk[:chunk_size].iterator():
+            count += 1
+            last = obj
+            yield obj
+
+        if count < chunk_size:
+            break
+
+
+def transaction_row(transaction):
+    return {
+        'id': transaction.id,
+        'date': transaction.date.isoformat(),
+        'transaction_type': transaction.transaction_type,
+        'category': transaction.category.slug,
+        'amount': str(transaction.amount),
+        'notes': transaction.notes,
+    }
+
+
+def csv_lines(rows, fields):
+    """
+    Turns dictionaries into CSV lines, starting with a header line.
+    """
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+
+    for row in rows:
+        writer.writerow([smart_str(row[field]) for field in fields])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+    if buffer.getvalue():
+        yield buffer.getvalue()
+
+
+def json_lines(rows):
+    """
+    Turns dictionaries into JSON lines, one object per line.
+    """
+    for row in rows:
+        yield simplejson.dumps(row) + '\n'
+
+
+def export_transactions(queryset, format='csv', chunk_size=1000):
+    """
+    Returns a generator of lines exporting the transactions as either
+    ``csv`` or ``json`` (lines).
+    """
+    rows = (transaction_row(transaction) for transaction in iterate_in_chunks(queryset, chunk_size))
+
+    if format == 'json':
+        return json_lines(rows)
+
+    return csv_lines(rows, TRANSACTION_FIELDS)
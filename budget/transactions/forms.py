@@ -1,8 +1,236 @@
+import datetime
 from django import forms
-from budget.transactions.models import Transaction
+from django.forms.formsets import BaseFormSet, formset_factory
+from django.forms.util import ErrorList
+from budget.categories.choices import CategoryChoiceField, get_category_choices
+from budget.categories.rules import categorize, get_matcher
+from budget.transactions.exporters import filter_transactions
+from budget.transactions.models import Transaction, TRANSACTION_TYPES, insert_transactions
 
 
 class TransactionForm(forms.ModelForm):
+    """
+    Leaving the category blank picks one with the active ``CategoryRule``
+    objects.
+    """
+    category = CategoryChoiceField(required=False)
+
+    def clean(self):
+        cleaned_data = super(TransactionForm, self).clean()
+
+        if not cleaned_data.get('category') and 'category' not in self._errors:
+            category = self.categorize(cleaned_data.get('notes'), cleaned_data.get('amount'), cleaned_data.get('transaction_type'))
+
+            if category is None:
+                self._errors['category'] = ErrorList([self.fields['category'].error_messages['required']])
+            else:
+                cleaned_data['category'] = category
+
+        return cleaned_data
+
+    def categorize(self, notes, amount, transaction_type):
+        return categorize(notes, amount, transaction_type)
+
     class Meta:
         model = Transaction
         fields = ('transaction_type', 'notes', 'category', 'amount', 'date')
+
+
+class TransactionExportForm(forms.Form):
+    start_date = forms.DateField(required=False)
+    end_date = forms.DateField(required=False)
+    transaction_type = forms.ChoiceField(choices=(('', '---------'),) + TRANSACTION_TYPES, required=False)
+    category = CategoryChoiceField(to_field_name='slug', required=False)
+
+
+BULK_ACTIONS = (
+    ('recategorize', 'Change the category'),
+    ('retype', 'Change the transaction type'),
+    ('delete', 'Delete'),
+    ('restore', 'Restore'),
+)
+
+
+class TransactionBulkForm(TransactionExportForm):
+    """
+    Picks out transactions by the export filters (plus the text of their
+    notes) and what to do with all of them.
+    """
+    notes = forms.CharField(required=False)
+    action = forms.ChoiceField(choices=BULK_ACTIONS)
+    new_category = CategoryChoiceField(to_field_name='slug', required=False)
+    new_transaction_type = forms.ChoiceField(choices=(('', '---------'),) + TRANSACTION_TYPES, required=False)
+
+    def clean(self):
+        cleaned_data = self.cleaned_data
+        filters = [cleaned_data.get(name) for name in ('start_date', 'end_date', 'transaction_type', 'category', 'notes')]
+
+        if not [value for value in filters if value]:
+            raise forms.ValidationError('Choose at least one filter, so every transaction is not changed by mistake.')
+
+        if cleaned_data.get('action') == 'recategorize' and not cleaned_data.get('new_category'):
+            raise forms.ValidationError('Choose the new category.')
+
+        if cleaned_data.get('action') == 'retype' and not cleaned_data.get('new_transaction_type'):
+            raise forms.ValidationError('Choose the new transaction type.')
+
+        return cleaned_data
+
+    def filter(self, queryset):
+        """
+        Narrows the queryset down to the chosen transactions.
+        """
+        cleaned_data = self.cleaned_data
+
+        if cleaned_data['action'] == 'restore':
+            queryset = queryset.filter(is_deleted=True)
+        else:
+            queryset = queryset.filter(is_deleted=False)
+
+        if cleaned_data['notes']:
+            queryset = queryset.filter(notes__icontains=cleaned_data['notes'])
+
+        return filter_transactions(queryset, cleaned_data['start_date'], cleaned_data['end_date'], cleaned_data['transaction_type'], cleaned_data['category'])
+
+    def values(self):
+        """
+        The field values to set, as accepted by ``update_transactions``.
+        """
+        action = self.cleaned_data['action']
+
+        if action == 'recategorize':
+            return {'category': self.cleaned_data['new_category']}
+
+        if action == 'retype':
+            return {'transaction_type': self.cleaned_data['new_transaction_type']}
+
+        return {'is_deleted': action == 'delete'}
+
+
+# The most rows a single batch may hold.
+MAX_BATCH_ROWS = 5000
+
+
+class TransactionBatchRowForm(TransactionForm):
+    """
+    One row of a batch, validated like ``TransactionForm``.
+
+    The category is given by slug and looked up in the batch's categories
+    rather than with a query per row, and a blank one is picked by the
+    batch's rule matcher.
+    """
+    category = forms.CharField(required=False, widget=forms.Select)
+
+    def __init__(self, *args, **kwargs):
+        self.batch = kwargs.pop('batch')
+        super(TransactionBatchRowForm, self).__init__(*args, **kwargs)
+        # The model's default is a callable, which Django compares against a
+        # hidden initial value. Use today's date so rows left at it still
+        # count as blank.
+        self.fields['date'].initial = datetime.date.today()
+        self.fields['date'].show_hidden_initial = False
+        self.fields['category'].widget.choices = self.batch.category_choices
+
+    def clean_category(self):
+        slug = self.cleaned_data['category']
+
+        if not slug:
+            return None
+
+        try:
+            return self.batch.categories[slug]
+        except KeyError:
+            raise forms.ValidationError('Select a valid choice. That choice is not one of the available choices.')
+
+    def categorize(self, notes, amount, transaction_type):
+        return self.batch.matcher.categorize(notes, amount, transaction_type)
+
+    def transaction(self):
+        return self.save(commit=False)
+
+
+class BaseTransactionBatchFormSet(BaseFormSet):
+    """
+    Many rows of new transactions, entered together.
+
+    The categories and the rule matcher are fetched once for the whole batch,
+    and ``save`` inserts every row with ``insert_transactions``.
+    """
+    def __init__(self, *args, **kwargs):
+        choices = get_category_choices()
+        self.categories = choices.by_slug
+        self.category_choices = [('', '---------')] + choices.choices('slug')
+        self.matcher = get_matcher()
+        super(BaseTransactionBatchFormSet, self).__init__(*args, **kwargs)
+
+    def total_form_count(self):
+        # Django only caps the rows of unbound formsets, so without this a
+        # bound one would build a form for as many rows as the client claims
+        # before ``clean`` turned them down.
+        if self.too_many():
+            return 0
+
+        return super(BaseTransactionBatchFormSet, self).total_form_count()
+
+    def too_many(self):
+        return self.is_bound and self.management_form.cleaned_data['TOTAL_FORMS'] > MAX_BATCH_ROWS
+
+    def is_valid(self):
+        # Django only cleans the formset when it reads a form's errors, and
+        # a batch turned down for its size has no forms.
+        if self.is_bound and self._errors is None:
+            self.full_clean()
+
+        return super(BaseTransactionBatchFormSet, self).is_valid()
+
+    def _construct_form(self, i, **kwargs):
+        kwargs['batch'] = self
+        return super(BaseTransactionBatchFormSet, self)._construct_form(i, **kwargs)
+
+    def clean(self):
+        if self.too_many():
+            raise forms.ValidationError('Enter at most %d transactions at once.' % MAX_BATCH_ROWS)
+
+        if not [form for form in self.forms if form.has_changed()]:
+            raise forms.ValidationError('Enter at least one transaction.')
+
+    def transactions(self):
+        """
+        The new ``Transaction`` objects for the rows which were filled in.
+        """
+        return [form.transaction() for form in self.forms if form.is_valid() and form.cleaned_data]
+
+    def save(self):
+        """
+        Inserts every row, returning how many were added. Transaction
+        management is left to the caller.
+        """
+        return insert_transactions(self.transactions())
+
+    def row_errors(self):
+        """
+        A dictionary of field errors for each row, in order.
+        """
+        return [dict([(name, [unicode(error) for error in field_errors]) for name, field_errors in form.errors.items()]) for form in self.forms]
+
+
+TransactionBatchFormSet = formset_factory(TransactionBatchRowForm, formset=BaseTransactionBatchFormSet, extra=10, max_num=MAX_BATCH_ROWS)
+
+
+def batch_data(rows, prefix='form'):
+    """
+    Turns a list of row dictionaries (as sent to the JSON API) into the
+    data for a ``TransactionBatchFormSet``. Unlike the extra rows of the
+    form, none of these may be left blank.
+    """
+    data = {
+        '%s-TOTAL_FORMS' % prefix: str(len(rows)),
+        '%s-INITIAL_FORMS' % prefix: str(len(rows)),
+    }
+
+    for index, row in enumerate(rows):
+        for name, value in row.items():
+            if value is not None:
+                data['%s-%d-%s' % (prefix, index, name)] = unicode(value)
+
+    return data
@@ -0,0 +1,233 @@
+"""
+Streaming readers for bank statements and the pipeline that turns their rows
+into ``Transaction`` objects.
+
+Every stage is a generator, so only one batch of rows is ever held in memory
+regardless of the size of the file.
+"""
+import csv
+import re
+from decimal import Decimal, InvalidOperation
+from django import forms
+from django.utils.encoding import force_unicode
+from budget.categories.choices import get_category_choices
+from budget.categories.models import CategoryRule
+from budget.categories.rules import RuleMatcher, get_matcher
+from budget.transactions.forms import TransactionForm
+from budget.transactions.models import Transaction
+
+
+class BudgetImportError(Exception):
+    pass
+
+
+def read_csv(fileobj):
+    """
+    Reads a CSV file with a header row.
+
+    The ``date`` and ``amount`` columns are required; ``notes``, ``category``
+    (a slug) and ``transaction_type`` are optional.
+    """
+    for row in csv.DictReader(fileobj):
+        yield dict([(key.strip().lower(), (value or '').strip()) for key, value in row.items() if key])
+
+
+def read_qif(fileobj):
+    """
+    Reads a Quicken Interchange Format file.
+
+    Payees and memos are joined into the notes, and the category (``L``) is
+    treated as a slug.
+    """
+    record = {}
+
+    for line in fileobj:
+        line = line.strip()
+
+        if not line or line.startswith('!'):
+            continue
+
+        code, value = line[0], line[1:].strip()
+
+        if code == '^':
+            if record:
+                yield record
+            record = {}
+        elif code == 'D':
+            # Quicken writes years after 1999 as 1/2'09.
+            record['date'] = value.replace("'", '/20').replace(' ', '')
+        elif code in ('T', 'U'):
+            record['amount'] = value.replace(',', '')
+        elif code in ('P', 'M'):
+            record['notes'] = ' '.join([part for part in (record.get('notes'), value) if part])
+        elif code == 'L':
+            record['category'] = value
+
+    if record:
+        yield record
+
+
+OFX_TAG_RE = re.compile(r'<(/?)([A-Za-z0-9.]+)>([^<]*)')
+
+
+def ofx_tokens(fileobj, chunk_size=64 * 1024):
+    """
+    Splits an OFX file (either the SGML or the XML flavor) into
+    ``(is_closing, tag, value)`` tuples, reading it a chunk at a time.
+    """
+    buffer = ''
+
+    while True:
+        chunk = fileobj.read(chunk_size)
+        buffer += chunk
+        last_tag = buffer.rfind('<')
+
+        # Hold back the last (possibly incomplete) tag until more data comes
+        # in, unless the file is done.
+        if chunk and last_tag > 0:
+            complete, buffer = buffer[:last_tag], buffer[last_tag:]
+        elif chunk:
+            continue
+        else:
+            complete, buffer = buffer, ''
+
+        for match in OFX_TAG_RE.finditer(complete):
+            yield (bool(match.group(1)), match.group(2).upper(), match.group(3).strip())
+
+        if not chunk:
+            break
+
+
+def read_ofx(fileobj):
+    """
+    Reads the statement transactions (``STMTTRN``) out of an OFX file.
+    """
+    record = None
+
+    for is_closing, tag, value in ofx_tokens(fileobj):
+        if tag == 'STMTTRN':
+            if is_closing and record is not None:
+                yield record
+                record = None
+            elif not is_closing:
+                record = {}
+        elif record is not None and not is_closing:
+            if tag == 'DTPOSTED':
+                record['date'] = '%s-%s-%s' % (value[0:4], value[4:6], value[6:8])
+            elif tag == 'TRNAMT':
+                record['amount'] = value
+            elif tag in ('NAME', 'MEMO'):
+                record['notes'] = ' '.join([part for part in (record.get('notes'), value) if part])
+
+
+READERS = {
+    'csv': read_csv,
+    'qif': read_qif,
+    'ofx': read_ofx,
+}
+
+
+class CategoryResolver(object):
+    """
+    Maps imported rows to categories.
+
+    Categories come from the cached category choices. A row's own ``category`` slug wins,
+    then the first of the given ``(text, slug)`` rules whose text appears in
+    the notes, then the active ``CategoryRule`` objects, then the default.
+    Both sets of rules are compiled into a ``RuleMatcher``.
+    """
+    def __init__(self, rules=None, default=None):
+        self.categories = get_category_choices().by_slug
+        self.default = None
+        self.matcher = RuleMatcher([CategoryRule(pattern=text, category=self.get(slug)) for text, slug in rules or []])
+        self.rule_matcher = get_matcher()
+
+        if default:
+            self.default = self.get(default)
+
+    def get(self, slug):
+        try:
+            return self.categories[slug]
+        except KeyError:
+            raise BudgetImportError("Unknown category '%s'." % slug)
+
+    def resolve(self, row, amount=None, transaction_type=None):
+        if row.get('category'):
+            return self.categories.get(row['category'])
+
+        notes = row.get('notes', '')
+
+        for matcher in (self.matcher, self.rule_matcher):
+            category = matcher.categorize(notes, amount, transaction_type)
+
+            if category is not None:
+                return category
+
+        return self.default
+
+
+def clean_row(row, resolver):
+    """
+    Validates a row with the same fields ``TransactionForm`` uses and turns it
+    into an unsaved ``Transaction``.
+
+    Amounts without a ``transaction_type`` are treated the way banks write
+    them: negative amounts are expenses and positive amounts are incomes.
+
+    Raises ``forms.ValidationError`` if the row is invalid.
+    """
+    fields = TransactionForm.base_fields
+    data = {
+        'notes': fields['notes'].clean(row.get('notes', '')[:255]),
+        'date': fields['date'].clean(row.get('date')),
+    }
+
+    try:
+        amount = Decimal(row.get('amount') or '')
+    except InvalidOperation:
+        raise forms.ValidationError("'%s' is not a valid amount." % row.get('amount'))
+
+    if row.get('transaction_type'):
+        data['transaction_type'] = fields['transaction_type'].clean(row['transaction_type'].lower())
+    elif amount < 0:
+        data['transaction_type'] = 'expense'
+    else:
+        data['transaction_type'] = 'income'
+
+    data['amount'] = fields['amount'].clean(abs(amount))
+    category = resolver.resolve(row, data['amount'], data['transaction_type'])
+
+    if category is None:
+        raise forms.ValidationError("No category found for '%s'." % data['notes'])
+
+    return Transaction(category=category, **data)
+
+
+def clean_rows(rows, resolver):
+    """
+    Yields ``(line_number, transaction, errors)`` for every row, where exactly
+    one of ``transaction`` and ``errors`` is ``None``.
+    """
+    line_number = 0
+
+    for row in rows:
+        line_number += 1
+
+        try:
+            yield (line_number, clean_row(row, resolver), None)
+        except forms.ValidationError, e:
+            yield (line_number, None, [force_unicode(message) for message in e.messages])
+
+
+def batches(iterable, size):
+    batch = []
+
+    for item in iterable:
+        batch.append(item)
+
+        if len(batch) >= size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
@@ -1,10 +1,16 @@
 import datetime
 from decimal import Decimal
 
-from django.db import models
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, models, IntegrityError
+from django.db.models import F, Q, Sum
 from django.utils.translation import ugettext_lazy as _
 
+from budget import tenancy
+from budget.caching import caching_enabled
 from budget.categories.models import Category, StandardMetadata, ActiveManager
+from budget.transactions.signals import transaction_changed, transactions_bulk_changed
 
 
 TRANSACTION_TYPES = (
@@ -13,9 +19,97 @@ TRANSACTION_TYPES = (
 )
 
 
+def first_of_month(date):
+    return datetime.date(date.year, date.month, 1)
+
+
+def rollups_enabled():
+    return getattr(settings, 'BUDGET_USE_ROLLUPS', False)
+
+
+def ledger_enabled():
+    return getattr(settings, 'BUDGET_USE_LEDGER', False)
+
+
+def partitioning_enabled():
+    return getattr(settings, 'BUDGET_PARTITION_BY_YEAR', False)
+
+
+def previous_rows_needed():
+    """
+    Whether saves look up the row as it was before, which only the rollups,
+    the ledger and the shared cache use.
+    """
+    return rollups_enabled() or ledger_enabled() or caching_enabled()
+
+
+_year_column_checked = False
+
+
+def has_year_column():
+    cursor = connection.cursor()
+    columns = [row[0] for row in connection.introspection.get_table_description(cursor, Transaction._meta.db_table)]
+    return 'year' in columns
+
+
+def require_year_column():
+    """
+    Raises ``ImproperlyConfigured`` if the transactions table predates the
+    ``year`` column, rather than letting every query fail with a database
+    error. Only checked once per process.
+    """
+    global _year_column_checked
+    
+    if _year_column_checked:
+        return
+    
+    if not has_year_column():
+        raise ImproperlyConfigured("The %s table has no year column. Add it with './manage.py budget_partitions create' and fill it in with './manage.py budget_partitions backfill'." % Transaction._meta.db_table)
+    
+    _year_column_checked = True
+
+
+def year_of(date):
+    """
+    The year bucket a transaction dated ``date`` (a date or a string) goes in.
+    """
+    return Transaction._meta.get_field('date').to_python(date).year
+
+
+def filter_dates(queryset, start_date, end_date, partitioned=None):
+    """
+    Narrows a queryset of transactions to a date range.
+    
+    When ``BUDGET_PARTITION_BY_YEAR`` is enabled (or ``partitioned`` is
+    ``True``) the range is also routed to its year buckets, so the database
+    only reads the slices of the year-led partition index covering those
+    years rather than the whole table.
+    """
+    queryset = queryset.filter(date__range=(start_date, end_date))
+    
+    if partitioned is None:
+        partitioned = partitioning_enabled()
+    
+    if partitioned:
+        queryset = queryset.filter(year__in=range(start_date.year, end_date.year + 1))
+    
+    return queryset
+
+
 class TransactionManager(ActiveManager):
+    def get_query_set(self):
+        require_year_column()
+        return super(TransactionManager, self).get_query_set()
+    
     def get_latest(self, limit=10):
-        return self.get_query_set().order_by('-date', '-created')[0:limit]
+        return self.get_query_set().select_related('category').order_by('-date', '-created')[0:limit]
+    
+    def between(self, start_date, end_date):
+        """
+        The transactions from ``start_date`` to ``end_date`` inclusive, routed
+        to their year buckets when partitioning is enabled.
+        """
+        return filter_dates(self.get_query_set(), start_date, end_date)
 
 
 class TransactionExpenseManager(TransactionManager):
@@ -42,15 +136,578 @@ class Transaction(StandardMetadata):
     category = models.ForeignKey(Category, verbose_name=_('Category'))
     amount = models.DecimalField(_('Amount'), max_digits=11, decimal_places=2)
     date = models.DateField(_('Date'), default=datetime.date.today, db_index=True)
+    # The year bucket of ``date``, which leads the partition index.
+    year = models.PositiveSmallIntegerField(_('Year'), null=True, editable=False)
     
     objects = models.Manager()
-    active = ActiveManager()
+    active = TransactionManager()
     expenses = TransactionExpenseManager()
     incomes = TransactionIncomeManager()
     
     def __unicode__(self):
         return u"%s (%s) - %s" % (self.notes, self.get_transaction_type_display(), self.amount)
     
+    def save(self, *args, **kwargs):
+        previous = None
+        
+        if self.pk and previous_rows_needed():
+            try:
+                previous = self.__class__.objects.filter(pk=self.pk).values('category', 'date', 'transaction_type', 'amount', 'is_deleted')[0]
+            except IndexError:
+                pass
+        
+        require_year_column()
+        self.year = year_of(self.date)
+        super(Transaction, self).save(*args, **kwargs)
+        transaction_changed.send(sender=self.__class__, instance=self, previous=previous)
+    
+    def as_row(self):
+        """
+        Returns the transaction in the same shape as the ``previous`` row sent
+        with ``transaction_changed``, with values converted to Python types.
+        """
+        return {
+            'category': self.category_id,
+            'date': self._meta.get_field('date').to_python(self.date),
+            'transaction_type': self.transaction_type,
+            'amount': self._meta.get_field('amount').to_python(self.amount),
+            'is_deleted': self.is_deleted,
+        }
+    
     class Meta:
         verbose_name = _('Transaction')
         verbose_name_plural = _('Transactions')
+
+
+def insert_transactions(transactions):
+    """
+    Inserts many new ``Transaction`` objects with a single ``executemany``,
+    skipping the per-row ``save``.
+    
+    Listeners are told about the whole batch at once through
+    ``transactions_bulk_changed``. Primary keys are not set on the objects
+    and transaction management is left to the caller.
+    """
+    if not transactions:
+        return 0
+    
+    opts = Transaction._meta
+    fields = [field for field in opts.local_fields if not isinstance(field, models.AutoField)]
+    qn = connection.ops.quote_name
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+        qn(opts.db_table),
+        ', '.join([qn(field.column) for field in fields]),
+        ', '.join(['%s'] * len(fields)),
+    )
+    params = []
+    deltas = {}
+    rows = []
+    owner_id = tenancy.get_current_owner_id()
+    require_year_column()
+    
+    for transaction in transactions:
+        transaction.year = year_of(transaction.date)
+        
+        if transaction.owner_id is None:
+            transaction.owner_id = owner_id
+        
+        params.append([field.get_db_prep_save(field.pre_save(transaction, True)) for field in fields])
+        row = transaction.as_row()
+        rows.append((None, row))
+        
+        for key, (amount, count) in rollup_deltas(None, row).items():
+            total, total_count = deltas.get(key, (Decimal('0.0'), 0))
+            deltas[key] = (total + amount, total_count + count)
+    
+    cursor = connection.cursor()
+    cursor.executemany(sql, params)
+    transactions_bulk_changed.send(sender=Transaction, deltas=deltas, rows=rows)
+    return len(params)
+
+
+BULK_UPDATE_FIELDS = ('category', 'transaction_type', 'is_deleted')
+
+
+def update_transactions(queryset, batch_size=1000, **values):
+    """
+    Sets ``values`` (any of ``category``, ``transaction_type`` and
+    ``is_deleted``) on every transaction in the queryset, with one ``UPDATE``
+    per ``batch_size`` rows instead of a ``save`` per row. ``updated`` is
+    stamped just as ``StandardMetadata.save`` would, and rows which already
+    have the values are skipped.
+    
+    Listeners are told about each batch at once through
+    ``transactions_bulk_changed``. Returns the number of rows changed.
+    """
+    for name in values:
+        if name not in BULK_UPDATE_FIELDS:
+            raise ValueError("'%s' can't be changed in bulk." % name)
+    
+    changes = values.copy()
+    
+    if isinstance(changes.get('category'), Category):
+        changes['category'] = changes['category'].pk
+    
+    rows = queryset.exclude(**values).order_by('id').values_list('id', 'category', 'date', 'transaction_type', 'amount', 'is_deleted')
+    updated = 0
+    last_id = None
+    
+    while True:
+        batch = rows
+        
+        if last_id is not None:
+            batch = batch.filter(id__gt=last_id)
+        
+        batch = list(batch[:batch_size])
+        
+        if not batch:
+            break
+        
+        last_id = batch[-1][0]
+        updated += Transaction.objects.filter(pk__in=[row[0] for row in batch]).update(updated=datetime.datetime.now(), **values)
+        deltas = {}
+        changed_rows = []
+        
+        for pk, category_id, date, transaction_type, amount, is_deleted in batch:
+            previous = {
+                'category': category_id,
+                'date': date,
+                'transaction_type': transaction_type,
+                'amount': amount,
+                'is_deleted': is_deleted,
+            }
+            current = previous.copy()
+            current.update(changes)
+            changed_rows.append((previous, current))
+            
+            for key, (delta, count) in rollup_deltas(previous, current).items():
+                total, total_count = deltas.get(key, (Decimal('0.0'), 0))
+                deltas[key] = (total + delta, total_count + count)
+        
+        transactions_bulk_changed.send(sender=Transaction, deltas=deltas, rows=changed_rows)
+        
+        if len(batch) < batch_size:
+            break
+    
+    return updated
+
+
+def rollup_deltas(previous, current):
+    """
+    Works out how the rollup totals change when a transaction row goes from
+    ``previous`` to ``current`` (either may be ``None``).
+    
+    Returns a dictionary of ``(category_id, month, transaction_type)`` to
+    ``(amount, count)``.
+    """
+    deltas = {}
+    
+    for row, sign in ((previous, -1), (current, 1)):
+        if row is None or row['is_deleted']:
+            continue
+        
+        key = (row['category'], first_of_month(row['date']), row['transaction_type'])
+        amount, count = deltas.get(key, (Decimal('0.0'), 0))
+        deltas[key] = (amount + sign * row['amount'], count + sign)
+    
+    for key, (amount, count) in deltas.items():
+        if amount == 0 and count == 0:
+            del deltas[key]
+    
+    return deltas
+
+
+class TransactionRollupManager(models.Manager):
+    def adjust(self, category_id, month, transaction_type, amount, count):
+        """
+        Adds ``amount`` and ``count`` to a single rollup row, creating it if
+        needed.
+        """
+        rollups = self.filter(category=category_id, month=month, transaction_type=transaction_type)
+        
+        if rollups.update(total=F('total') + amount, count=F('count') + count):
+            return
+        
+        try:
+            self.create(category_id=category_id, month=month, transaction_type=transaction_type, total=amount, count=count)
+        except IntegrityError:
+            # Someone else created the row in the meantime.
+            rollups.update(total=F('total') + amount, count=F('count') + count)
+    
+    def record(self, deltas):
+        """
+        Applies a dictionary of deltas as produced by ``rollup_deltas``.
+        """
+        for (category_id, month, transaction_type), (amount, count) in deltas.items():
+            self.adjust(category_id, month, transaction_type, amount, count)
+    
+    def compute(self, transactions=None):
+        """
+        Sums the active transactions into rollup cells, straight from the raw
+        table. Returns a dictionary in the same shape as ``rollup_deltas``.
+        """
+        if transactions is None:
+            transactions = Transaction.active.all()
+        
+        cells = {}
+        rows = transactions.values_list('category', 'date', 'transaction_type', 'amount').order_by()
+        
+        for category_id, date, transaction_type, amount in rows.iterator():
+            key = (category_id, first_of_month(date), transaction_type)
+            total, count = cells.get(key, (Decimal('0.0'), 0))
+            cells[key] = (total + amount, count + 1)
+        
+        return cells
+    
+    def rebuild(self):
+        """
+        Throws away every rollup row and recomputes them from the transactions.
+        """
+        self.all().delete()
+        cells = self.compute()
+        
+        for (category_id, month, transaction_type), (total, count) in cells.items():
+            self.create(category_id=category_id, month=month, transaction_type=transaction_type, total=total, count=count)
+        
+        return len(cells)
+    
+    def verify(self):
+        """
+        Compares the rollup table against the transactions.
+        
+        Returns a list of ``(key, expected, actual)`` tuples for every cell
+        that doesn't match, where ``expected`` and ``actual`` are
+        ``(total, count)`` tuples.
+        """
+        expected = self.compute()
+        actual = {}
+        mismatches = []
+        
+        for rollup in self.all():
+            key = (rollup.category_id, rollup.month, rollup.transaction_type)
+            actual[key] = (rollup.total, rollup.count)
+        
+        empty = (Decimal('0.0'), 0)
+        
+        for key in set(expected.keys()) | set(actual.keys()):
+            expected_cell = expected.get(key, empty)
+            actual_cell = actual.get(key, empty)
+            
+            if expected_cell != actual_cell:
+                mismatches.append((key, expected_cell, actual_cell))
+        
+        mismatches.sort()
+        return mismatches
+    
+    def totals_by_category(self, category_ids, start_date, end_date, transaction_type='expense'):
+        """
+        Returns a dictionary mapping category ids to their totals for every
+        month between ``start_date`` and ``end_date``.
+        """
+        totals = {}
+        rollups = self.filter(category__in=category_ids, transaction_type=transaction_type, month__range=(first_of_month(start_date), first_of_month(end_date)))
+        
+        for category_id, total in rollups.values_list('category', 'total'):
+            totals[category_id] = totals.get(category_id, Decimal('0.0')) + total
+        
+        return totals
+
+
+class TransactionRollup(models.Model):
+    """
+    The running total and number of active transactions for one category,
+    month and transaction type.
+    
+    This is derived data, kept up to date as transactions are saved so
+    reports can avoid summing the raw transactions. It is only maintained
+    when ``BUDGET_USE_ROLLUPS`` is enabled and can be rebuilt with the
+    ``budget_rollups`` management command.
+    """
+    category = models.ForeignKey(Category, related_name='rollups', verbose_name=_('Category'))
+    month = models.DateField(_('Month'), db_index=True)
+    transaction_type = models.CharField(_('Transaction type'), max_length=32, choices=TRANSACTION_TYPES)
+    total = models.DecimalField(_('Total'), max_digits=15, decimal_places=2, default=Decimal('0.0'))
+    count = models.IntegerField(_('Count'), default=0)
+    
+    objects = TransactionRollupManager()
+    
+    def __unicode__(self):
+        return u"%s %s (%s) - %s" % (self.category_id, self.month.strftime('%Y-%m'), self.transaction_type, self.total)
+    
+    class Meta:
+        verbose_name = _('Transaction rollup')
+        verbose_name_plural = _('Transaction rollups')
+        unique_together = (('category', 'month', 'transaction_type'),)
+
+
+def ledger_deltas(previous, current):
+    """
+    Works out how the balance of each category changes on each day when a
+    transaction row goes from ``previous`` to ``current`` (either may be
+    ``None``). Incomes add to the balance and expenses take away from it.
+    
+    Returns a dictionary of ``(category_id, date)`` to an amount.
+    """
+    deltas = {}
+    
+    for row, sign in ((previous, -1), (current, 1)):
+        if row is None or row['is_deleted']:
+            continue
+        
+        if row['transaction_type'] == 'expense':
+            sign = -sign
+        
+        key = (row['category'], row['date'])
+        deltas[key] = deltas.get(key, Decimal('0.0')) + sign * row['amount']
+    
+    for key, amount in deltas.items():
+        if amount == 0:
+            del deltas[key]
+    
+    return deltas
+
+
+class BalanceManager(models.Manager):
+    """
+    Keeps a table of cumulative balances, one row per day with any change.
+    
+    The ``scope`` keyword arguments of each method narrow it down to a single
+    ledger (e.g. ``category=1`` for ``CategoryBalance``).
+    """
+    def balance_as_of(self, date, **scope):
+        """
+        The balance at the end of ``date``, found with a single index seek.
+        """
+        balances = self.filter(date__lte=date, **scope).order_by('-date').values_list('balance', flat=True)[:1]
+        
+        for balance in balances:
+            return balance
+        
+        return Decimal('0.0')
+    
+    def total_as_of(self, date, field, **filters):
+        """
+        The sum of the balances at the end of ``date`` of every ledger keyed
+        by ``field`` (``category`` for ``CategoryBalance``) which matches
+        ``filters``, adding up each ledger's latest row in a single query.
+        """
+        qn = connection.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        column = qn(self.model._meta.get_field(field).column)
+        latest = '%s.%s = (SELECT MAX(latest.%s) FROM %s latest WHERE latest.%s = %s.%s AND latest.%s <= %%s)' % (
+            table, qn('date'), qn('date'), table, column, table, column, qn('date'))
+        balances = self.filter(date__lte=date, **filters).extra(where=[latest], params=[connection.ops.value_to_db_date(date)])
+        return balances.aggregate(total=Sum('balance'))['total'] or Decimal('0.0')
+    
+    def adjust(self, date, amount, **scope):
+        """
+        Adds ``amount`` to the change on ``date`` and to the balance of that day
+        and every day after it.
+        """
+        days = self.filter(date=date, **scope)
+        
+        if not days.update(change=F('change') + amount):
+            day = self.model(date=date, change=amount, balance=self.balance_as_of(date - datetime.timedelta(days=1), **scope))
+            
+            for name, value in scope.items():
+                # Scopes may give related objects by primary key.
+                setattr(day, self.model._meta.get_field(name).attname, value)
+            
+            try:
+                day.save()
+            except IntegrityError:
+                # Someone else created the row in the meantime.
+                days.update(change=F('change') + amount)
+        
+        self.filter(date__gte=date, **scope).update(balance=F('balance') + amount)
+
+
+class Balance(models.Model):
+    date = models.DateField(_('Date'))
+    change = models.DecimalField(_('Change'), max_digits=15, decimal_places=2, default=Decimal('0.0'))
+    balance = models.DecimalField(_('Balance'), max_digits=15, decimal_places=2, default=Decimal('0.0'))
+    
+    objects = BalanceManager()
+    
+    class Meta:
+        abstract = True
+
+
+class DailyBalance(Balance):
+    """
+    The running balance (incomes less expenses) across every category at
+    the end of each day with active transactions.
+    
+    Like the rollups, this is derived data. It is only maintained when
+    ``BUDGET_USE_LEDGER`` is enabled and can be rebuilt with the
+    ``budget_ledger`` management command.
+    """
+    class Meta:
+        verbose_name = _('Daily balance')
+        verbose_name_plural = _('Daily balances')
+        unique_together = (('date',),)
+
+
+class CategoryBalance(Balance):
+    """
+    The running balance of a single category at the end of each day with
+    active transactions in it.
+    """
+    category = models.ForeignKey(Category, related_name='balances', verbose_name=_('Category'))
+    
+    class Meta:
+        verbose_name = _('Category balance')
+        verbose_name_plural = _('Category balances')
+        unique_together = (('category', 'date'),)
+
+
+def record_ledger(deltas):
+    """
+    Applies a dictionary of deltas as produced by ``ledger_deltas``.
+    """
+    daily = {}
+    
+    for (category_id, date), amount in deltas.items():
+        CategoryBalance.objects.adjust(date, amount, category=category_id)
+        daily[date] = daily.get(date, Decimal('0.0')) + amount
+    
+    for date, amount in daily.items():
+        if amount:
+            DailyBalance.objects.adjust(date, amount)
+
+
+def balance_as_of(date, category=None):
+    """
+    Returns the balance (all incomes less all expenses) up to and including
+    ``date``, optionally for a single category.
+    
+    With ``BUDGET_USE_LEDGER`` enabled this is a single index lookup, or a
+    single query adding up the latest balance of each category of the
+    current ledger when ``budget.tenancy`` is scoping (``DailyBalance``
+    spans every ledger). Otherwise every transaction up to the date is
+    summed.
+    """
+    if ledger_enabled():
+        if category is None and tenancy.is_active():
+            return CategoryBalance.objects.total_as_of(date, 'category', category__in=tenancy.scope(Category.objects.all()).values('pk'))
+        
+        if category is None:
+            return DailyBalance.objects.balance_as_of(date)
+        
+        return CategoryBalance.objects.balance_as_of(date, category=category)
+    
+    transactions = Transaction.active.filter(date__lte=date)
+    
+    if category is not None:
+        transactions = transactions.filter(category=category)
+    
+    balance = Decimal('0.0')
+    
+    for transaction_type, total in transactions.values_list('transaction_type').annotate(total=Sum('amount')).order_by():
+        if transaction_type == 'expense':
+            balance -= total
+        else:
+            balance += total
+    
+    return balance
+
+
+def rebuild_ledger(chunk_size=1000):
+    """
+    Throws away the ledger and recomputes it from the transactions, reading
+    them ``chunk_size`` rows at a time in date order.
+    
+    Returns the number of days in the ledger.
+    """
+    DailyBalance.objects.all().delete()
+    CategoryBalance.objects.all().delete()
+    rows = Transaction.active.order_by('date', 'id').values_list('id', 'category', 'date', 'transaction_type', 'amount')
+    category_balances = {}
+    balance = Decimal('0.0')
+    day = None
+    changes = {}
+    days = 0
+    last = None
+    
+    while True:
+        chunk = rows
+        
+        if last is not None:
+            chunk = chunk.filter(Q(date__gt=last[2]) | Q(date=last[2], id__gt=last[0]))
+        
+        count = 0
+        
+        for row in chunk[:chunk_size]:
+            count += 1
+            last = row
+            
+            if row[2] != day:
+                if day is not None:
+                    balance = write_ledger_day(day, changes, category_balances, balance)
+                    days += 1
+                
+                day = row[2]
+                changes = {}
+            
+            amount = row[4]
+            
+            if row[3] == 'expense':
+                amount = -amount
+            
+            changes[row[1]] = changes.get(row[1], Decimal('0.0')) + amount
+        
+        if count < chunk_size:
+            break
+    
+    if day is not None:
+        write_ledger_day(day, changes, category_balances, balance)
+        days += 1
+    
+    return days
+
+
+def write_ledger_day(day, changes, category_balances, balance):
+    """
+    Writes one day of a ledger rebuild, returning the new overall balance.
+    """
+    total = Decimal('0.0')
+    
+    for category_id, change in changes.items():
+        category_balances[category_id] = category_balances.get(category_id, Decimal('0.0')) + change
+        CategoryBalance.objects.create(category_id=category_id, date=day, change=change, balance=category_balances[category_id])
+        total += change
+    
+    DailyBalance.objects.create(date=day, change=total, balance=balance + total)
+    return balance + total
+
+
+def update_rollups(sender, instance, previous, **kwargs):
+    if rollups_enabled():
+        TransactionRollup.objects.record(rollup_deltas(previous, instance.as_row()))
+
+
+def update_rollups_in_bulk(sender, deltas, **kwargs):
+    if rollups_enabled():
+        TransactionRollup.objects.record(deltas)
+
+
+def update_ledger(sender, instance, previous, **kwargs):
+    if ledger_enabled():
+        record_ledger(ledger_deltas(previous, instance.as_row()))
+
+
+def update_ledger_in_bulk(sender, rows, **kwargs):
+    if ledger_enabled():
+        deltas = {}
+        
+        for previous, current in rows:
+            for key, amount in ledger_deltas(previous, current).items():
+                deltas[key] = deltas.get(key, Decimal('0.0')) + amount
+        
+        record_ledger(deltas)
+
+
+transaction_changed.connect(update_rollups, dispatch_uid='budget.transactions.update_rollups')
+transactions_bulk_changed.connect(update_rollups_in_bulk, dispatch_uid='budget.transactions.update_rollups_in_bulk')
+transaction_changed.connect(update_ledger, dispatch_uid='budget.transactions.update_ledger')
+transactions_bulk_changed.connect(update_ledger_in_bulk, dispatch_uid='budget.transactions.update_ledger_in_bulk')
@@ -0,0 +1,16 @@
+from django.dispatch import Signal
+
+
+# Sent after a single transaction has been saved (soft deletes included).
+# ``previous`` is a dictionary of the row as it was in the database before the
+# save, or ``None`` for new transactions. It's only looked up while
+# ``BUDGET_USE_ROLLUPS``, ``BUDGET_USE_LEDGER`` or ``BUDGET_CACHE_REPORTS`` is
+# enabled, and is ``None`` otherwise.
+transaction_changed = Signal(providing_args=['instance', 'previous'])
+
+# Sent after many transactions have been written at once (imports, bulk
+# edits). ``deltas`` maps ``(category_id, month, transaction_type)`` to a
+# ``(amount, count)`` tuple describing how the active totals changed. ``rows``
+# is a list of ``(previous, current)`` tuples, in the same shape as
+# ``previous`` above, for listeners that need more detail than the deltas.
+transactions_bulk_changed = Signal(providing_args=['deltas', 'rows'])
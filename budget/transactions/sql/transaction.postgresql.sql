@@ -0,0 +1,15 @@
+-- Partial indexes that only cover active transactions, matching the
+-- ActiveManager family. The report queries filter on category, type and date
+-- (BudgetEstimate.actual_transactions and the grouped totals) and the
+-- dashboard orders expenses/incomes by date (TransactionManager.get_latest).
+CREATE INDEX transactions_transaction_active_reports ON transactions_transaction (category_id, transaction_type, date) WHERE is_deleted = false;
+CREATE INDEX transactions_transaction_active_latest ON transactions_transaction (transaction_type, date, created) WHERE is_deleted = false;
+-- The partition index. Date ranges routed to their year buckets (see
+-- filter_dates) read one contiguous slice of it per year, and it covers the
+-- grouped report totals without touching the table.
+CREATE INDEX transactions_transaction_partitions ON transactions_transaction (year, category_id, transaction_type, date, amount) WHERE is_deleted = false;
+-- Owner-led versions of the latest and partition indexes, so each ledger's
+-- dashboard and yearly totals read only its own range (see budget.tenancy).
+-- Queries on a category already stay within its owner's ledger.
+CREATE INDEX transactions_transaction_owner_latest ON transactions_transaction (owner_id, transaction_type, date, created) WHERE is_deleted = false;
+CREATE INDEX transactions_transaction_owner_years ON transactions_transaction (owner_id, year, transaction_type, date, amount) WHERE is_deleted = false;
@@ -0,0 +1,10 @@
+-- Supports the keyset pagination of the transaction list, which walks the
+-- active transactions ordered by (date, created, id).
+CREATE INDEX transactions_transaction_keyset ON transactions_transaction (is_deleted, date, created, id);
+-- The same walk within one owner's ledger (see budget.tenancy).
+CREATE INDEX transactions_transaction_owner_keyset ON transactions_transaction (owner_id, is_deleted, date, created, id);
+-- Supports the JSON API's conditional GETs (budget.api.resource_state),
+-- which read the latest updated and the row count of every transaction, or
+-- of one owner's, from the index rather than the table.
+CREATE INDEX transactions_transaction_updated ON transactions_transaction (updated);
+CREATE INDEX transactions_transaction_owner_updated ON transactions_transaction (owner_id, updated);
@@ -0,0 +1,16 @@
+-- Django binds is_deleted as a query parameter, which SQLite can't match
+-- against a partial index, so is_deleted leads instead. The report
+-- queries filter on category, type and date (BudgetEstimate.actual_transactions
+-- and the grouped totals) and the dashboard orders expenses/incomes by date
+-- (TransactionManager.get_latest).
+CREATE INDEX transactions_transaction_active_reports ON transactions_transaction (is_deleted, category_id, transaction_type, date);
+CREATE INDEX transactions_transaction_active_latest ON transactions_transaction (is_deleted, transaction_type, date, created);
+-- The partition index. Date ranges routed to their year buckets (see
+-- filter_dates) read one contiguous slice of it per year, and it covers the
+-- grouped report totals without touching the table.
+CREATE INDEX transactions_transaction_partitions ON transactions_transaction (is_deleted, year, category_id, transaction_type, date, amount);
+-- Owner-led versions of the latest and partition indexes, so each ledger's
+-- dashboard and yearly totals read only its own range (see budget.tenancy).
+-- Queries on a category already stay within its owner's ledger.
+CREATE INDEX transactions_transaction_owner_latest ON transactions_transaction (owner_id, is_deleted, transaction_type, date, created);
+CREATE INDEX transactions_transaction_owner_years ON transactions_transaction (owner_id, is_deleted, year, transaction_type, date, amount);
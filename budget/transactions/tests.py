@@ -1,4 +1,5 @@
 """
+>>> import datetime
 >>> from django.test import Client
 >>> c = Client()
 
@@ -71,4 +72,432 @@ Installed 1 object(s) from 1 fixture(s)
 200
 >>> r.context[-1]['transactions']
 []
+
+
+# Rollups
+
+Without rollups, the ledger or the shared cache nothing needs the row as it
+was, so saving an existing transaction doesn't look it up first.
+
+>>> from decimal import Decimal
+>>> from budget.instrumentation import collect
+>>> from budget.transactions.models import Transaction
+>>> t1 = Transaction.objects.create(transaction_type='expense', category=cat, notes='Resaved', amount='1.00', date='2008-10-03')
+>>> result, collector = collect(t1.save)
+>>> collector.queries
+2
+>>> Transaction.objects.filter(pk=t1.pk).delete()
+
+>>> from django.conf import settings
+>>> from budget.transactions.models import Transaction, TransactionRollup
+>>> old_use_rollups = getattr(settings, 'BUDGET_USE_ROLLUPS', False)
+>>> settings.BUDGET_USE_ROLLUPS = True
+
+>>> t1 = Transaction.objects.create(transaction_type='expense', category=cat, notes='Groceries', amount='20.25', date='2008-10-03')
+>>> t2 = Transaction.objects.create(transaction_type='expense', category=cat, notes='Gas', amount=Decimal('30.50'), date='2008-10-12')
+>>> t3 = Transaction.objects.create(transaction_type='income', category=cat, notes='Paycheck', amount=Decimal('100.25'), date='2008-10-14')
+>>> def print_rollups():
+...     for r in TransactionRollup.objects.order_by('month', 'transaction_type'):
+...         print r.month.strftime('%Y-%m'), r.transaction_type, '%.2f' % r.total, r.count
+>>> print_rollups()
+2008-10 expense 50.75 2
+2008-10 income 100.25 1
+
+>>> t2.date = datetime.date(2008, 11, 1)
+>>> t2.amount = Decimal('31.50')
+>>> t2.save()
+>>> print_rollups()
+2008-10 expense 20.25 1
+2008-10 income 100.25 1
+2008-11 expense 31.50 1
+
+>>> t1.delete()
+>>> print_rollups()
+2008-10 expense 0.00 0
+2008-10 income 100.25 1
+2008-11 expense 31.50 1
+>>> TransactionRollup.objects.verify()
+[]
+
+>>> TransactionRollup.objects.filter(transaction_type='income').update(count=5)
+1
+>>> len(TransactionRollup.objects.verify())
+1
+>>> TransactionRollup.objects.rebuild()
+2
+>>> call_command('budget_rollups', verify_only=True)
+Rollups match the transactions.
+>>> TransactionRollup.objects.count()
+2
+
+>>> settings.BUDGET_USE_ROLLUPS = old_use_rollups
+>>> Transaction.objects.filter(pk__in=[t1.pk, t2.pk, t3.pk]).delete()
+>>> TransactionRollup.objects.all().delete()
+
+
+# Importing
+
+>>> from StringIO import StringIO
+>>> from budget.transactions.importers import read_csv, read_qif, read_ofx, CategoryResolver, clean_rows
+>>> [sorted(row.items()) for row in read_csv(StringIO("Date,Amount,Notes,Category\\n2008-10-01,-12.25,Coffee Shop,misc\\n"))]
+[[('amount', '-12.25'), ('category', 'misc'), ('date', '2008-10-01'), ('notes', 'Coffee Shop')]]
+>>> [sorted(row.items()) for row in read_qif(StringIO("!Type:Bank\\nD10/14'08\\nT-1,200.50\\nPRent\\nMOctober\\n^\\nD10/15/2008\\nT300.00\\nPPaycheck\\n^\\n"))]
+[[('amount', '-1200.50'), ('date', '10/14/2008'), ('notes', 'Rent October')], [('amount', '300.00'), ('date', '10/15/2008'), ('notes', 'Paycheck')]]
+>>> ofx = "<OFX><BANKTRANLIST><STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20081016120000<TRNAMT>-4.75<NAME>Bakery</STMTTRN><STMTTRN><TRNTYPE>DEBIT</TRNTYPE><DTPOSTED>20081017</DTPOSTED><TRNAMT>-9.25</TRNAMT><NAME>Books</NAME><MEMO>Used</MEMO></STMTTRN></BANKTRANLIST></OFX>"
+>>> [sorted(row.items()) for row in read_ofx(StringIO(ofx))]
+[[('amount', '-4.75'), ('date', '2008-10-16'), ('notes', 'Bakery')], [('amount', '-9.25'), ('date', '2008-10-17'), ('notes', 'Books Used')]]
+
+>>> resolver = CategoryResolver(rules=[('paycheck', 'misc')])
+>>> rows = [{'date': '2008-10-15', 'amount': '300.00', 'notes': 'Paycheck'}, {'date': 'yesterday', 'amount': '1.00'}, {'date': '2008-10-16', 'amount': '-4.75', 'notes': 'Bakery'}]
+>>> for row, transaction, errors in clean_rows(rows, resolver):
+...     print row, transaction, errors and ' '.join(errors)
+1 Paycheck (Income) - 300.00 None
+2 None Enter a valid date.
+3 None No category found for 'Bakery'.
+
+>>> import os, tempfile
+>>> handle, filename = tempfile.mkstemp(suffix='.csv')
+>>> statement = open(filename, 'w')
+>>> statement.write("date,amount,notes\\n2009-01-02,-10.25,Bakery\\n2009-01-03,-5.50,Bakery\\n2009-01-04,abc,Bakery\\n2009-01-05,1000.00,Paycheck\\n")
+>>> statement.close()
+>>> call_command('budget_import', filename, category='misc', dry_run=True, verbosity=0)
+>>> Transaction.objects.filter(date__year=2009).count()
+0
+>>> call_command('budget_import', filename, category='misc', batch_size=2, verbosity=0)
+>>> [(t.notes, t.transaction_type, '%.2f' % t.amount) for t in Transaction.objects.filter(date__year=2009).order_by('date')]
+[(u'Bakery', u'expense', '10.25'), (u'Bakery', u'expense', '5.50'), (u'Paycheck', u'income', '1000.00')]
+>>> os.close(handle)
+>>> os.remove(filename)
+>>> Transaction.objects.filter(date__year=2009).delete()
+
+
+# Exporting
+
+>>> from budget.transactions.exporters import export_transactions, iterate_in_chunks
+>>> t1 = Transaction.objects.create(transaction_type='expense', category=cat, notes='Tea, green', amount=Decimal('3.25'), date='2009-02-01')
+>>> t2 = Transaction.objects.create(transaction_type='expense', category=cat, notes='Cake', amount=Decimal('4.25'), date='2009-02-01')
+>>> t3 = Transaction.objects.create(transaction_type='income', category=cat, notes='Gift', amount=Decimal('50.25'), date='2009-01-15')
+>>> [t.notes for t in iterate_in_chunks(Transaction.active.filter(date__year=2009), chunk_size=1)]
+[u'Gift', u'Tea, green', u'Cake']
+>>> for line in ''.join(export_transactions(Transaction.active.filter(date__year=2009), chunk_size=2)).splitlines():
+...     print line.split(',', 1)[1]
+date,transaction_type,category,amount,notes
+2009-01-15,income,misc,50.25,Gift
+2009-02-01,expense,misc,3.25,"Tea, green"
+2009-02-01,expense,misc,4.25,Cake
+
+>>> r = c.get('/budget/transaction/export/json/', {'start_date': '2009-02-01', 'transaction_type': 'expense', 'category': 'misc'})
+>>> r.status_code
+200
+>>> r['Content-Type']
+'application/json'
+>>> from django.utils import simplejson
+>>> [(row['notes'], row['amount']) for row in [simplejson.loads(line) for line in r.content.splitlines()]]
+[(u'Tea, green', u'3.25'), (u'Cake', u'4.25')]
+>>> c.get('/budget/transaction/export/csv/', {'category': 'no-such-category'}).status_code
+400
+>>> Transaction.objects.filter(date__year=2009).delete()
+
+
+# Keyset pagination
+
+>>> old_keyset, old_per_page = getattr(settings, 'BUDGET_KEYSET_PAGINATION', False), getattr(settings, 'BUDGET_LIST_PER_PAGE', 50)
+>>> settings.BUDGET_KEYSET_PAGINATION, settings.BUDGET_LIST_PER_PAGE = True, 2
+
+SQLite reads some fractions of a second back a microsecond early, which
+mustn't make pages skip or repeat rows.
+
+>>> for day, notes, microsecond in ((1, 'A', 249), (2, 'B', 251), (2, 'C', 489), (2, 'D', 493), (3, 'E', 498)):
+...     t = Transaction.objects.create(category=cat, notes=notes, amount=Decimal('1.25'), date=datetime.date(2009, 3, day), created=datetime.datetime(2009, 3, 1, 12, 0, 0, microsecond))
+>>> r = c.get('/budget/transaction/')
+>>> [t.notes for t in r.context[-1]['transactions']], r.context[-1]['page'].has_previous(), r.context[-1]['page'].has_next()
+([u'E', u'D'], False, True)
+>>> r = c.get('/budget/transaction/', {'cursor': r.context[-1]['page'].next_cursor})
+>>> [t.notes for t in r.context[-1]['transactions']], r.context[-1]['page'].has_previous(), r.context[-1]['page'].has_next()
+([u'C', u'B'], True, True)
+>>> r = c.get('/budget/transaction/', {'cursor': r.context[-1]['page'].next_cursor})
+>>> [t.notes for t in r.context[-1]['transactions']], r.context[-1]['page'].has_previous(), r.context[-1]['page'].has_next()
+([u'A'], True, False)
+>>> r = c.get('/budget/transaction/', {'cursor': r.context[-1]['page'].previous_cursor})
+>>> [t.notes for t in r.context[-1]['transactions']], r.context[-1]['page'].has_previous(), r.context[-1]['page'].has_next()
+([u'C', u'B'], True, True)
+>>> r = c.get('/budget/transaction/', {'cursor': r.context[-1]['page'].previous_cursor})
+>>> [t.notes for t in r.context[-1]['transactions']], r.context[-1]['page'].has_previous(), r.context[-1]['page'].has_next()
+([u'E', u'D'], False, True)
+>>> 'cursor=' in r.content
+True
+>>> from budget.pagination import KeysetPaginator, InvalidCursor
+>>> KeysetPaginator(Transaction.active.all(), 2, ('-date', '-created', '-id')).page('garbage')
+Traceback (most recent call last):
+    ...
+InvalidCursor: That cursor is not valid.
+
+>>> settings.BUDGET_KEYSET_PAGINATION, settings.BUDGET_LIST_PER_PAGE = old_keyset, old_per_page
+>>> Transaction.objects.filter(date__year=2009).delete()
+
+
+# Ledger
+
+>>> from budget.transactions.models import DailyBalance, CategoryBalance, balance_as_of
+>>> other = Category.objects.create(name='Other', slug='other')
+>>> dates = [datetime.date(2010, 1, day) for day in (1, 5, 9, 12, 20)]
+>>> old_use_ledger = getattr(settings, 'BUDGET_USE_LEDGER', False)
+>>> settings.BUDGET_USE_LEDGER = True
+>>> call_command('budget_ledger', chunk_size=2) #doctest: +ELLIPSIS
+Rebuilt the ledger for ... day(s).
+
+>>> def print_balances(category=None):
+...     for date in dates:
+...         print date.day, '%.2f' % (balance_as_of(date, category) - balance_as_of(datetime.date(2009, 12, 31), category))
+>>> t1 = Transaction.objects.create(transaction_type='income', category=cat, notes='Pay', amount=Decimal('100'), date='2010-01-05')
+>>> t2 = Transaction.objects.create(transaction_type='expense', category=other, notes='Rent', amount=Decimal('60.50'), date='2010-01-09')
+>>> t3 = Transaction.objects.create(transaction_type='expense', category=cat, notes='Food', amount=Decimal('12.25'), date='2010-01-12')
+>>> print_balances()
+1 0.00
+5 100.00
+9 39.50
+12 27.25
+20 27.25
+>>> print_balances(other.pk)
+1 0.00
+5 0.00
+9 -60.50
+12 -60.50
+20 -60.50
+
+Moving a transaction, changing its amount and deleting one all shift the
+later balances.
+
+>>> t3.date = datetime.date(2010, 1, 1)
+>>> t3.amount = Decimal('10')
+>>> t3.save()
+>>> t2.delete()
+>>> print_balances()
+1 -10.00
+5 90.00
+9 90.00
+12 90.00
+20 90.00
+
+>>> from budget.transactions.models import insert_transactions
+>>> insert_transactions([Transaction(transaction_type='expense', category=other, notes='Bulk', amount=Decimal('5'), date=datetime.date(2010, 1, day)) for day in (5, 20)])
+2
+>>> print_balances()
+1 -10.00
+5 85.00
+9 85.00
+12 85.00
+20 80.00
+
+>>> settings.BUDGET_USE_LEDGER = False
+>>> [balance_as_of(date) - balance_as_of(datetime.date(2009, 12, 31)) for date in dates] == [Decimal(value) for value in ('-10', '85', '85', '85', '80')]
+True
+>>> settings.BUDGET_USE_LEDGER = True
+>>> before = [(balance_as_of(date), balance_as_of(date, cat.pk), balance_as_of(date, other.pk)) for date in dates]
+>>> call_command('budget_ledger', chunk_size=2, verbosity=0)
+>>> [(balance_as_of(date), balance_as_of(date, cat.pk), balance_as_of(date, other.pk)) for date in dates] == before
+True
+
+Scoped to a ledger, the balance adds up the latest row of each of its
+categories in one query.
+
+>>> from budget import tenancy
+>>> from budget.instrumentation import collect
+>>> old_tenancy = getattr(settings, 'BUDGET_MULTI_TENANT', False)
+>>> settings.BUDGET_MULTI_TENANT = True
+>>> [tenancy.as_owner(None, balance_as_of, date) for date in dates] == [balance_as_of(date) for date in dates]
+True
+>>> result, collector = tenancy.as_owner(None, collect, balance_as_of, dates[-1])
+>>> collector.queries
+1
+>>> settings.BUDGET_MULTI_TENANT = old_tenancy
+
+>>> settings.BUDGET_USE_LEDGER = old_use_ledger
+>>> Transaction.objects.filter(date__year=2010).delete()
+>>> DailyBalance.objects.all().delete()
+>>> CategoryBalance.objects.all().delete()
+>>> Category.objects.filter(pk=other.pk).delete()
+
+
+# Bulk changes
+
+>>> from budget.transactions.models import update_transactions
+>>> from budget.transactions.signals import transactions_bulk_changed
+>>> old_settings = getattr(settings, 'BUDGET_USE_ROLLUPS', False), getattr(settings, 'BUDGET_USE_LEDGER', False)
+>>> settings.BUDGET_USE_ROLLUPS = settings.BUDGET_USE_LEDGER = True
+>>> other = Category.objects.create(name='Coffee', slug='coffee')
+>>> for day in range(1, 6):
+...     t = Transaction.objects.create(category=cat, notes='Coffee shop %d' % day, amount=Decimal('3'), date=datetime.date(2011, 2, day))
+>>> t = Transaction.objects.create(category=cat, notes='Rent', amount=Decimal('500'), date=datetime.date(2011, 2, 1))
+>>> TransactionRollup.objects.rebuild() and None
+>>> call_command('budget_ledger', verbosity=0)
+
+>>> sent = []
+>>> def listener(sender, deltas, rows, **kwargs):
+...     sent.append(len(rows))
+>>> transactions_bulk_changed.connect(listener)
+>>> update_transactions(Transaction.active.filter(notes__startswith='Coffee shop'), batch_size=2, category=other)
+5
+>>> sent
+[2, 2, 1]
+>>> Transaction.active.filter(category=other).count()
+5
+>>> TransactionRollup.objects.verify()
+[]
+>>> print '%.2f' % balance_as_of(datetime.date(2011, 2, 28), other.pk)
+-15.00
+>>> update_transactions(Transaction.active.filter(category=other), category=other)
+0
+>>> update_transactions(Transaction.active.all(), amount=Decimal('1'))
+Traceback (most recent call last):
+    ...
+ValueError: 'amount' can't be changed in bulk.
+>>> transactions_bulk_changed.disconnect(listener)
+
+>>> r = c.post('/budget/transaction/bulk/', {'action': 'delete', 'category': 'coffee', 'start_date': '2011-02-02'}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+>>> r.status_code, r.content
+(200, '{"updated": 4}')
+>>> print '%.2f' % balance_as_of(datetime.date(2011, 2, 28), other.pk)
+-3.00
+>>> r = c.post('/budget/transaction/bulk/', {'action': 'restore', 'notes': 'coffee shop 5'})
+>>> r.status_code, Transaction.active.filter(category=other).count()
+(302, 2)
+>>> r = c.post('/budget/transaction/bulk/', {'action': 'delete'}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+>>> r.status_code, r.content
+(400, '{"errors": {"__all__": ["Choose at least one filter, so every transaction is not changed by mistake."]}}')
+>>> Transaction.active.filter(date__year=2011).update(updated=datetime.datetime(2000, 1, 1))
+3
+>>> r = c.post('/budget/transaction/bulk/', {'action': 'retype', 'new_transaction_type': 'income', 'notes': 'rent'})
+>>> rent = Transaction.objects.get(notes='Rent')
+>>> rent.transaction_type, rent.updated.year > 2000
+(u'income', True)
+>>> TransactionRollup.objects.verify()
+[]
+
+>>> settings.BUDGET_USE_ROLLUPS, settings.BUDGET_USE_LEDGER = old_settings
+>>> Transaction.objects.filter(date__year=2011).delete()
+>>> TransactionRollup.objects.all().delete()
+>>> DailyBalance.objects.all().delete()
+>>> CategoryBalance.objects.all().delete()
+>>> Category.objects.filter(pk=other.pk).delete()
+
+
+# Categorization rules
+
+>>> from budget.categories.models import CategoryRule
+>>> from budget.transactions.forms import TransactionForm
+>>> rule = CategoryRule.objects.create(pattern='bakery', category=cat, max_amount=Decimal('50'))
+>>> form = TransactionForm({'transaction_type': 'expense', 'notes': 'Corner Bakery', 'amount': '4.75', 'date': '2012-01-02'})
+>>> form.is_valid(), form.cleaned_data['category'] == cat
+(True, True)
+>>> form = TransactionForm({'transaction_type': 'expense', 'notes': 'Corner Bakery', 'amount': '400', 'date': '2012-01-02'})
+>>> form.is_valid(), form.errors['category']
+(False, [u'This field is required.'])
+
+>>> resolver = CategoryResolver()
+>>> [(transaction.notes, transaction.category == cat) for row, transaction, errors in clean_rows([{'date': '2012-01-02', 'amount': '-4.75', 'notes': 'BAKERY 123'}], resolver)]
+[(u'BAKERY 123', True)]
+>>> CategoryRule.objects.all().delete()
+
+
+# Year buckets
+
+Every transaction is bucketed by the year of its date, however it's saved.
+
+>>> from budget import partitions
+>>> from budget.transactions.models import filter_dates
+>>> first = Transaction.objects.create(transaction_type='expense', category=cat, notes='Bucketed', amount=Decimal('3.00'), date='2013-12-31')
+>>> insert_transactions([Transaction(transaction_type='expense', category=cat, notes='Bucketed', amount=Decimal('4.00'), date=datetime.date(2014, 1, 1))])
+1
+>>> Transaction.objects.filter(notes='Bucketed').values_list('year', flat=True).order_by('year')
+[2013, 2014]
+
+Routed date ranges only read the buckets of their years, so rows which
+haven't been backfilled yet aren't found until they are.
+
+>>> Transaction.objects.filter(pk=first.pk).update(year=None)
+1
+>>> [('%.2f' % transaction.amount) for transaction in filter_dates(Transaction.active.all(), datetime.date(2013, 12, 1), datetime.date(2014, 1, 31), partitioned=True)]
+['4.00']
+>>> [(year, count) for year, count in partitions.status() if year in (None, 2013, 2014)]
+[(None, 1), (2014, 1)]
+>>> call_command('budget_partitions', 'backfill')
+Backfilled the year of 1 transaction(s).
+>>> [('%.2f' % transaction.amount) for transaction in filter_dates(Transaction.active.all(), datetime.date(2013, 12, 1), datetime.date(2014, 1, 31), partitioned=True).order_by('date')]
+['3.00', '4.00']
+>>> filter_dates(Transaction.active.all(), datetime.date(2013, 12, 1), datetime.date(2014, 1, 31)).count()
+2
+
+>>> old_partitioning = getattr(settings, 'BUDGET_PARTITION_BY_YEAR', False)
+>>> settings.BUDGET_PARTITION_BY_YEAR = True
+>>> [('%.2f' % transaction.amount) for transaction in Transaction.expenses.between(datetime.date(2014, 1, 1), datetime.date(2014, 12, 31))]
+['4.00']
+>>> settings.BUDGET_PARTITION_BY_YEAR = old_partitioning
+
+>>> call_command('budget_partitions', 'create')
+The year column already exists.
+>>> Transaction.objects.filter(notes='Bucketed').delete()
+
+Upgraded installs without the column are told how to add it, rather than
+getting a database error from every query.
+
+>>> from budget.transactions import models as transaction_models
+>>> transaction_models._year_column_checked = False
+>>> transaction_models.has_year_column = lambda: False
+>>> Transaction.active.count()
+Traceback (most recent call last):
+    ...
+ImproperlyConfigured: The transactions_transaction table has no year column. Add it with './manage.py budget_partitions create' and fill it in with './manage.py budget_partitions backfill'.
+>>> transaction_models.has_year_column = partitions.has_year_column
+>>> Transaction.active.count()
+0
+
+
+# Batch entry
+
+Many rows are validated together and inserted at once, with the categories
+looked up once per batch.
+
+>>> from budget.instrumentation import collect
+>>> from budget.transactions.forms import batch_data
+>>> r = c.get('/budget/transaction/batch/')
+>>> r.status_code, len(r.context[-1]['formset'].forms)
+(200, 10)
+>>> def rows(count):
+...     return [{'transaction_type': 'expense', 'notes': 'Batch %d' % index, 'category': 'misc', 'amount': '2.00', 'date': '2015-01-%02d' % (index + 1)} for index in range(count)]
+>>> response, small = collect(c.post, '/budget/transaction/batch/', batch_data(rows(2)))
+>>> response.status_code, response['Location']
+(302, 'http://testserver/budget/transaction/')
+>>> response, large = collect(c.post, '/budget/transaction/batch/', batch_data(rows(20)), HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+>>> response.status_code, response.content
+(200, '{"created": 20}')
+>>> small.queries == large.queries
+True
+>>> Transaction.active.filter(notes__startswith='Batch', year=2015).count()
+22
+
+Nothing is saved unless every row is valid, and the errors come back per row.
+
+>>> data = batch_data(rows(2) + [{'notes': 'Mystery', 'amount': 'lots', 'date': '2015-01-05'}])
+>>> r = c.post('/budget/transaction/batch/', data, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+>>> errors = simplejson.loads(r.content)['errors']
+>>> r.status_code, errors['rows'][:2], sorted(errors['rows'][2].keys())
+(400, [{}, {}], [u'amount', u'category', u'transaction_type'])
+>>> today = datetime.date.today().isoformat()
+>>> r = c.post('/budget/transaction/batch/', {'form-TOTAL_FORMS': '2', 'form-INITIAL_FORMS': '0', 'form-0-transaction_type': 'expense', 'form-0-date': today, 'form-1-transaction_type': 'expense', 'form-1-date': today}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+>>> simplejson.loads(r.content)['errors']['batch']
+[u'Enter at least one transaction.']
+>>> from budget.transactions.forms import MAX_BATCH_ROWS, TransactionBatchFormSet
+>>> formset = TransactionBatchFormSet({'form-TOTAL_FORMS': str(MAX_BATCH_ROWS + 1), 'form-INITIAL_FORMS': '0'})
+>>> len(formset.forms), formset.is_valid(), formset.non_form_errors()
+(0, False, [u'Enter at most 5000 transactions at once.'])
+>>> Transaction.active.filter(notes__startswith='Batch', year=2015).count()
+22
+>>> Transaction.objects.filter(notes__startswith='Batch', year=2015).delete()
+
+
+# Cleanup
+
+>>> Transaction.objects.all().delete()
+>>> Category.objects.all().delete()
 """
@@ -3,6 +3,9 @@ from django.conf.urls.defaults import *
 urlpatterns = patterns('budget.transactions.views',
     url(r'^$', 'transaction_list', name='budget_transaction_list'),
     url(r'^add/$', 'transaction_add', name='budget_transaction_add'),
+    url(r'^batch/$', 'transaction_batch', name='budget_transaction_batch'),
     url(r'^edit/(?P<transaction_id>\d+)/$', 'transaction_edit', name='budget_transaction_edit'),
     url(r'^delete/(?P<transaction_id>\d+)/$', 'transaction_delete', name='budget_transaction_delete'),
+    url(r'^bulk/$', 'transaction_bulk', name='budget_transaction_bulk'),
+    url(r'^export/(?P<format>csv|json)/$', 'transaction_export', name='budget_transaction_export'),
 )
@@ -1,13 +1,24 @@
-from django.conf import settings
 from django.core.urlresolvers import reverse
-from django.core.paginator import Paginator, InvalidPage
-from django.http import Http404, HttpResponseRedirect
+from django.db.transaction import commit_on_success
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseRedirect
 from django.shortcuts import render_to_response, get_object_or_404
 from django.template import RequestContext
-from budget.transactions.models import Transaction
-from budget.transactions.forms import TransactionForm
+from django.utils import simplejson
+from django.utils.encoding import force_unicode
+from budget import tenancy
+from budget.instrumentation import instrument
+from budget.pagination import paginate
+from budget.transactions.models import Transaction, update_transactions
+from budget.transactions.forms import TransactionForm, TransactionExportForm, TransactionBulkForm, TransactionBatchFormSet
+from budget.transactions.exporters import export_transactions, filter_transactions
 
+EXPORT_MIMETYPES = {
+    'csv': 'text/csv',
+    'json': 'application/json',
+}
 
+
+@instrument
 def transaction_list(request, model_class=Transaction, template_name='budget/transactions/list.html'):
     """
     A list of transaction objects.
@@ -17,17 +28,12 @@ def transaction_list(request, model_class=Transaction, template_name='budget/tra
         transactions
             paginated list of transaction objects
         paginator
-            A Django Paginator instance
+            A Django Paginator (or KeysetPaginator) instance
         page
             current page of transaction objects
     """
-    transaction_list = model_class.active.order_by('-date', '-created')
-    try:
-        paginator = Paginator(transaction_list, getattr(settings, 'BUDGET_LIST_PER_PAGE', 50))
-        page = paginator.page(request.GET.get('page', 1))
-        transactions = page.object_list
-    except InvalidPage:
-        raise Http404('Invalid page requested.')
+    transaction_list = model_class.active.select_related('category').order_by('-date', '-created')
+    transactions, paginator, page = paginate(request, transaction_list, ('-date', '-created', '-id'))
     return render_to_response(template_name, {
         'transactions': transactions,
         'paginator': paginator,
@@ -35,6 +41,7 @@ def transaction_list(request, model_class=Transaction, template_name='budget/tra
     }, context_instance=RequestContext(request))
 
 
+@instrument
 def transaction_add(request, form_class=TransactionForm, template_name='budget/transactions/add.html'):
     """
     Create a new transaction object.
@@ -57,6 +64,45 @@ def transaction_add(request, form_class=TransactionForm, template_name='budget/t
     }, context_instance=RequestContext(request))
 
 
+@instrument
+def transaction_batch(request, formset_class=TransactionBatchFormSet, template_name='budget/transactions/batch.html'):
+    """
+    Adds many transactions at once. Every row is validated before any are
+    saved, then they're all inserted together in one database transaction.
+
+    Answers AJAX requests with a JSON object holding the number of
+    transactions added (or the errors for each row) instead of redirecting.
+
+    Templates: ``budget/transactions/batch.html``
+    Context:
+        formset
+            a transaction batch formset
+    """
+    if request.POST:
+        formset = formset_class(request.POST)
+
+        if formset.is_valid():
+            created = commit_on_success(formset.save)()
+
+            if request.is_ajax():
+                return HttpResponse(simplejson.dumps({'created': created}), mimetype='application/json')
+
+            return HttpResponseRedirect(reverse('budget_transaction_list'))
+
+        if request.is_ajax():
+            errors = {
+                'rows': formset.row_errors(),
+                'batch': [force_unicode(error) for error in formset.non_form_errors()],
+            }
+            return HttpResponseBadRequest(simplejson.dumps({'errors': errors}), mimetype='application/json')
+    else:
+        formset = formset_class()
+    return render_to_response(template_name, {
+        'formset': formset,
+    }, context_instance=RequestContext(request))
+
+
+@instrument
 def transaction_edit(request, transaction_id, model_class=Transaction, form_class=TransactionForm, template_name='budget/transactions/edit.html'):
     """
     Edit a transaction object.
@@ -83,6 +129,7 @@ def transaction_edit(request, transaction_id, model_class=Transaction, form_clas
     }, context_instance=RequestContext(request))
 
 
+@instrument
 def transaction_delete(request, transaction_id, model_class=Transaction, template_name='budget/transactions/delete.html'):
     """
     Delete a transaction object.
@@ -100,3 +147,59 @@ def transaction_delete(request, transaction_id, model_class=Transaction, templat
     return render_to_response(template_name, {
         'transaction': transaction,
     }, context_instance=RequestContext(request))
+
+
+@instrument
+def transaction_export(request, format, model_class=Transaction, form_class=TransactionExportForm):
+    """
+    Streams the active transactions as CSV or JSON lines.
+
+    The ``start_date``, ``end_date``, ``transaction_type`` and ``category``
+    (a slug) GET parameters narrow down which transactions are exported.
+    Rows are written as they are read, so make sure no middleware buffers
+    the response (e.g. ``GZipMiddleware`` or ETag generation).
+    """
+    form = form_class(request.GET)
+
+    if not form.is_valid():
+        return HttpResponseBadRequest('Invalid export filters.')
+
+    transactions = filter_transactions(model_class.active.all(), **form.cleaned_data)
+    response = HttpResponse(export_transactions(transactions, format), mimetype=EXPORT_MIMETYPES[format])
+    response['Content-Disposition'] = 'attachment; filename=transactions.%s' % format
+    return response
+
+
+@instrument
+def transaction_bulk(request, model_class=Transaction, form_class=TransactionBulkForm, template_name='budget/transactions/bulk.html'):
+    """
+    Recategorizes, retypes, deletes or restores every transaction matching
+    a filter at once.
+
+    Answers AJAX requests with a JSON object holding the number of
+    transactions changed (or the form errors) instead of redirecting.
+
+    Templates: ``budget/transactions/bulk.html``
+    Context:
+        form
+            a bulk transaction form
+    """
+    if request.POST:
+        form = form_class(request.POST)
+
+        if form.is_valid():
+            updated = update_transactions(form.filter(tenancy.scope(model_class.objects.all())), **form.values())
+
+            if request.is_ajax():
+                return HttpResponse(simplejson.dumps({'updated': updated}), mimetype='application/json')
+
+            return HttpResponseRedirect(reverse('budget_transaction_list'))
+
+        if request.is_ajax():
+            errors = dict([(name, [force_unicode(error) for error in field_errors]) for name, field_errors in form.errors.items()])
+            return HttpResponseBadRequest(simplejson.dumps({'errors': errors}), mimetype='application/json')
+    else:
+        form = form_class()
+    return render_to_response(template_name, {
+        'form': form,
+    }, context_instance=RequestContext(request))
@@ -0,0 +1,230 @@
+"""
+Multi-year trend reports.
+
+A trend report is a category by month matrix of actual expenses and incomes
+over an arbitrary span of months, along with the budget that applies to each
+month. Everything comes from a single grouped query (or the rollups when
+``BUDGET_USE_ROLLUPS`` is enabled), so a five year report costs the same
+handful of queries as a single month.
+"""
+import datetime
+from array import array
+from decimal import Decimal
+from django.db import connection
+from django.db.models import Count, Sum
+from budget import tenancy
+from budget.models import Budget, covers_whole_months
+from budget.categories.models import Category
+from budget.transactions.models import Transaction, TransactionRollup, first_of_month, rollups_enabled
+
+
+def months_between(start_date, end_date):
+    """
+    Returns the first day of every month from ``start_date`` to ``end_date``
+    inclusive.
+    """
+    months = []
+    year, month = start_date.year, start_date.month
+
+    while (year, month) <= (end_date.year, end_date.month):
+        months.append(datetime.date(year, month, 1))
+        month += 1
+
+        if month > 12:
+            year += 1
+            month = 1
+
+    return months
+
+
+def last_of_month(date):
+    if date.month == 12:
+        return datetime.date(date.year, 12, 31)
+
+    return datetime.date(date.year, date.month + 1, 1) - datetime.timedelta(days=1)
+
+
+def to_cents(amount):
+    return int((amount * 100).to_integral())
+
+
+def from_cents(cents):
+    return Decimal(int(cents)) / 100
+
+
+class TrendMatrix(object):
+    """
+    A category by month grid of amounts.
+
+    The cells live in a single flat ``array`` of whole cents (row-major, one
+    row per category) rather than a dictionary of ``Decimal`` objects. Cents
+    are stored as doubles, which are exact for integers well beyond any
+    realistic total, and converted back to ``Decimal`` as they're read.
+    """
+    def __init__(self, category_ids, months):
+        self.category_ids = list(category_ids)
+        self.months = list(months)
+        self.category_index = dict([(category_id, index) for index, category_id in enumerate(self.category_ids)])
+        self.month_index = dict([(month, index) for index, month in enumerate(self.months)])
+        self.cells = array('d', [0.0]) * (len(self.category_ids) * len(self.months))
+
+    def position(self, category_id, month):
+        return self.category_index[category_id] * len(self.months) + self.month_index[month]
+
+    def add(self, category_id, month, amount):
+        self.cells[self.position(category_id, month)] += to_cents(amount)
+
+    def get(self, category_id, month):
+        return from_cents(self.cells[self.position(category_id, month)])
+
+    def row(self, category_id):
+        """
+        The amounts for a category, one per month.
+        """
+        start = self.category_index[category_id] * len(self.months)
+        return [from_cents(cents) for cents in self.cells[start:start + len(self.months)]]
+
+    def row_total(self, category_id):
+        start = self.category_index[category_id] * len(self.months)
+        return from_cents(sum(self.cells[start:start + len(self.months)]))
+
+    def column_totals(self):
+        """
+        The totals across every category, one per month.
+        """
+        width = len(self.months)
+        totals = [0.0] * width
+
+        for index in range(len(self.cells)):
+            totals[index % width] += self.cells[index]
+
+        return [from_cents(cents) for cents in totals]
+
+    def total(self):
+        return from_cents(sum(self.cells))
+
+
+def month_of(value):
+    """
+    Normalizes a truncated date from the database, which some backends return
+    as a string, to the first of its month.
+    """
+    if isinstance(value, basestring):
+        return datetime.date(int(value[:4]), int(value[5:7]), 1)
+
+    return datetime.date(value.year, value.month, 1)
+
+
+def monthly_totals(start_date, end_date):
+    """
+    Yields ``(category_id, month, transaction_type, total)`` for every
+    category/month/type with active transactions in the date range, using a
+    single query.
+    """
+    if rollups_enabled() and covers_whole_months(start_date, end_date):
+        rollups = tenancy.scope(TransactionRollup.objects.filter(month__range=(first_of_month(start_date), first_of_month(end_date))), 'category__owner')
+
+        for category_id, month, transaction_type, total in rollups.values_list('category', 'month', 'transaction_type', 'total'):
+            yield (category_id, month, transaction_type, total)
+
+        return
+
+    qn = connection.ops.quote_name
+    column = '%s.%s' % (qn(Transaction._meta.db_table), qn('date'))
+    totals = Transaction.active.between(start_date, end_date)
+    totals = totals.extra(select={'month': connection.ops.date_trunc_sql('month', column)})
+
+    for row in totals.values('category', 'transaction_type', 'month').annotate(total=Sum('amount')).order_by():
+        yield (row['category'], month_of(row['month']), row['transaction_type'], row['total'])
+
+
+def month_summaries(transaction_model_class=Transaction):
+    """
+    Returns a dictionary for every month with active transactions, oldest
+    first, holding the ``month`` (a ``datetime`` like ``QuerySet.dates``
+    returns), the ``count`` of transactions and the ``expenses`` and
+    ``incomes`` totals.
+
+    With ``BUDGET_USE_ROLLUPS`` enabled this reads the rollups, which hold a
+    row per category, month and type however many transactions there are.
+    Otherwise the transactions are grouped by month in a single query.
+    """
+    if rollups_enabled() and transaction_model_class is Transaction:
+        rows = tenancy.scope(TransactionRollup.objects.filter(count__gt=0), 'category__owner').values('month', 'transaction_type').annotate(amount=Sum('total'), transactions=Sum('count')).order_by()
+    else:
+        qn = connection.ops.quote_name
+        column = '%s.%s' % (qn(transaction_model_class._meta.db_table), qn('date'))
+        rows = transaction_model_class.active.extra(select={'month': connection.ops.date_trunc_sql('month', column)})
+        rows = rows.values('month', 'transaction_type').annotate(amount=Sum('amount'), transactions=Count('id')).order_by()
+
+    summaries = {}
+
+    for row in rows:
+        month = month_of(row['month'])
+        summary = summaries.setdefault(month, {
+            'month': datetime.datetime(month.year, month.month, 1),
+            'count': 0,
+            'expenses': Decimal('0.0'),
+            'incomes': Decimal('0.0'),
+        })
+        summary['count'] += row['transactions']
+
+        if row['transaction_type'] == 'income':
+            summary['incomes'] += row['amount']
+        else:
+            summary['expenses'] += row['amount']
+
+    return [summaries[month] for month in sorted(summaries.keys())]
+
+
+def budgets_for_months(months, budget_model_class=Budget):
+    """
+    Returns the budget that applies to each month (the most current one as of
+    the month's last day, like ``BudgetManager.most_current_for_date``), or
+    ``None`` where no budget had started yet.
+
+    All of the months are resolved in one go against the budget index.
+    """
+    return budget_model_class.active.most_current_for_dates([last_of_month(month) for month in months])
+
+
+class TrendReport(object):
+    """
+    Actual expenses and incomes per category and month between two dates.
+
+    ``categories`` only includes categories with transactions in the span,
+    ordered by name. ``expenses`` and ``incomes`` are ``TrendMatrix``
+    objects, and ``budgets`` holds the applicable budget for each month.
+    """
+    def __init__(self, start_date, end_date, budget_model_class=Budget):
+        self.start_date = start_date
+        self.end_date = end_date
+        self.months = months_between(start_date, end_date)
+        totals = list(monthly_totals(start_date, end_date))
+        category_ids = set([row[0] for row in totals])
+        self.categories = list(Category.objects.filter(pk__in=category_ids).order_by('name'))
+        category_ids = [category.pk for category in self.categories]
+        self.expenses = TrendMatrix(category_ids, self.months)
+        self.incomes = TrendMatrix(category_ids, self.months)
+
+        for category_id, month, transaction_type, total in totals:
+            if transaction_type == 'income':
+                self.incomes.add(category_id, month, total)
+            else:
+                self.expenses.add(category_id, month, total)
+
+        self.budgets = budgets_for_months(self.months, budget_model_class)
+
+    def rows(self):
+        """
+        Yields a dictionary per category with its monthly expenses and
+        incomes and their totals, ready for a template.
+        """
+        for category in self.categories:
+            yield {
+                'category': category,
+                'expenses': self.expenses.row(category.pk),
+                'incomes': self.incomes.row(category.pk),
+                'expense_total': self.expenses.row_total(category.pk),
+                'income_total': self.incomes.row_total(category.pk),
+            }
@@ -18,11 +18,15 @@ Day Summary
 urlpatterns = patterns('budget.views',
     url(r'^$', 'dashboard', name='budget_dashboard'),
     url(r'^setup/$', 'setup', name='budget_setup'),
+    url(r'^_stats/$', 'stats', name='budget_stats'),
     
     # Summaries
     url(r'^summary/$', 'summary_list', name='budget_summary_list'),
     url(r'^summary/(?P<year>\d{4})/$', 'summary_year', name='budget_summary_year'),
     url(r'^summary/(?P<year>\d{4})/(?P<month>\d{1,2})/$', 'summary_month', name='budget_summary_month'),
+    url(r'^summary/trends/(?P<start_year>\d{4})-(?P<end_year>\d{4})/$', 'trend_report', name='budget_trend_report'),
+    url(r'^summary/(?P<year>\d{4})/export/(?P<format>csv|json)/$', 'summary_export', name='budget_summary_year_export'),
+    url(r'^summary/(?P<year>\d{4})/(?P<month>\d{1,2})/export/(?P<format>csv|json)/$', 'summary_export', name='budget_summary_month_export'),
     
     # Categories
     url(r'^category/', include('budget.categories.urls')),
@@ -42,3 +46,18 @@ urlpatterns = patterns('budget.views',
     # Transaction
     url(r'^transaction/', include('budget.transactions.urls')),
 )
+
+urlpatterns += patterns('budget.api',
+    # API
+    url(r'^api/transactions/$', 'transaction_collection', name='budget_api_transactions'),
+    url(r'^api/transactions/batch/$', 'transaction_batch', name='budget_api_transaction_batch'),
+    url(r'^api/transactions/(?P<transaction_id>\d+)/$', 'transaction_resource', name='budget_api_transaction'),
+    url(r'^api/categories/$', 'category_collection', name='budget_api_categories'),
+    url(r'^api/categories/(?P<slug>[\w-]+)/$', 'category_resource', name='budget_api_category'),
+    url(r'^api/budgets/$', 'budget_collection', name='budget_api_budgets'),
+    url(r'^api/budgets/(?P<slug>[\w-]+)/$', 'budget_resource', name='budget_api_budget'),
+    url(r'^api/budgets/(?P<budget_slug>[\w-]+)/estimates/$', 'estimate_collection', name='budget_api_estimates'),
+    url(r'^api/budgets/(?P<budget_slug>[\w-]+)/estimates/(?P<estimate_id>\d+)/$', 'estimate_resource', name='budget_api_estimate'),
+    url(r'^api/reports/(?P<year>\d{4})/$', 'report', name='budget_api_report_year'),
+    url(r'^api/reports/(?P<year>\d{4})/(?P<month>\d{1,2})/$', 'report', name='budget_api_report_month'),
+)
@@ -1,18 +1,40 @@
 import datetime
 from decimal import Decimal
-from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
-from django.core.paginator import Paginator, InvalidPage
 from django.core.urlresolvers import reverse
-from django.http import Http404, HttpResponseRedirect
+from django.http import Http404, HttpResponse, HttpResponseRedirect
+from django.utils import simplejson
 from django.shortcuts import render_to_response, get_object_or_404
 from django.template import RequestContext
-from budget.models import Budget, BudgetEstimate
+from budget import caching
+from budget import instrumentation
+from budget.analytics import Analytics
+from budget.instrumentation import instrument
+from budget.models import Budget, BudgetEstimate, ReportJob, async_reports_enabled
 from budget.categories.models import Category
 from budget.transactions.models import Transaction
 from budget.forms import BudgetEstimateForm, BudgetForm
+from budget.pagination import paginate
+from budget.exporters import export_summary
+from budget.trends import TrendReport, month_summaries
+from budget.transactions.views import EXPORT_MIMETYPES
 
 
+def month_bounds(year, month):
+    """
+    Returns the first and last dates of a month.
+    """
+    start_date = datetime.date(int(year), int(month), 1)
+    end_year, end_month = int(year), int(month) + 1
+
+    if end_month > 12:
+        end_year += 1
+        end_month = 1
+
+    return (start_date, datetime.date(end_year, end_month, 1) - datetime.timedelta(days=1))
+
+
+@instrument
 def dashboard(request, budget_model_class=Budget, transaction_model_class=Transaction, template_name='budget/dashboard.html'):
     """
     Provides a high-level rundown of recent activity and budget status.
@@ -49,11 +71,11 @@ def dashboard(request, budget_model_class=Budget, transaction_model_class=Transa
         # as this view is meaningless without at least basic data in place.
         return HttpResponseRedirect(reverse('budget_setup'))
 
-    latest_expenses = transaction_model_class.expenses.get_latest()
-    latest_incomes = transaction_model_class.incomes.get_latest()
+    latest_expenses = caching.get_latest(transaction_model_class.expenses)
+    latest_incomes = caching.get_latest(transaction_model_class.incomes)
 
-    estimated_amount = budget.monthly_estimated_total()
-    amount_used = budget.actual_total(start_date, end_date)
+    estimated_amount = caching.monthly_estimated_total(budget)
+    amount_used = caching.actual_total(budget, start_date, end_date)
 
     if estimated_amount == 0:
         progress_bar_percent = 100
@@ -73,6 +95,7 @@ def dashboard(request, budget_model_class=Budget, transaction_model_class=Transa
     }, context_instance=RequestContext(request))
 
 
+@instrument
 def setup(request, template_name='budget/setup.html'):
     """
     Displays a setup page which ties together the
@@ -84,6 +107,7 @@ def setup(request, template_name='budget/setup.html'):
     return render_to_response(template_name, {}, context_instance=RequestContext(request))
 
 
+@instrument
 def summary_list(request, transaction_model_class=Transaction, template_name='budget/summaries/summary_list.html'):
     """
     Displays a list of all months that may have transactions for that month.
@@ -92,13 +116,66 @@ def summary_list(request, transaction_model_class=Transaction, template_name='bu
     Context:
         dates
             a list of datetime objects representing all years/months that have transactions
+        months
+            a list of dictionaries with the ``month``, the ``count`` of transactions and the ``expenses`` and ``incomes`` totals for each of those months
     """
-    dates = transaction_model_class.active.all().dates('date', 'month')
+    months = month_summaries(transaction_model_class)
     return render_to_response(template_name, {
-        'dates': dates,
+        'dates': [summary['month'] for summary in months],
+        'months': months,
     }, context_instance=RequestContext(request))
 
 
+def render_report(request, template_name, context_function, budget_model_class=Budget, **params):
+    """
+    Renders the context built by ``context_function(**params)``.
+
+    With ``BUDGET_ASYNC_REPORTS`` enabled, the context is built by the
+    ``budget_worker`` command instead. The latest result is served while a
+    fresh one is prepared, and ``budget/summaries/preparing.html`` is
+    rendered (with a 202 status) until the first one is ready. If the job
+    failed before producing one, ``budget/summaries/failed.html`` is rendered
+    (with a 500 status) until it's retried. Only the default budget model can
+    be used asynchronously.
+    """
+    if async_reports_enabled() and budget_model_class is Budget:
+        job = ReportJob.objects.request('%s.%s' % (context_function.__module__, context_function.__name__), **params)
+        context = job.get_result()
+
+        if context is None and job.status == 'failed':
+            response = render_to_response('budget/summaries/failed.html', {
+                'job': job,
+            }, context_instance=RequestContext(request))
+            response.status_code = 500
+            return response
+
+        if context is None:
+            response = render_to_response('budget/summaries/preparing.html', {
+                'job': job,
+            }, context_instance=RequestContext(request))
+            response.status_code = 202
+            return response
+    else:
+        context = context_function(budget_model_class=budget_model_class, **params)
+
+    return render_to_response(template_name, context, context_instance=RequestContext(request))
+
+
+def summary_year_context(year, budget_model_class=Budget):
+    start_date = datetime.date(int(year), 1, 1)
+    end_date = datetime.date(int(year), 12, 31)
+    budget = budget_model_class.active.most_current_for_date(end_date)
+    estimates_and_transactions, actual_total = caching.estimates_and_transactions(budget, start_date, end_date)
+    return {
+        'budget': budget,
+        'estimates_and_transactions': estimates_and_transactions,
+        'actual_total': actual_total,
+        'start_date': start_date,
+        'end_date': end_date,
+    }
+
+
+@instrument
 def summary_year(request, year, budget_model_class=Budget, template_name='budget/summaries/summary_year.html'):
     """
     Displays a budget report for the year to date.
@@ -116,19 +193,10 @@ def summary_year(request, year, budget_model_class=Budget, template_name='budget
         end_date
             the last date for the year
     """
-    start_date = datetime.date(int(year), 1, 1)
-    end_date = datetime.date(int(year), 12, 31)
-    budget = budget_model_class.active.most_current_for_date(end_date)
-    estimates_and_transactions, actual_total = budget.estimates_and_transactions(start_date, end_date)
-    return render_to_response(template_name, {
-        'budget': budget,
-        'estimates_and_transactions': estimates_and_transactions,
-        'actual_total': actual_total,
-        'start_date': start_date,
-        'end_date': end_date,
-    }, context_instance=RequestContext(request))
+    return render_report(request, template_name, summary_year_context, budget_model_class, year=int(year))
 
 
+@instrument
 def summary_month(request, year, month, budget_model_class=Budget, template_name='budget/summaries/summary_month.html'):
     """
     Displays a budget report for the month to date.
@@ -146,16 +214,9 @@ def summary_month(request, year, month, budget_model_class=Budget, template_name
         end_date
             the last date for the month
     """
-    start_date = datetime.date(int(year), int(month), 1)
-    end_year, end_month = int(year), int(month) + 1
-
-    if end_month > 12:
-        end_year += 1
-        end_month = 1
-
-    end_date = datetime.date(end_year, end_month, 1) - datetime.timedelta(days=1)
+    start_date, end_date = month_bounds(year, month)
     budget = budget_model_class.active.most_current_for_date(end_date)
-    estimates_and_transactions, actual_total = budget.estimates_and_transactions(start_date, end_date)
+    estimates_and_transactions, actual_total = caching.estimates_and_transactions(budget, start_date, end_date)
     return render_to_response(template_name, {
         'budget': budget,
         'estimates_and_transactions': estimates_and_transactions,
@@ -165,6 +226,96 @@ def summary_month(request, year, month, budget_model_class=Budget, template_name
     }, context_instance=RequestContext(request))
 
 
+@instrument
+def summary_export(request, year, month=None, format='csv', budget_model_class=Budget):
+    """
+    Streams a year or month summary as CSV (one row per estimate) or JSON
+    lines (each estimate followed by its transactions).
+    """
+    if month is None:
+        start_date, end_date = datetime.date(int(year), 1, 1), datetime.date(int(year), 12, 31)
+        filename = 'summary-%s.%s' % (year, format)
+    else:
+        start_date, end_date = month_bounds(year, month)
+        filename = 'summary-%s-%02d.%s' % (year, int(month), format)
+
+    try:
+        budget = budget_model_class.active.most_current_for_date(end_date)
+    except ObjectDoesNotExist:
+        raise Http404('No budget covers the requested dates.')
+
+    response = HttpResponse(export_summary(budget, start_date, end_date, format), mimetype=EXPORT_MIMETYPES[format])
+    response['Content-Disposition'] = 'attachment; filename=%s' % filename
+    return response
+
+
+def trend_report_context(start_year, end_year, budget_model_class=Budget):
+    start_date = datetime.date(int(start_year), 1, 1)
+    end_date = datetime.date(int(end_year), 12, 31)
+    report = TrendReport(start_date, end_date, budget_model_class)
+    analytics = Analytics(report)
+    rows = list(report.rows())
+
+    for row, variance, percents, averages, projection in zip(rows, analytics.variance(), analytics.percent_of_estimate(), analytics.moving_average(), analytics.projection()):
+        row.update({
+            'variance': variance,
+            'percent_of_estimate': percents,
+            'moving_average': averages,
+            'projection': projection,
+        })
+
+    return {
+        'report': report,
+        'rows': rows,
+        'months': report.months,
+        'budgets': report.budgets,
+        'expense_totals': report.expenses.column_totals(),
+        'income_totals': report.incomes.column_totals(),
+        'start_date': start_date,
+        'end_date': end_date,
+    }
+
+
+@instrument
+def trend_report(request, start_year, end_year, budget_model_class=Budget, template_name='budget/summaries/trends.html'):
+    """
+    Displays the actual expenses and incomes of every category for each month
+    between two years (inclusive).
+
+    Templates: ``budget/summaries/trends.html``
+    Context:
+        report
+            a ``TrendReport`` object
+        rows
+            a list of dictionaries containing each category, its monthly expenses and incomes and their totals, its monthly variance from and percent of the estimate and three month moving average, and its projected total after another twelve months (see ``budget.analytics.Analytics``)
+        months
+            the first date of each month in the report
+        budgets
+            the applicable budget object (or ``None``) for each month
+        start_date
+            the first date of the report
+        end_date
+            the last date of the report
+    """
+    if int(end_year) < int(start_year):
+        raise Http404('The report must end after it starts.')
+
+    return render_report(request, template_name, trend_report_context, budget_model_class, start_year=int(start_year), end_year=int(end_year))
+
+
+def stats(request):
+    """
+    Serves the histograms gathered by ``InstrumentationMiddleware`` as JSON.
+
+    Only available when ``BUDGET_INSTRUMENTATION`` is enabled.
+    """
+    if not instrumentation.instrumentation_enabled():
+        raise Http404('Instrumentation is not enabled.')
+
+    return HttpResponse(simplejson.dumps(instrumentation.stats.as_dict(), indent=2, sort_keys=True), mimetype='application/json')
+
+
+@instrument
 def budget_list(request, model_class=Budget, template_name='budget/budgets/list.html'):
     """
     A list of budget objects.
@@ -174,17 +325,12 @@ def budget_list(request, model_class=Budget, template_name='budget/budgets/list.
         budgets
             paginated list of budget objects
         paginator
-            A Django Paginator instance
+            A Django Paginator (or KeysetPaginator) instance
         page
             current page of budget objects
     """
     budgets_list = model_class.active.all()
-    try:
-        paginator = Paginator(budgets_list, getattr(settings, 'BUDGET_LIST_PER_PAGE', 50))
-        page = paginator.page(request.GET.get('page', 1))
-        budgets = page.object_list
-    except InvalidPage:
-        raise Http404('Invalid page requested.')
+    budgets, paginator, page = paginate(request, budgets_list, ('id',))
     return render_to_response(template_name, {
         'budgets': budgets,
         'paginator': paginator,
@@ -192,6 +338,7 @@ def budget_list(request, model_class=Budget, template_name='budget/budgets/list.
     }, context_instance=RequestContext(request))
 
 
+@instrument
 def budget_add(request, form_class=BudgetForm, template_name='budget/budgets/add.html'):
     """
     Create a new budget object.
@@ -214,6 +361,7 @@ def budget_add(request, form_class=BudgetForm, template_name='budget/budgets/add
     }, context_instance=RequestContext(request))
 
 
+@instrument
 def budget_edit(request, slug, model_class=Budget, form_class=BudgetForm, template_name='budget/budgets/edit.html'):
     """
     Edit a budget object.
@@ -240,6 +388,7 @@ def budget_edit(request, slug, model_class=Budget, form_class=BudgetForm, templa
     }, context_instance=RequestContext(request))
 
 
+@instrument
 def budget_delete(request, slug, model_class=Budget, template_name='budget/budgets/delete.html'):
     """
     Delete a budget object.
@@ -259,6 +408,7 @@ def budget_delete(request, slug, model_class=Budget, template_name='budget/budge
     }, context_instance=RequestContext(request))
 
 
+@instrument
 def estimate_list(request, budget_slug, budget_model_class=Budget, model_class=BudgetEstimate, template_name='budget/estimates/list.html'):
     """
     A list of estimate objects.
@@ -270,18 +420,13 @@ def estimate_list(request, budget_slug, budget_model_class=Budget, model_class=B
         estimates
             paginated list of estimate objects
         paginator
-            A Django Paginator instance
+            A Django Paginator (or KeysetPaginator) instance
         page
             current page of estimate objects
     """
     budget = get_object_or_404(budget_model_class.active.all(), slug=budget_slug)
-    estimates_list = model_class.active.all()
-    try:
-        paginator = Paginator(estimates_list, getattr(settings, 'BUDGET_LIST_PER_PAGE', 50))
-        page = paginator.page(request.GET.get('page', 1))
-        estimates = page.object_list
-    except InvalidPage:
-        raise Http404('Invalid page requested.')
+    estimates_list = model_class.active.select_related('category', 'budget')
+    estimates, paginator, page = paginate(request, estimates_list, ('id',))
     return render_to_response(template_name, {
         'budget': budget,
         'estimates': estimates,
@@ -290,6 +435,7 @@ def estimate_list(request, budget_slug, budget_model_class=Budget, model_class=B
     }, context_instance=RequestContext(request))
 
 
+@instrument
 def estimate_add(request, budget_slug, budget_model_class=Budget, form_class=BudgetEstimateForm, template_name='budget/estimates/add.html'):
     """
     Create a new estimate object.
@@ -316,6 +462,7 @@ def estimate_add(request, budget_slug, budget_model_class=Budget, form_class=Bud
     }, context_instance=RequestContext(request))
 
 
+@instrument
 def estimate_edit(request, budget_slug, estimate_id, budget_model_class=Budget, form_class=BudgetEstimateForm, template_name='budget/estimates/edit.html'):
     """
     Edit a estimate object.
@@ -349,6 +496,7 @@ def estimate_edit(request, budget_slug, estimate_id, budget_model_class=Budget,
     }, context_instance=RequestContext(request))
 
 
+@instrument
 def estimate_delete(request, budget_slug, estimate_id, budget_model_class=Budget, template_name='budget/estimates/delete.html'):
     """
     Delete a estimate object.